@@ -0,0 +1,315 @@
+"""
+    Write-behind recording of Access objects.
+"""
+
+import atexit
+import datetime
+import logging
+import threading
+import time
+
+from django.db import connection
+
+from linkanalytics.models import TrackedInstance
+from linkanalytics.models import new_access, save_accesses, save_failure_counts
+from linkanalytics.models import _ACCESS_FAILURE_UUID
+from linkanalytics import app_settings, instancecache
+
+logger = logging.getLogger('linkanalytics')
+
+#==============================================================================#
+# Every tracked access results in an Access object.  Saving each one while the
+# request is being handled means every pixel and redirect waits on its own
+# INSERT and commit.  An AccessRecorder instead collects Access objects in a
+# bounded buffer and writes them with bulk inserts.  The buffer is flushed
+# when it holds batch_size Accesses, when flush_interval seconds have passed,
+# or when the process exits.
+#
+# With a background thread, flushing happens off the request path entirely.
+# Without one, the request which crosses a threshold performs the flush.
+#
+# Failed accesses (unknown uuids, bad hashes) are mostly generated by bots, 
+# and can arrive in great numbers.  These are tallied per minute and written 
+# as AccessFailureCounts along with the buffered Accesses.  Only the first 
+# few failures of each kind per minute are kept as Access objects.  The 
+# counts are buffered even by a synchronous recorder, and written with the 
+# next Access saved or once flush_interval seconds have passed.
+#
+# Accesses may also be recorded by uuid (see record_deferred()).  The uuids 
+# are resolved to TrackedInstances when the Accesses are written, all in one 
+# query.  Combined with buffering, a tracked request then does no database 
+# work at all.
+#==============================================================================#
+
+class AccessRecorder(object):
+    """Buffers Access objects and writes them to the database in batches."""
+
+    def __init__(self, synchronous=False, batch_size=100, flush_interval=5.0,
+                 buffer_limit=10000, failure_samples=10, background=True, 
+                 clock=time.time):
+        self.synchronous = synchronous
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer_limit = buffer_limit
+        self.failure_samples = failure_samples
+        self.background = background
+        self.clock = clock
+
+        # Number of Accesses written to the database.
+        self.flushed = 0
+        # Number of Accesses discarded because the buffer was full.
+        self.dropped = 0
+
+        self._buffer = []
+        # Failure counts not yet written: {(minute, result): count}
+        self._failures = {}
+        # Failures seen so far during the current minute: {result: count}
+        self._failure_minute = None
+        self._failures_this_minute = {}
+        self._lock = threading.Lock()
+        self._last_flush = clock()
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._closed = False
+
+    @staticmethod
+    def from_settings():
+        """Create an AccessRecorder configured by the LINKANALYTICS_ACCESS_*
+           settings."""
+        return AccessRecorder(
+                synchronous=    app_settings.ACCESS_RECORDING == 'sync',
+                batch_size=     app_settings.ACCESS_BATCH_SIZE,
+                flush_interval= app_settings.ACCESS_FLUSH_INTERVAL,
+                buffer_limit=   app_settings.ACCESS_BUFFER_LIMIT,
+                failure_samples=app_settings.ACCESS_FAILURE_SAMPLES )
+
+    def pending(self):
+        """Returns the number of Accesses waiting to be written."""
+        with self._lock:
+            return len(self._buffer)
+
+    def stats(self):
+        """Returns a dict of the recorder's counters."""
+        with self._lock:
+            return { 'pending': len(self._buffer),
+                     'flushed': self.flushed,
+                     'dropped': self.dropped }
+
+    def record(self, instance_id, result, url, tracker_id=None):
+        """Record an access of the TrackedInstance with the given primary key.
+           The result and url arguments are as for TrackedInstance.on_access().
+           tracker_id, if given, is the primary key of the TrackedInstance's 
+           Tracker.
+        """
+        self.add(new_access(instance_id, result, url, tracker_id=tracker_id))
+
+    def record_deferred(self, uuid, result, url):
+        """Record an access of the TrackedInstance with the given uuid.  Unless 
+           it is already cached, the TrackedInstance is not looked up until the 
+           Access is written.  If there turns out to be no such 
+           TrackedInstance, the access is counted as a failure instead.
+        """
+        ref = instancecache.get_cached(uuid)
+        if ref is not None:
+            self.add(new_access(ref.pk, result, url, 
+                                tracker_id=ref.tracker_id))
+        else:
+            access = new_access(None, result, url)
+            access.deferred_uuid = uuid
+            self.add(access)
+
+    def record_failure(self, result, url, instance_id=None):
+        """Record a failed access.  If the TrackedInstance is not known, 
+           instance_id should be None; any sample Access is then recorded 
+           against the unknown TrackedInstance.
+        """
+        now = datetime.datetime.fromtimestamp(self.clock())
+        n = self._count_failure(result, now)
+        if n <= self.failure_samples:
+            if instance_id is None:
+                instance_id = TrackedInstance.unknown_pk()
+            self.add(new_access(instance_id, result, url, time=now))
+        elif self._closed:
+            self._flush_failures()
+        elif self.background and not self.synchronous:
+            self._ensure_thread()
+        elif self.clock() - self._last_flush >= self.flush_interval:
+            # Even when synchronous, the counts are only written every 
+            # flush_interval seconds, or along with the next Access.
+            with self._lock:
+                self._last_flush = self.clock()
+            self._flush_failures()
+
+    def _count_failure(self, result, when):
+        """Add one to the failure count for the minute containing when.  
+           Returns the number of such failures seen by this recorder during 
+           the current minute."""
+        minute = when.replace(second=0, microsecond=0)
+        with self._lock:
+            if minute != self._failure_minute:
+                self._failure_minute = minute
+                self._failures_this_minute = {}
+            n = self._failures_this_minute.get(result, 0) + 1
+            self._failures_this_minute[result] = n
+            key = (minute, result)
+            self._failures[key] = self._failures.get(key, 0) + 1
+        return n
+
+    def add(self, access):
+        """Record the given unsaved Access object."""
+        if self.synchronous or self._closed:
+            n = self._save([access])
+            with self._lock:
+                self.flushed += n
+            self._flush_failures()
+            return
+
+        with self._lock:
+            if len(self._buffer) >= self.buffer_limit:
+                self.dropped += 1
+                return
+            self._buffer.append(access)
+            due = (len(self._buffer) >= self.batch_size or
+                   self.clock() - self._last_flush >= self.flush_interval)
+
+        if self.background:
+            self._ensure_thread()
+            if due:
+                self._wakeup.set()
+        elif due:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered Accesses to the database.  Returns the number of
+           Accesses written.  If the write fails, the Accesses are returned to
+           the buffer (as far as its limit allows) and the exception is
+           reraised.
+        """
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+            self._last_flush = self.clock()
+        n = 0
+        if batch:
+            try:
+                n = self._save(batch)
+            except Exception:
+                with self._lock:
+                    room = max(self.buffer_limit - len(self._buffer), 0)
+                    self.dropped += max(len(batch) - room, 0)
+                    self._buffer[0:0] = batch[:room]
+                raise
+            with self._lock:
+                self.flushed += n
+        self._flush_failures()
+        return n
+
+    def _save(self, accesses):
+        """Resolve the uuids of any deferred Accesses, then save them all.  
+           Returns the number of Accesses saved.  Accesses of unknown uuids 
+           are counted as failures once the others have been saved, so 
+           that retrying a failed save does not count them twice."""
+        unknown = []
+        deferred = [a for a in accesses if a.instance_id is None]
+        if deferred:
+            refs = instancecache.lookup_many(set(a.deferred_uuid 
+                                                 for a in deferred))
+            resolved = []
+            for a in accesses:
+                if a.instance_id is None:
+                    ref = refs.get(a.deferred_uuid)
+                    if ref is None:
+                        unknown.append(a)
+                        continue
+                    a.instance_id = ref.pk
+                    a.tracker_id = ref.tracker_id
+                resolved.append(a)
+            accesses = resolved
+        if accesses:
+            save_accesses(accesses)
+        for a in unknown:
+            self._count_failure(_ACCESS_FAILURE_UUID, a.time)
+        return len(accesses)
+
+    def _flush_failures(self):
+        """Write the pending failure counts to the database."""
+        with self._lock:
+            failures, self._failures = self._failures, {}
+        if not failures:
+            return
+        try:
+            save_failure_counts(failures)
+        except Exception:
+            with self._lock:
+                for key, n in failures.iteritems():
+                    self._failures[key] = self._failures.get(key, 0) + n
+            raise
+
+    def close(self):
+        """Stop the background thread (if any) and flush the buffer.  Accesses
+           recorded after closing are saved immediately."""
+        self._closed = True
+        thread = self._thread
+        if thread is not None:
+            self._wakeup.set()
+            thread.join(self.flush_interval)
+            self._thread = None
+        self.flush()
+
+    def _ensure_thread(self):
+        """Start the background flushing thread if it is not running."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                t = threading.Thread(target=self._run,
+                                     name='linkanalytics-accessrecorder')
+                t.daemon = True
+                self._thread = t
+                t.start()
+
+    def _run(self):
+        """Body of the background flushing thread."""
+        try:
+            while not self._closed:
+                self._wakeup.wait(self.flush_interval)
+                self._wakeup.clear()
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception('Failed to write buffered Accesses.')
+        finally:
+            # Django opens a connection per thread, and only closes those of
+            # request threads.
+            connection.close()
+
+#==============================================================================#
+# The process-wide recorder used by the tracking views.
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+def get_recorder():
+    """Returns the process-wide AccessRecorder, creating it if necessary.  The
+       recorder is flushed when the process exits."""
+    global _recorder
+    if _recorder is None:
+        with _recorder_lock:
+            if _recorder is None:
+                r = AccessRecorder.from_settings()
+                atexit.register(r.close)
+                _recorder = r
+    return _recorder
+
+def record(instance_id, result, url, tracker_id=None):
+    """Record an access using the process-wide AccessRecorder."""
+    get_recorder().record(instance_id, result, url, tracker_id)
+
+def record_deferred(uuid, result, url):
+    """Record an access by uuid using the process-wide AccessRecorder."""
+    get_recorder().record_deferred(uuid, result, url)
+
+def record_failure(result, url, instance_id=None):
+    """Record a failed access using the process-wide AccessRecorder."""
+    get_recorder().record_failure(result, url, instance_id)
+
+#==============================================================================#
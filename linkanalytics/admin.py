@@ -1,7 +1,7 @@
 from django.contrib import admin
 
 from linkanalytics.models import Tracker, TrackedInstance, Visitor
-from linkanalytics.models import Access
+from linkanalytics.models import Access, AccessFailureCount
 
 import linkanalytics.email.admin  # register email admin classes
 
@@ -31,11 +31,16 @@ class TrackedInstanceAdmin(admin.ModelAdmin):
     list_display = ('tracker', 'visitor', 'uuid', 'notified', )
     inlines = [ AccessInline, ]
     
+class AccessFailureCountAdmin(admin.ModelAdmin):
+    list_display = ('minute', 'result', 'count', )
+    list_filter = ('result', )
+    
 
 
 admin.site.register(Tracker, TrackerAdmin)
 admin.site.register(TrackedInstance, TrackedInstanceAdmin)
 admin.site.register(Visitor, VisitorAdmin)
+admin.site.register(AccessFailureCount, AccessFailureCountAdmin)
 
 
 
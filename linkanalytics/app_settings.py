@@ -62,6 +62,70 @@ DIGEST_CTOR = hashlib.sha1
 # should not need to be changed.
 URLBASE_VARNAME = 'urlbase'
 LINKID_VARNAME = 'linkid'
+# Context variable through which the trackedurl tag reports its URLs when an
+# email is rendered once for many recipients (see _email.py).
+SLOTS_VARNAME = 'linkanalytics_slots'
+
+# Encoding of the hash and uuid in new tracked urls.  'hex' uses the full 
+# digest and the uuid in hexadecimal (72 characters in all, using SHA1).  
+# 'compact' uses 'v1' followed by the first URL_MAC_LENGTH bytes of the digest, 
+# and the uuid, both in unpadded base64url (40 characters in all, by default).  
+# Urls in either format are always accepted.
+URL_TOKEN_FORMAT = getsettings('URL_TOKEN_FORMAT', 'hex')
+
+# Number of bytes of the digest kept in compact hashes.  A compact hash must 
+# have exactly this length to be accepted.
+URL_MAC_LENGTH = getsettings('URL_MAC_LENGTH', 12)
+
+# How TrackedInstance uuids are stored.  'char' uses a 32-character string.  
+# 'binary' uses 16 raw bytes (a native uuid column on PostgreSQL), halving the 
+# size of the unique index.  To change this on an existing database, run the 
+# convert_uuid_storage management command first.
+UUID_STORAGE = getsettings('UUID_STORAGE', 'char')
+
+#==============================================================================#
+# Tracked access settings:
+
+# How Access objects are written to the database.  'sync' saves each Access
+# while the request is being handled.  'buffered' collects Accesses in memory
+# and writes them in bulk, either when ACCESS_BATCH_SIZE Accesses are waiting,
+# when ACCESS_FLUSH_INTERVAL seconds have passed, or when the process exits.
+ACCESS_RECORDING = getsettings('ACCESS_RECORDING', 'sync')
+
+# Number of buffered Accesses that triggers a bulk insert.
+ACCESS_BATCH_SIZE = getsettings('ACCESS_BATCH_SIZE', 100)
+
+# Maximum number of seconds a buffered Access may wait before being written.
+ACCESS_FLUSH_INTERVAL = getsettings('ACCESS_FLUSH_INTERVAL', 5.0)
+
+# Upper bound on the number of buffered Accesses.  Once reached, further
+# Accesses are dropped (and counted) until the buffer has been flushed.
+ACCESS_BUFFER_LIMIT = getsettings('ACCESS_BUFFER_LIMIT', 10000)
+
+# Failed accesses are counted per minute (see AccessFailureCount).  Only this
+# many failures of each kind per minute are also recorded as Accesses.
+ACCESS_FAILURE_SAMPLES = getsettings('ACCESS_FAILURE_SAMPLES', 10)
+
+# If True, a tracked URL's hash is checked before its TrackedInstance is looked
+# up, so URLs with bad hashes are rejected without querying the database.  If
+# False, the TrackedInstance is looked up first, and a bad hash is recorded 
+# against it.
+VALIDATE_HASH_FIRST = getsettings('VALIDATE_HASH_FIRST', True)
+
+# If True (and VALIDATE_HASH_FIRST is True), a tracked URL with a valid hash 
+# is served without looking up its TrackedInstance.  The uuid is resolved when 
+# the Access is written; if it has no TrackedInstance, the access is counted 
+# as a failure then.  With ACCESS_RECORDING set to 'buffered', pixel images 
+# and redirects are then served without any database queries.
+DEFER_INSTANCE_LOOKUP = getsettings('DEFER_INSTANCE_LOOKUP', False)
+
+# Number of uuid to TrackedInstance mappings cached by each process, and the
+# number of seconds each mapping is kept.  A size of 0 disables the cache.
+INSTANCE_CACHE_SIZE = getsettings('INSTANCE_CACHE_SIZE', 10000)
+INSTANCE_CACHE_TTL = getsettings('INSTANCE_CACHE_TTL', 300)
+
+# Number of urltails whose resolved targetviews are cached by each process.
+TARGET_CACHE_SIZE = getsettings('TARGET_CACHE_SIZE', 1000)
 
 #==============================================================================#
 # Email-specific settings:
@@ -90,6 +154,30 @@ EMAIL_DEFAULT_INCLUDE_PIXELIMG = getsettings('EMAIL_DEFAULT_INCLUDE_PIXELIMG',
 # Format string used when creating Trackers representing sent emails.
 EMAIL_TRACKER_NAMEFORMAT = getsettings('EMAIL_TRACKER_NAMEFORMAT', '_email_{0}')
 
+# Number of recipients whose emails are created, sent and recorded together.  
+# Only this many messages are held in memory at a time.
+EMAIL_SEND_CHUNK_SIZE = getsettings('EMAIL_SEND_CHUNK_SIZE', 200)
+
+# Number of seconds after which a SendJob claimed by a send worker, which has 
+# not recorded any progress since, may be claimed by another worker.  This 
+# must be longer than it takes to send one chunk of emails.
+EMAIL_SEND_JOB_TIMEOUT = getsettings('EMAIL_SEND_JOB_TIMEOUT', 600)
+
+# Limits on the delivery of emails to each recipient domain.  A dict mapping 
+# domains (or '*', for all others) to dicts with any of the keys 'rate' 
+# (messages per second), 'burst' (messages sent at once before the rate 
+# applies) and 'concurrency' (messages being sent at the same time).  For 
+# example: {'example.com': {'rate': 5, 'burst': 20, 'concurrency': 2}}
+EMAIL_DOMAIN_LIMITS = getsettings('EMAIL_DOMAIN_LIMITS', {})
+
+# Number of worker processes over which the emails of each chunk are rendered.  
+# With 0, emails are rendered by the process sending them.
+EMAIL_RENDER_PROCESSES = getsettings('EMAIL_RENDER_PROCESSES', 0)
+
+# Number of connections over which emails are sent at once, each from its own 
+# thread.  With 1, emails are sent one after the other.
+EMAIL_DELIVERY_WORKERS = getsettings('EMAIL_DELIVERY_WORKERS', 1)
+
 #==============================================================================#
 
 
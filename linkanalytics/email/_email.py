@@ -1,7 +1,12 @@
+import re
+import uuid
+
+from django.core import mail
 from django.template import Template, Context
 
 from linkanalytics.util.htmltotext import HTMLtoText
 from linkanalytics.util.htmldocument import HtmlDocument
+from linkanalytics.templatetags.tracked_links import render_trackedurl
 from linkanalytics import app_settings
 
 #==============================================================================#
@@ -145,6 +150,127 @@ def email_instantiator(texttpl, htmltpl, urlbase, disable_pixelimages=False):
         return (ttext.render(ctx), thtml.render(ctx))
         
     return _instantiate_email
-    
 
+#==============================================================================#
+# Rendering each email separately evaluates every template node, and builds 
+# every tracked URL, once per recipient.  Only the tracked URLs differ between 
+# recipients, so the segmented instantiator renders the templates just once, 
+# with a placeholder standing in for the uuid.  Each trackedurl tag given the 
+# placeholder records a slot in the context's SlotCollector, and outputs a 
+# marker in place of its URL.  The output is split at the markers, and each 
+# email is then assembled by joining the static segments with that 
+# recipient's URLs.
+#
+# If the placeholder itself shows up in the output (for instance, through 
+# {{ linkid }}), or a marker was altered by a filter, the templates are 
+# rendered for each recipient instead.
 
+class _Linkid(object):
+    """Stands in for the uuid while the templates are rendered once."""
+    def __init__(self, token):
+        self.token = token
+    def __unicode__(self):
+        return self.token
+    def __str__(self):
+        return str(self.token)
+        
+        
+class SlotCollector(object):
+    """Collects the tracked URLs of templates rendered with the placeholder 
+       linkid.  Each distinct (urlbase, builder) pair is one slot."""
+       
+    def __init__(self):
+        self.token = uuid.uuid4().hex
+        self.linkid = _Linkid(u'linkanalytics-linkid-{0}'.format(self.token))
+        self.slots = []
+        self._indices = {}
+        self._re_marker = re.compile(u'\x00{0}:(\d+)\x00'.format(self.token))
+        
+    def add(self, urlbase, builder):
+        """Records a slot for the URL built by builder, following urlbase.  
+           Returns the marker to output in its place."""
+        key = (urlbase, builder)
+        n = self._indices.get(key)
+        if n is None:
+            n = self._indices[key] = len(self.slots)
+            self.slots.append(key)
+        return self.marker(n)
+        
+    def marker(self, n):
+        """Returns the marker output in place of slot n."""
+        return u'\x00{0}:{1}\x00'.format(self.token, n)
+        
+    def split(self, rendered):
+        """Splits rendered output at the markers, returning a list of static 
+           segments alternating with slot numbers.  Returns None if the 
+           output cannot be split reliably."""
+        parts = self._re_marker.split(rendered)
+        for i in xrange(1, len(parts), 2):
+            parts[i] = int(parts[i])
+        # What remains of the placeholder or of a marker must not be mistaken 
+        # for static text.
+        for segment in parts[0::2]:
+            if u'\x00' in segment or self.token in segment.lower():
+                return None
+        return parts
+        
+    def urls(self, uuid):
+        """Returns the URL of each slot for the given uuid."""
+        return [render_trackedurl(urlbase, builder, uuid) 
+                for urlbase, builder in self.slots]
+        
+        
+def _assemble(parts, urls):
+    """Joins the static segments in parts with the URLs of their slots."""
+    pieces = list(parts)
+    for i in xrange(1, len(pieces), 2):
+        pieces[i] = urls[pieces[i]]
+    return u''.join(pieces)
+    
+def segmented_email_instantiator(texttpl, htmltpl, urlbase, 
+                                 disable_pixelimages=False):
+    """Returns a function that can be used to instantiate individual emails, 
+       as email_instantiator() does.  The templates are only rendered once.
+    """
+    slots = SlotCollector()
+    ctx = Context({ app_settings.URLBASE_VARNAME: urlbase,
+                    'ignore_pixelimages': disable_pixelimages,
+                    app_settings.LINKID_VARNAME: slots.linkid,
+                    app_settings.SLOTS_VARNAME: slots })
+    try:
+        text = Template('{% load tracked_links %}'+texttpl).render(ctx)
+        html = Template('{% load tracked_links %}'+htmltpl).render(ctx)
+    except Exception:
+        text = html = None
+    textparts = slots.split(text)  if text is not None else  None
+    htmlparts = slots.split(html)  if html is not None else  None
+    if textparts is None or htmlparts is None:
+        return email_instantiator(texttpl, htmltpl, urlbase, 
+                                  disable_pixelimages)
+    return SegmentedInstantiator(slots, textparts, htmlparts)
+    
+
+class SegmentedInstantiator(object):
+    """Instantiates emails from the segments of their rendered templates.  
+       Returned by segmented_email_instantiator() when the templates could 
+       be split."""
+    def __init__(self, slots, textparts, htmlparts):
+        self.slots = slots
+        self.textparts = textparts
+        self.htmlparts = htmlparts
+        
+    def __call__(self, uuid):
+        urls = self.slots.urls(uuid)
+        return (_assemble(self.textparts, urls), 
+                _assemble(self.htmlparts, urls))
+    
+    
+#==============================================================================#
+def multipart_email(subject, fromemail, text, html, address, connection=None):
+    """Returns an EmailMultiAlternatives to the given address, containing 
+       both the given text and html content."""
+    msg = mail.EmailMultiAlternatives(subject, text, fromemail, [address],
+                                      connection=connection)
+    msg.attach_alternative(html, "text/html")
+    return msg
+    
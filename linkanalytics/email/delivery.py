@@ -0,0 +1,120 @@
+"""
+    Delivery of email messages over several connections at once.
+
+    Sending a message over SMTP takes at least one round trip to the server,
+    so sending a long list of messages one after the other is limited by the
+    server's latency rather than by its throughput.  A DeliveryPool sends
+    messages from several worker threads, each with its own connection, which
+    is kept open for as many messages as the worker sends.
+
+    The order in which the workers send messages, and how quickly, is decided
+    by a DeliveryScheduler (see scheduler.py).
+
+    The workers only send messages.  They report each message's result back
+    to the calling thread, which does any database work.
+"""
+
+import threading
+
+from django.core import mail
+
+from linkanalytics.email.scheduler import DeliveryScheduler
+from linkanalytics import app_settings
+
+#==============================================================================#
+class MessageNotSent(Exception):
+    """The connection reported that a message was not sent, without raising
+       an exception of its own."""
+
+class DeliveryError(Exception):
+    """Some of the messages could not be sent.  failures is a list of
+       (recipient, exception) pairs."""
+    def __init__(self, failures):
+        msg = '{0} message(s) could not be sent'.format(len(failures))
+        super(DeliveryError, self).__init__(msg)
+        self.failures = failures
+
+
+#==============================================================================#
+class DeliveryPool(object):
+    """Sends email messages over a number of connections at once.
+
+       workers: the number of connections (and threads) used.  If it is 1,
+                messages are sent from the calling thread.  The default is
+                the EMAIL_DELIVERY_WORKERS setting.
+       connection_factory: a callable returning a new email backend
+                instance.  The default is django.core.mail.get_connection.
+       scheduler: the DeliveryScheduler deciding the order in which messages
+                are sent.  The default interleaves the recipients' domains,
+                subject to the EMAIL_DOMAIN_LIMITS setting.  The same
+                scheduler is used for every call to deliver(), so its limits
+                and counts cover them all.
+    """
+    def __init__(self, workers=None, connection_factory=None, scheduler=None):
+        if workers is None:
+            workers = app_settings.EMAIL_DELIVERY_WORKERS
+        if connection_factory is None:
+            connection_factory = mail.get_connection
+        if scheduler is None:
+            scheduler = DeliveryScheduler()
+        self.workers = max(1, workers)
+        self.connection_factory = connection_factory
+        self.scheduler = scheduler
+
+    def deliver(self, messages):
+        """Sends each of the given EmailMessages.  Returns a list with an
+           entry for each message, in the same order: None if it was sent, or
+           the exception which prevented it from being sent."""
+        messages = list(messages)
+        results = [None] * len(messages)
+        self.scheduler.start(messages)
+
+        n = min(self.workers, len(messages))
+        if n <= 1:
+            self._work(results)
+            return results
+
+        threads = [threading.Thread(target=self._work, args=(results,))
+                   for i in xrange(n)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def _work(self, results):
+        """Sends the messages handed out by the scheduler over one connection
+           until none remain.  The connection is reopened after any
+           failure."""
+        connection = None
+        try:
+            while True:
+                task = self.scheduler.next()
+                if task is None:
+                    return
+                n, msg = task
+                try:
+                    if connection is None:
+                        connection = self.connection_factory()
+                        connection.open()
+                    if not connection.send_messages([msg]):
+                        raise MessageNotSent()
+                except Exception as e:
+                    results[n] = e
+                    self._close(connection)
+                    connection = None
+                self.scheduler.done(n, results[n])
+        finally:
+            self._close(connection)
+
+    def _close(self, connection):
+        if connection is None:
+            return
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+#==============================================================================#
@@ -1,14 +1,13 @@
 import datetime
 import re
 
-from django.db import models
-from django.core import mail
+from django.db import models, transaction
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 
 from linkanalytics.models import Visitor, Tracker, TrackedInstance
 from linkanalytics.models import Access, _create_uuid
-from linkanalytics.email import _email
-from linkanalytics import app_settings
+from linkanalytics.email import _email, delivery, rendering
+from linkanalytics import app_settings, instancecache
 
 #==============================================================================#
 # Extras:
@@ -16,6 +15,10 @@ from linkanalytics import app_settings
 class EmailAlreadySentError(Exception):
     """An attempt was made to send a DraftEmail object that was already sent."""
 
+class ClaimLost(Exception):
+    """A SendJob was claimed by another worker (or finished) while it was 
+       being run."""
+
 def _create_tracker_for_email():
     """Creates a Tracker to be used with a new email message."""
     fmt = app_settings.EMAIL_TRACKER_NAMEFORMAT
@@ -23,6 +26,44 @@ def _create_tracker_for_email():
     u.save()
     return u
 
+def _claim_time():
+    """Returns the current time, as stored in SendJob.claimed.  Microseconds 
+       are dropped, since not every database keeps them, and a claim is only 
+       recognized by its exact value."""
+    return datetime.datetime.now().replace(microsecond=0)
+
+def _recipient_chunks(recipients, size, after=None):
+    """Yields the Visitors in the QuerySet recipients, in lists of at most 
+       size, ordered by primary key.  If after is given, only Visitors with 
+       a greater primary key are included.  Each list is read with its own 
+       query, so that no more than one list is held at a time."""
+    qs = recipients.order_by('pk')
+    last = after
+    while True:
+        page = qs  if last is None else  qs.filter(pk__gt=last)
+        chunk = list(page[:size])
+        if not chunk:
+            return
+        yield chunk
+        last = chunk[-1].pk
+
+# Number of rows written by each bulk UPDATE or INSERT while sending.  SQLite 
+# allows at most 999 parameters per statement.
+_BULK_BATCH_SIZE = 400
+
+def _add_recipients(obj, fieldname, visitors):
+    """Adds the given Visitors to the ManyToManyField fieldname of obj, by 
+       bulk inserting rows into its through table.  Unlike the related 
+       manager's add(), existing rows are not checked for, so none of the 
+       visitors may already be present."""
+    field = obj._meta.get_field(fieldname)
+    through = field.rel.through
+    src = field.m2m_field_name() + '_id'
+    dst = field.m2m_reverse_field_name() + '_id'
+    for start in xrange(0, len(visitors), _BULK_BATCH_SIZE):
+        through.objects.bulk_create([through(**{src: obj.pk, dst: v.pk}) 
+                        for v in visitors[start:start+_BULK_BATCH_SIZE]])
+
 class Email(models.Model):
     """Represents a *sent* email message.  This object may not be edited, 
        except to add more recipients.  Its message, subject, from-email, 
@@ -40,15 +81,15 @@ class Email(models.Model):
     
     def read_count(self):
         """Returns the number of recipients who have read this email."""
-        return self.tracker.instances_read().count()
+        return self.tracker.access_stats().read
     
     def unread_count(self):
         """Returns the number of recipients who have not read this email."""
-        return self.tracker.instances_unread().count()
+        return self.tracker.access_stats().unread
         
     def recipient_count(self):
         """Returns the number of recipients of this email."""
-        return self.tracker.instances().count()    
+        return self.tracker.access_stats().recipients
     
     def render(self, uuid, disable_pixelimages=True):
         """ Render the content but with pixelimages disabled by default.  The 
@@ -65,64 +106,22 @@ class Email(models.Model):
 
     def send(self, recipients):
         """Attempt to send the email.  This may be called on emails that have 
-           already been sent.
+           already been sent.  The sending is done by a new SendJob, which is 
+           returned.  If it is interrupted, it can be resumed (see 
+           SendJob.run()).  If any messages could not be sent, a 
+           DeliveryError listing them is raised once the others have been 
+           recorded.
         
-           recipients: A sequence of Visitor objects who will be sent this 
-                       message.
+           recipients: A QuerySet of Visitor objects who will be sent this 
+                       message.  Visitors who were already sent it are 
+                       skipped.
         """
         if not recipients or not recipients.exists():
             return
-        urlbase = app_settings.URLBASE
-        einstantiator = _email.email_instantiator(self.txtmsg, self.htmlmsg, 
-                                                  urlbase)
-        
-        # Note: msgs = list of django.core.mail.EmailMultiAlternatives
-        msgs = []
-        cx = mail.get_connection()
-        
-        # Build the emails
-        for recipient in recipients:
-            i = TrackedInstance(tracker=self.tracker, 
-                                visitor=recipient)
-            i.save()
-            text, html = einstantiator(i.uuid)
-            
-            msg = self._create_multipart_email(text, html, recipient, cx)
-            msgs.append((msg, i, recipient,))
-        
-        rs = []  # recipients to whom the email was sent
-        today = datetime.date.today()
-        
-        # Send the emails
-        cx.open()
-        try:
-            for msg, i, rec in msgs:
-                msg.send()
-                i.notified = today
-                i.save()
-                rs.append(rec)
-        finally:
-            cx.close()  # Close the connection!
-            
-            # Record the recipients
-            er = EmailRecipients(email=self, datesent=today)
-            er.save()
-            for recipient in rs:
-                er.recipients.add(recipient)
-            er.save()
-        
+        job = SendJob.create(self, recipients)
+        job.run()
+        return job
 
-    def _create_multipart_email(self, text, html, recipient, connection=None):
-        """Creates an email addressed to the given recipient and containing 
-           both the given html and text content."""
-        msg = mail.EmailMultiAlternatives(
-                                self.subject, text, self.fromemail,
-                                [recipient.emailaddress],
-                                connection=connection
-                                )
-        msg.attach_alternative(html, "text/html")
-        return msg
-            
     def htmlmsg_brief(self):
         """A brief representation of the email message.  Currently, this only 
            returns the first line."""
@@ -174,8 +173,33 @@ class DraftEmail(models.Model):
     def send(self, **kwargs):
         """Send a DraftEmail to the pending_recipients.  Once sent the first
            time, the DraftEmail may not be sent again.  Instead, use the send
-           method on Email.
+           method on Email.  The DraftEmail is marked as sent before the 
+           email is, so that it is not sent twice if some messages fail (see 
+           Email.send()).
+        """
+        email_model = self._create_email(**kwargs)
+        recipients = self.pending_recipients.all()
+        job = None
+        if recipients.exists():
+            job = SendJob.create(email_model, recipients)
+        self._mark_sent()
+        if job is not None:
+            job.run()
+        return email_model
+        
+    def enqueue(self, **kwargs):
+        """Like send(), except that nothing is sent yet.  A SendJob is created 
+           and returned, which a send worker will run (see the 
+           run_send_worker management command).
         """
+        email_model = self._create_email(**kwargs)
+        job = SendJob.create(email_model, self.pending_recipients.all(), 
+                             queued=True)
+        self._mark_sent()
+        return job
+        
+    def _create_email(self, **kwargs):
+        """Compiles and saves the Email to be sent for this DraftEmail."""
         if self.sent:
             raise EmailAlreadySentError()
         if self.pixelimage:
@@ -194,16 +218,16 @@ class DraftEmail(models.Model):
                 kwargs['text_footer'] = f.read()
         email_model = self._compile(**kwargs)
         email_model.save()
-        email_model.send(self.pending_recipients.all())
-
+        return email_model
+        
+    def _mark_sent(self):
         self.pending_recipients.clear()
         self.sent = True
         self.save()
-        return email_model
 
     def _compile(self, **kwargs):
         """Compile the DraftEmail object into an Email object.  Do not call 
-           directly, instead use send().
+           directly, instead use send() or enqueue().
         """
         if not self.subject:
             self.subject = app_settings.EMAIL_DEFAULT_SUBJECT
@@ -239,6 +263,236 @@ class EmailRecipients(models.Model):
         app_label = 'linkanalytics'
 
 
-#==============================================================================#
+class SendJob(models.Model):
+    """The sending of an Email to a set of recipients.  Progress is recorded 
+       after each chunk of recipients, so that a job which was interrupted 
+       can be resumed where it stopped.
+       
+       Recipients are handled in order of primary key.  checkpoint is the 
+       primary key of the last recipient whose chunk was completely 
+       recorded.  While a chunk's messages are being delivered, inflight is 
+       the primary key of its last recipient.
+       
+       Queued jobs are run by send workers, which take them with claim_next().  
+       claimed is the time the job was last claimed or checkpointed; if that 
+       was more than EMAIL_SEND_JOB_TIMEOUT seconds ago, the job is assumed 
+       to have been abandoned and may be claimed again.  Jobs run directly 
+       (by Email.send()) are claimed from the start, so they are only taken 
+       by a worker if the process running them stops.
+       
+       A claim is recognized by its value of claimed.  Every write to a 
+       claimed job's row is made only if claimed still holds the value the 
+       writer set or read, and renews it; a run whose write fails has lost 
+       the job to another worker, and stops.
+    """
+    email =         models.ForeignKey(Email)
+    sentrecord =    models.OneToOneField(EmailRecipients)
+    recipients =    models.ManyToManyField(Visitor)
+    total =         models.IntegerField(default=0)
+    created =       models.DateTimeField(auto_now_add=True)
+    claimed =       models.DateTimeField(null=True, blank=True)
+    finished =      models.DateTimeField(null=True, blank=True)
+    checkpoint =    models.IntegerField(default=0)
+    inflight =      models.IntegerField(default=0)
+    # Number of recipients sent the email, who could not be sent it, and 
+    # whose messages may or may not have been sent when a run was interrupted.
+    sent =          models.IntegerField(default=0)
+    failed =        models.IntegerField(default=0)
+    uncertain =     models.IntegerField(default=0)
+    
+    class Meta:
+        app_label = 'linkanalytics'
+        
+    @staticmethod
+    def create(email, recipients, queued=False):
+        """Creates and saves a SendJob sending email to the Visitors in the 
+           QuerySet recipients.  Nothing is sent until run() is called.  If 
+           queued is True, the job is left for a send worker to claim."""
+        # The job is only visible to workers once all its recipients are.
+        with transaction.commit_on_success():
+            er = EmailRecipients(email=email, datesent=datetime.date.today())
+            er.save()
+            claimed = None  if queued else  _claim_time()
+            job = SendJob(email=email, sentrecord=er, claimed=claimed)
+            job.save()
+            for chunk in _recipient_chunks(recipients, 
+                                           app_settings.EMAIL_SEND_CHUNK_SIZE):
+                _add_recipients(job, 'recipients', chunk)
+                job.total += len(chunk)
+            SendJob.objects.filter(pk=job.pk).update(total=job.total)
+        return job
+        
+    @staticmethod
+    def claim_next(pks=None):
+        """Claims the oldest unfinished SendJob which is not claimed (or 
+           whose claim has expired), and returns it.  Returns None if there 
+           is no such job.  If pks is given, only the SendJobs with those 
+           primary keys are considered.  A job is only claimed if no other 
+           worker claimed it since it was read, so that only one worker can 
+           claim it."""
+        expired = _claim_time() - datetime.timedelta(
+                                seconds=app_settings.EMAIL_SEND_JOB_TIMEOUT)
+        qs = SendJob.objects.filter(finished=None)
+        qs = qs.filter(models.Q(claimed=None) | models.Q(claimed__lt=expired))
+        if pks is not None:
+            qs = qs.filter(pk__in=pks)
+        last = 0
+        while True:
+            jobs = list(qs.filter(pk__gt=last).order_by('pk')[:10])
+            if not jobs:
+                return None
+            for job in jobs:
+                try:
+                    job._update()
+                except ClaimLost:
+                    continue
+                return job
+            last = jobs[-1].pk
+            
+    def _update(self, add=None, **values):
+        """Writes the given values, and the amounts in the dict add added to 
+           their fields, to this job's row, and renews the claim.  Raises 
+           ClaimLost, and writes nothing, if the row's claim is no longer the 
+           one this object holds."""
+        add = add or {}
+        now = _claim_time()
+        qs = SendJob.objects.filter(pk=self.pk, finished=None)
+        if self.claimed is None:
+            qs = qs.filter(claimed=None)
+        else:
+            qs = qs.filter(claimed=self.claimed)
+        updates = dict(values)
+        for name, n in add.iteritems():
+            updates[name] = models.F(name) + n
+        if not qs.update(claimed=now, **updates):
+            raise ClaimLost()
+        self.claimed = now
+        for name, value in values.iteritems():
+            setattr(self, name, value)
+        for name, n in add.iteritems():
+            setattr(self, name, getattr(self, name) + n)
+        
+    def progress(self):
+        """Returns a dict describing the progress of this job: the number of 
+           recipients sent the email, who could not be sent it, who are 
+           uncertain (see run()), and who remain, along with the total and 
+           whether the job has finished.  Recipients skipped because they 
+           were already sent the email are not counted."""
+        remaining = 0
+        if self.finished is None:
+            remaining = self.recipients.filter(pk__gt=self.checkpoint).count()
+        return { 'sent':        self.sent,
+                 'failed':      self.failed,
+                 'uncertain':   self.uncertain,
+                 'remaining':   remaining,
+                 'total':       self.total,
+                 'finished':    self.finished is not None, }
+        
+    def run(self, pool=None):
+        """Sends the email to the job's recipients, starting after the last 
+           checkpoint.  This both starts a new job and resumes an interrupted 
+           one.  The messages are sent through the given DeliveryPool, or a 
+           new one.
+           
+           Recipients who have already been sent the email are skipped.  If 
+           the previous run was interrupted while delivering a chunk, that 
+           chunk's unrecorded recipients may or may not have been sent the 
+           email.  They are skipped too (and counted as uncertain), so that no 
+           one is sent the email twice.
+           
+           The run holds the claim this object was created or claimed with 
+           (see claim_next()).  If another worker claims the job meanwhile, 
+           ClaimLost is raised before any more messages are sent.
+           
+           Raises a DeliveryError listing the recipients of this run who 
+           could not be sent the email.
+        """
+        if self.finished is not None:
+            return
+        self._update()
+        if self.inflight > self.checkpoint:
+            self._skip_interrupted()
+            
+        if pool is None:
+            pool = delivery.DeliveryPool()
+        renderer = rendering.create_renderer(self.email)
+        failures = []
+        try:
+            for chunk in _recipient_chunks(self.recipients.all(), 
+                                           app_settings.EMAIL_SEND_CHUNK_SIZE,
+                                           after=self.checkpoint):
+                failures.extend(self._send_chunk(chunk, renderer, pool))
+        finally:
+            renderer.close()
+            
+        self._update(finished=datetime.datetime.now())
+        if failures:
+            raise delivery.DeliveryError(failures)
+            
+    def _pending_instances(self, **kwargs):
+        """Returns a QuerySet of the TrackedInstances of this job's 
+           recipients which have not been sent the email, filtered with the 
+           given keyword arguments."""
+        return TrackedInstance.objects.filter(tracker=self.email.tracker_id, 
+                                              visitor__sendjob=self,
+                                              notified=None, **kwargs)
+        
+    def _skip_interrupted(self):
+        """Skips the chunk whose delivery was interrupted."""
+        qs = self._pending_instances(visitor__pk__gt=self.checkpoint, 
+                                     visitor__pk__lte=self.inflight)
+        self._update(checkpoint=self.inflight, add={'uncertain': qs.count()})
+            
+    def _send_chunk(self, recipients, renderer, pool):
+        """Sends the email to a list of recipients, and records the result.  
+           Returns a list of (recipient, exception) pairs for those it could 
+           not be sent to."""
+        first, last = recipients[0].pk, recipients[-1].pk
+        
+        # Build the emails.  Recipients who have an instance but were not 
+        # sent the email (because an earlier run stopped before delivering 
+        # it, or delivery failed) are sent it now.
+        self.email.tracker.add_visitors(recipients)
+        instances = list(self._pending_instances(visitor__pk__gte=first, 
+                                                 visitor__pk__lte=last)
+                            .select_related('visitor').order_by('pk'))
+        for i in instances:
+            instancecache.prime(i)
+        msgs = renderer.render(instances)
+        
+        # Send the emails, unless another worker has taken the job.
+        self._update(inflight=last)
+        errors = pool.deliver(msgs)
+        
+        # Record the results, all at once.
+        sent = []
+        failures = []
+        for i, error in zip(instances, errors):
+            if error is None:
+                sent.append(i)
+            else:
+                failures.append((i.visitor, error))
+        # The messages were sent whether or not the job is still claimed, so 
+        # they are recorded and counted either way.  Only the checkpoint is 
+        # left to the worker which took it.
+        er = self.sentrecord
+        lost = False
+        with transaction.commit_on_success():
+            for start in xrange(0, len(sent), _BULK_BATCH_SIZE):
+                pks = [i.pk for i in sent[start:start+_BULK_BATCH_SIZE]]
+                TrackedInstance.objects.filter(pk__in=pks).update(
+                                                    notified=er.datesent)
+            _add_recipients(er, 'recipients', [i.visitor for i in sent])
+            counts = {'sent': len(sent), 'failed': len(failures)}
+            try:
+                self._update(checkpoint=last, add=counts)
+            except ClaimLost:
+                lost = True
+                SendJob.objects.filter(pk=self.pk).update(**dict(
+                    (name, models.F(name) + n) for name, n in counts.items()))
+        if lost:
+            raise ClaimLost()
+        return failures
 
 
+#==============================================================================#
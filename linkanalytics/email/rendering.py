@@ -0,0 +1,245 @@
+"""
+    Creation of the messages of an Email for each of its recipients.
+
+    The messages of an Email differ only in their To, Message-ID and Date
+    headers and in their tracked URLs.  A MessageTemplate MIME-encodes the
+    message once, with placeholders in those places, and splits the encoded
+    message at the placeholders.  Each recipient's message is then made by
+    joining the encoded segments with that recipient's values, so that
+    nothing is encoded per recipient.  Messages whose templates cannot be
+    split (see _email.segmented_email_instantiator()), or whose address
+    would be encoded or folded rather than copied into the To header, are
+    encoded in full instead.
+
+    Rendering a large number of messages still keeps a processor busy, and
+    in one process only one thread at a time can do it.  A RenderPool spreads
+    the work over several worker processes instead.  The workers are sent the
+    Email's compiled templates once per chunk, along with the uuid and
+    address of each recipient, and return each message already encoded,
+    along with its text and html content.  They do not use the database.
+
+    The messages are sent from the main process as PreparedMessages, which
+    hand their encoded form to the email backend as it is.  Their body and
+    alternatives still hold the text and html, for backends and code which
+    read those rather than calling message().
+"""
+
+import multiprocessing
+import re
+
+from django.core import mail
+from django.core.mail.message import make_msgid, formatdate
+
+from linkanalytics.email import _email
+from linkanalytics import app_settings
+
+#==============================================================================#
+class _EncodedMIME(object):
+    """Stands in for the email.Message of a PreparedMessage."""
+    def __init__(self, data):
+        self.data = data
+    def as_string(self, unixfrom=False):
+        return self.data
+    def __str__(self):
+        return self.data
+
+
+class PreparedMessage(mail.EmailMultiAlternatives):
+    """An EmailMultiAlternatives whose MIME encoding, data (a str), was done
+       beforehand.  message() returns that encoding, so body and
+       alternatives should not be changed afterwards."""
+    def __init__(self, subject, body, from_email, to, data, alternatives=None,
+                 connection=None):
+        super(PreparedMessage, self).__init__(subject, body, from_email, to,
+                                              alternatives=alternatives,
+                                              connection=connection)
+        self.data = data
+
+    def message(self):
+        return _EncodedMIME(self.data)
+
+
+#==============================================================================#
+# Addresses containing any of these are encoded, or may be folded, by the
+# email package, so they are not copied into a MessageTemplate as they are.
+_re_unsafe_address = re.compile(r'[^\x21-\x7e]|[,;]')
+
+class MessageTemplate(object):
+    """The encoded message of an Email, from which the message for each
+       recipient is made."""
+    def __init__(self, subject, fromemail, txtmsg, htmlmsg, urlbase):
+        self.subject = subject
+        self.fromemail = fromemail
+        self.einstantiator = _email.segmented_email_instantiator(
+                                            txtmsg, htmlmsg, urlbase)
+        self.parts = None
+        if isinstance(self.einstantiator, _email.SegmentedInstantiator):
+            self.parts = self._split()
+
+    def _split(self):
+        """Encodes the message with placeholders, and splits it into encoded
+           segments alternating with slot numbers and header names.  Returns
+           None if the placeholders did not come through encoding intact."""
+        inst = self.einstantiator
+        slots = inst.slots
+        markers = [slots.marker(n) for n in xrange(len(slots.slots))]
+        text = _email._assemble(inst.textparts, markers)
+        html = _email._assemble(inst.htmlparts, markers)
+        placeholder = 'linkanalytics{0}{{0}}'.format(slots.token)
+        msg = _email.multipart_email(self.subject, self.fromemail, text, html,
+                                     placeholder.format('to'))
+        msg.extra_headers = { 'Message-ID': placeholder.format('msgid'),
+                              'Date': placeholder.format('date') }
+        data = msg.message().as_string()
+
+        pattern = re.compile(r'\x00{0}:(\d+)\x00|'
+                             r'linkanalytics{0}(to|msgid|date)'.format(
+                                                                slots.token))
+        pieces = pattern.split(data)
+        parts = [pieces[0]]
+        for i in xrange(1, len(pieces), 3):
+            slot, header, segment = pieces[i:i+3]
+            parts.append(int(slot)  if slot is not None else  header)
+            parts.append(segment)
+
+        # Each placeholder must have come through once for each time it was
+        # given, and nothing else of them may remain.
+        keys = parts[1::2]
+        headers = sorted(k for k in keys if not isinstance(k, int))
+        nslots = len(inst.textparts[1::2]) + len(inst.htmlparts[1::2])
+        if headers != ['date', 'msgid', 'to'] or len(keys) - 3 != nslots:
+            return None
+        for segment in parts[0::2]:
+            if '\x00' in segment or slots.token in segment:
+                return None
+        return parts
+
+    def render(self, uuid, address):
+        """Returns the encoded message to address, with the tracked URLs for
+           the given uuid."""
+        return self.render_content(uuid, address)[2]
+
+    def render_content(self, uuid, address):
+        """Returns the text and html content of the message to address, with
+           the tracked URLs for the given uuid, and the encoded message, as a
+           (text, html, data) tuple."""
+        urls = encoded = None
+        if self.parts is not None and not _re_unsafe_address.search(address):
+            urls = self.einstantiator.slots.urls(uuid)
+            try:
+                encoded = [url.encode('ascii') for url in urls]
+            except UnicodeError:
+                encoded = None
+        if encoded is None:
+            text, html = self.einstantiator(uuid)
+            msg = _email.multipart_email(self.subject, self.fromemail, text,
+                                         html, address)
+            return text, html, msg.message().as_string()
+
+        inst = self.einstantiator
+        text = _email._assemble(inst.textparts, urls)
+        html = _email._assemble(inst.htmlparts, urls)
+        headers = { 'to': str(address), 'msgid': make_msgid(),
+                    'date': formatdate() }
+        pieces = list(self.parts)
+        for i in xrange(1, len(pieces), 2):
+            key = pieces[i]
+            if isinstance(key, int):
+                pieces[i] = encoded[key]
+            else:
+                pieces[i] = headers[key]
+        return text, html, ''.join(pieces)
+
+    def message(self, uuid, address):
+        """Returns a PreparedMessage to address, with the tracked URLs for the
+           given uuid."""
+        text, html, data = self.render_content(uuid, address)
+        return _prepared_message(self.subject, self.fromemail, address,
+                                 text, html, data)
+
+
+def _prepared_message(subject, fromemail, address, text, html, data):
+    """Returns a PreparedMessage with the same content as 
+       _email.multipart_email() would give it."""
+    return PreparedMessage(subject, text, fromemail, [address], data,
+                           alternatives=[(html, 'text/html')])
+
+
+def _template_args(email):
+    """Returns the arguments of the MessageTemplate for email."""
+    return (email.subject, email.fromemail, email.txtmsg, email.htmlmsg,
+            app_settings.URLBASE)
+
+#==============================================================================#
+class Renderer(object):
+    """Creates the messages of an Email in this process."""
+    def __init__(self, email):
+        self.template = MessageTemplate(*_template_args(email))
+
+    def render(self, instances):
+        """Returns a message for each of the given TrackedInstances (with
+           their visitors), in the same order."""
+        return [self.template.message(i.uuid, i.visitor.emailaddress)
+                for i in instances]
+
+    def close(self):
+        pass
+
+
+# The MessageTemplate of the Email last rendered by a worker process, with
+# the arguments it was created from.
+_worker_job = None
+_worker_template = None
+
+def _render_messages(args):
+    """Runs in a worker process.  Returns the (text, html, data) tuple of
+       the message for each (uuid, address) pair of args."""
+    global _worker_job, _worker_template
+    job, pairs = args
+    if job != _worker_job:
+        _worker_template = MessageTemplate(*job)
+        _worker_job = job
+    return [_worker_template.render_content(uuid, address)
+            for uuid, address in pairs]
+
+
+class RenderPool(object):
+    """Creates the messages of an Email in a pool of worker processes.  Call
+       close() once done with it."""
+    def __init__(self, email, processes):
+        self.email = email
+        self.processes = processes
+        self._job = _template_args(email)
+        self._pool = multiprocessing.Pool(processes)
+
+    def render(self, instances):
+        """Returns a message for each of the given TrackedInstances (with
+           their visitors), in the same order."""
+        pairs = [(i.uuid, i.visitor.emailaddress) for i in instances]
+        size = max(1, -(-len(pairs) // self.processes))
+        tasks = [(self._job, pairs[k:k+size])
+                 for k in xrange(0, len(pairs), size)]
+        msgs = []
+        for task, results in zip(tasks,
+                                 self._pool.map(_render_messages, tasks)):
+            for (uuid, address), (text, html, data) in zip(task[1], results):
+                msgs.append(_prepared_message(self.email.subject,
+                                              self.email.fromemail, address,
+                                              text, html, data))
+        return msgs
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+def create_renderer(email):
+    """Returns a RenderPool for email if the EMAIL_RENDER_PROCESSES setting
+       is more than 0, or else a Renderer."""
+    processes = app_settings.EMAIL_RENDER_PROCESSES
+    if processes > 0:
+        return RenderPool(email, processes)
+    return Renderer(email)
+
+
+#==============================================================================#
@@ -0,0 +1,214 @@
+"""
+    Ordering and pacing of email deliveries by recipient domain.
+
+    Mail providers throttle senders who deliver many messages to their
+    domain at once.  A DeliveryScheduler hands out the messages of a
+    DeliveryPool one domain after another (round robin), and holds back a
+    domain's messages while it is over its limits: a token bucket rate, and
+    a cap on the number of messages being sent to it at the same time.  It
+    also counts the messages sent to each domain, and how long that took.
+
+    The limits are given by the EMAIL_DOMAIN_LIMITS setting, a dict mapping
+    domains to dicts with any of the keys 'rate' (messages per second),
+    'burst' (messages which may be sent at once before the rate applies) and
+    'concurrency'.  The limits under the key '*' apply to all other domains.
+    A missing or None limit means no limit.  Rates must be positive, and 
+    bursts and concurrencies at least 1.
+
+    Messages are scheduled within each call to DeliveryPool.deliver(), which 
+    SendJob makes once per chunk of recipients.  The limits and counts carry 
+    over from one chunk to the next, but a chunk is only done once all of 
+    its messages are, so a slow domain holds back the domains after it until 
+    its messages in the chunk are sent.
+"""
+
+import collections
+import threading
+import time
+
+from linkanalytics import app_settings
+
+# Fractions of a token smaller than this are ignored, so that rounding errors 
+# in refilling do not leave a bucket forever just short of a token.
+_EPSILON = 1e-9
+
+#==============================================================================#
+class TokenBucket(object):
+    """Allows rate events per second on average, and up to burst at once.
+       clock is a function returning the current time in seconds."""
+    def __init__(self, rate, burst=1, clock=time.time):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.clock = clock
+        self.tokens = float(self.burst)
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """Takes a token if one is available.  Returns True if one was
+           taken; False otherwise."""
+        self._refill()
+        if self.tokens < 1 - _EPSILON:
+            return False
+        self.tokens = max(0.0, self.tokens - 1)
+        return True
+
+    def wait_time(self):
+        """Returns the number of seconds until a token is available."""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+def message_domain(msg):
+    """Returns the (lowercase) domain of a message's first recipient."""
+    return msg.to[0].rpartition('@')[2].lower()  if msg.to else  ''
+
+
+def _check_limits(limits):
+    """Raises a ValueError if any of the given limits (as the 
+       EMAIL_DOMAIN_LIMITS setting) could never let a message be sent."""
+    for name, lim in limits.iteritems():
+        for key in ('rate', 'burst', 'concurrency'):
+            value = lim.get(key)
+            if value is None:
+                continue
+            if (value <= 0  if key == 'rate' else  value < 1):
+                raise ValueError('Invalid {0} limit for domain {1!r}: '
+                                 '{2!r}'.format(key, name, value))
+
+
+#==============================================================================#
+class _Domain(object):
+    """The pending messages, limits and counts of one domain."""
+    def __init__(self, limits, clock):
+        self.pending = collections.deque()
+        rate = limits.get('rate')
+        self.bucket = None
+        if rate is not None:
+            self.bucket = TokenBucket(rate, limits.get('burst') or 1, clock)
+        self.concurrency = limits.get('concurrency')
+        self.active = 0
+        self.sent = 0
+        self.failed = 0
+        self.started = None
+        self.finished = None
+
+    def is_open(self):
+        """Returns True if the domain's concurrency limit allows another 
+           message to be sent now."""
+        return self.concurrency is None or self.active < self.concurrency
+
+
+class DeliveryScheduler(object):
+    """Decides the order in which a DeliveryPool's workers send messages.
+       It may be shared by any number of worker threads.
+
+       limits: as the EMAIL_DOMAIN_LIMITS setting, which is the default.
+       clock: a function returning the current time in seconds.
+       sleep: a function which waits for the given number of seconds.
+    """
+    def __init__(self, limits=None, clock=time.time, sleep=time.sleep):
+        if limits is None:
+            limits = app_settings.EMAIL_DOMAIN_LIMITS
+        _check_limits(limits)
+        self.limits = limits
+        self.clock = clock
+        self.sleep = sleep
+        self._cond = threading.Condition()
+        self._domains = {}
+        self._order = []
+        self._next = 0
+        self._tasks = {}
+
+    def _domain(self, name):
+        d = self._domains.get(name)
+        if d is None:
+            limits = self.limits.get(name, self.limits.get('*', {}))
+            d = self._domains[name] = _Domain(limits, self.clock)
+        return d
+
+    def start(self, messages):
+        """Schedules the given list of messages.  Their tasks are (index,
+           message) pairs.  Limits and counts carry over from earlier
+           messages."""
+        with self._cond:
+            self._order = []
+            self._next = 0
+            for n, msg in enumerate(messages):
+                name = message_domain(msg)
+                d = self._domain(name)
+                if not d.pending:
+                    self._order.append(name)
+                d.pending.append((n, msg))
+                self._tasks[n] = name
+
+    def next(self):
+        """Returns the next task to send, waiting until one may be sent.
+           Returns None once every message has been handed out."""
+        with self._cond:
+            while True:
+                if not any(self._domains[name].pending
+                           for name in self._order):
+                    return None
+                wait = None
+                # Start after the domain last handed out.
+                k = self._next % len(self._order)
+                for name in self._order[k:] + self._order[:k]:
+                    d = self._domains[name]
+                    if not d.pending or not d.is_open():
+                        continue
+                    if d.bucket is not None and not d.bucket.take():
+                        w = d.bucket.wait_time()
+                        wait = w  if wait is None else  min(wait, w)
+                        continue
+                    self._next = self._order.index(name) + 1
+                    d.active += 1
+                    if d.started is None:
+                        d.started = self.clock()
+                    return d.pending.popleft()
+                if wait is None:
+                    # Every domain is at its concurrency limit.
+                    self._cond.wait()
+                else:
+                    self._cond.release()
+                    try:
+                        self.sleep(wait)
+                    finally:
+                        self._cond.acquire()
+
+    def done(self, n, error):
+        """Records that the message of task n was sent (if error is None) or
+           could not be sent."""
+        with self._cond:
+            d = self._domains[self._tasks.pop(n)]
+            d.active -= 1
+            if error is None:
+                d.sent += 1
+            else:
+                d.failed += 1
+            d.finished = self.clock()
+            self._cond.notify_all()
+
+    def stats(self):
+        """Returns a dict mapping each domain to a dict of the number of
+           messages sent and failed, the seconds from the first being handed
+           out to the last being done, and the messages sent per second
+           (None if no time passed)."""
+        with self._cond:
+            stats = {}
+            for name, d in self._domains.iteritems():
+                seconds = 0.0
+                if d.started is not None and d.finished is not None:
+                    seconds = d.finished - d.started
+                rate = d.sent / seconds  if seconds > 0 else  None
+                stats[name] = { 'sent': d.sent, 'failed': d.failed,
+                                'seconds': seconds, 'rate': rate }
+            return stats
+
+
+#==============================================================================#
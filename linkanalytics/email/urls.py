@@ -37,6 +37,8 @@ urlpatterns = patterns('linkanalytics.email',
                     {}, 'linkanalytics-email-viewrecipients'),
     (r'^(?P<emailid>\d+)/content/$', 'views.viewSentEmailContent', 
                     {}, 'linkanalytics-email-viewsentcontent'),
+    (r'^(?P<emailid>\d+)/progress/$', 'views.viewSendProgress', 
+                    {}, 'linkanalytics-email-sendprogress'),
                     
     # Target views...
     (r'^render/$', 'targetviews.targetview_renderemail', 
@@ -1,3 +1,5 @@
+import json
+
 from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.shortcuts import render_to_response
 from django.template import RequestContext
@@ -5,7 +7,7 @@ from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse as urlreverse
 
 from linkanalytics.models import Visitor, resolve_emails
-from linkanalytics.email.models import Email, DraftEmail
+from linkanalytics.email.models import Email, DraftEmail, SendJob
 from linkanalytics.email.forms import ComposeEmailForm, CreateContactForm
 
 #==============================================================================#
@@ -65,7 +67,8 @@ def composeEmail(request, emailid=None):
                                  kwargs={'emailid':draft.pk})
                 return HttpResponseRedirect(url)
             elif 'do_send' in request.POST:
-                draft.send()
+                # The email is sent by a send worker, not while responding.
+                draft.enqueue()
                 url = urlreverse('linkanalytics-email-idcompose',
                                  kwargs={'emailid':draft.pk})
                 return HttpResponseRedirect(url)
@@ -85,9 +88,20 @@ def composeEmail(request, emailid=None):
 def viewSentEmails(request):
     """The view which displays a list of all sent emails."""
     return _email_render_to_response('linkanalytics/email/sent.html',
-                             {'emails': Email.objects.all() },
+                             {'emails': Email.objects.select_related(
+                                                'tracker__stats') },
                               context_instance=RequestContext(request))
 
+@login_required
+def viewSendProgress(request, emailid):
+    """Returns the progress of the most recent SendJob of an email, as JSON.  
+       See SendJob.progress()."""
+    jobs = SendJob.objects.filter(email=emailid).order_by('-pk')[:1]
+    if not jobs:
+        raise Http404
+    return HttpResponse(json.dumps(jobs[0].progress()), 
+                        mimetype='application/json')
+
 @login_required
 def viewDraftEmails(request):
     """The view which displays a list of all unsent draft emails."""
@@ -150,7 +164,8 @@ class EmailReadIter(object):
     def __init__(self, email):
         self.tracker = email.tracker
     def __iter__(self):
-        for instance in self.tracker.instances_read():
+        qs = self.tracker.instances_read().select_related('summary', 'visitor')
+        for instance in qs:
             yield { 'instance': instance,
                     'visitor': instance.visitor,
                   }
@@ -174,7 +189,8 @@ class EmailUnreadIter(object):
     def __init__(self, email):
         self.tracker = email.tracker
     def __iter__(self):
-        for instance in self.tracker.instances_unread():
+        qs = self.tracker.instances_unread().select_related('summary', 'visitor')
+        for instance in qs:
             yield { 'instance': instance,
                     'visitor': instance.visitor,
                   }
@@ -198,7 +214,8 @@ class EmailRecipientIter(object):
     def __init__(self, email):
         self.tracker = email.tracker
     def __iter__(self):
-        for instance in self.tracker.instances():
+        qs = self.tracker.instances().select_related('summary', 'visitor')
+        for instance in qs:
             yield { 'instance': instance,
                     'visitor': instance.visitor,
                   }
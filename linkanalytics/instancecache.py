@@ -0,0 +1,99 @@
+"""
+    A per-process cache mapping uuids to the TrackedInstance data needed when
+    a tracked URL is accessed.
+"""
+
+from collections import namedtuple
+
+from django.db.models import signals
+
+from linkanalytics.models import TrackedInstance
+from linkanalytics.util.lrucache import LRUCache
+from linkanalytics import app_settings
+
+#==============================================================================#
+# Tracking a URL only requires a TrackedInstance's primary key and uuid (and
+# occasionally its Tracker), so that is all that is kept, and the full row is
+# never loaded.  Entries are added when first looked up and when
+# instances are created while sending emails.  Saving a TrackedInstance
+# refreshes its entry and deleting one removes it.  Entries also expire after
+# INSTANCE_CACHE_TTL seconds, which bounds how long other processes may use
+# stale data.
+
+InstanceRef = namedtuple('InstanceRef', 'pk uuid tracker_id')
+
+_cache = LRUCache(app_settings.INSTANCE_CACHE_SIZE,
+                  app_settings.INSTANCE_CACHE_TTL)
+
+# values_list() returns uuids as stored in the database (see UuidField).
+_uuid_to_python = TrackedInstance._meta.get_field('uuid').to_python
+
+def _ref(row):
+    pk, uuid, tracker_id = row
+    return InstanceRef(pk, _uuid_to_python(uuid), tracker_id)
+
+def lookup(uuid):
+    """Returns the InstanceRef for the TrackedInstance with the given uuid, or
+       None if there is no such TrackedInstance."""
+    ref = _cache.get(uuid)
+    if ref is None:
+        qs = TrackedInstance.objects.filter(uuid=uuid)
+        rows = list(qs.values_list('pk', 'uuid', 'tracker_id')[:1])
+        if not rows:
+            return None
+        ref = _ref(rows[0])
+        _cache.set(uuid, ref)
+    return ref
+
+def lookup_many(uuids):
+    """Returns a dict mapping each of the given uuids to the InstanceRef of 
+       its TrackedInstance.  uuids without a TrackedInstance are left out.  
+       Uncached uuids are looked up with a single query."""
+    refs = {}
+    missing = []
+    for uuid in uuids:
+        ref = _cache.get(uuid)
+        if ref is None:
+            missing.append(uuid)
+        else:
+            refs[uuid] = ref
+    if missing:
+        qs = TrackedInstance.objects.filter(uuid__in=missing)
+        for row in qs.values_list('pk', 'uuid', 'tracker_id'):
+            ref = _ref(row)
+            _cache.set(ref.uuid, ref)
+            refs[ref.uuid] = ref
+    return refs
+
+def get_cached(uuid):
+    """Returns the cached InstanceRef for the given uuid, or None if it is not 
+       cached.  The database is never queried."""
+    return _cache.get(uuid)
+
+def prime(instance):
+    """Add the given (saved) TrackedInstance to the cache."""
+    _cache.set(instance.uuid,
+               InstanceRef(instance.pk, instance.uuid, instance.tracker_id))
+
+def invalidate(uuid):
+    """Remove any entry for the given uuid."""
+    _cache.delete(uuid)
+
+def clear():
+    """Remove all entries."""
+    _cache.clear()
+
+#==============================================================================#
+def _on_instance_saved(sender, instance, **kwargs):
+    if _cache.get(instance.uuid) is not None:
+        prime(instance)
+
+def _on_instance_deleted(sender, instance, **kwargs):
+    invalidate(instance.uuid)
+
+signals.post_save.connect(_on_instance_saved, sender=TrackedInstance,
+                          dispatch_uid='linkanalytics.instancecache.save')
+signals.post_delete.connect(_on_instance_deleted, sender=TrackedInstance,
+                            dispatch_uid='linkanalytics.instancecache.delete')
+
+#==============================================================================#
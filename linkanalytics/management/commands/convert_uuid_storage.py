@@ -0,0 +1,97 @@
+"""
+    Convert the stored TrackedInstance uuids between the 'char' and 'binary'
+    storage formats (see the UUID_STORAGE setting).
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+from linkanalytics.models import TrackedInstance
+
+_STORAGES = ('char', 'binary')
+
+connection = connections[DEFAULT_DB_ALIAS]
+
+class Command(BaseCommand):
+    args = '<char|binary>'
+    help = ('Converts the uuid column of TrackedInstances to the given '
+            'storage, and its values along with it.  Run this before changing '
+            'LINKANALYTICS_UUID_STORAGE on an existing database.  On SQLite '
+            'only the values are converted; the column type is left alone.')
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in _STORAGES:
+            raise CommandError('Expected one argument: char or binary.')
+        storage = args[0]
+        convert = getattr(self, 'convert_' + connection.vendor, None)
+        if convert is None:
+            raise CommandError('Converting uuids is not supported on {0} '
+                               'databases.'.format(connection.vendor))
+
+        qn = connection.ops.quote_name
+        opts = TrackedInstance._meta
+        table = qn(opts.db_table)
+        column = qn(opts.get_field('uuid').column)
+        with transaction.commit_on_success():
+            n = convert(connection.cursor(), table, column, storage)
+        self.stdout.write('Converted {0} uuids to {1} storage.\n'.format(n,
+                                                                    storage))
+
+    def column_type(self, cursor, current_schema):
+        """Returns the data type of the uuid column, from the
+           information_schema.  If current_schema is True, only the current
+           database (MySQL's schema) is searched."""
+        sql = ('SELECT data_type FROM information_schema.columns '
+               'WHERE table_name = %s AND column_name = %s')
+        params = [TrackedInstance._meta.db_table,
+                  TrackedInstance._meta.get_field('uuid').column]
+        if current_schema:
+            sql += ' AND table_schema = DATABASE()'
+        cursor.execute(sql, params)
+        return cursor.fetchone()[0].lower()
+
+    def count(self, cursor, table):
+        cursor.execute('SELECT COUNT(*) FROM {0}'.format(table))
+        return cursor.fetchone()[0]
+
+    def convert_sqlite(self, cursor, table, column, storage):
+        # SQLite keeps values as given whatever the declared column type, so
+        # only the values need rewriting.
+        field = TrackedInstance._meta.get_field('uuid')
+        pk = connection.ops.quote_name(TrackedInstance._meta.pk.column)
+        cursor.execute('SELECT {0}, {1} FROM {2}'.format(pk, column, table))
+        rows = [(field.encode(field.to_python(uuid), connection, storage), id)
+                for id, uuid in cursor.fetchall()]
+        cursor.executemany('UPDATE {0} SET {1} = %s WHERE {2} = %s'.format(
+                                table, column, pk), rows)
+        return len(rows)
+
+    def convert_postgresql(self, cursor, table, column, storage):
+        is_binary = self.column_type(cursor, False) == 'uuid'
+        if is_binary == (storage == 'binary'):
+            return 0
+        if storage == 'binary':
+            sql = 'ALTER TABLE {0} ALTER COLUMN {1} TYPE uuid USING {1}::uuid'
+        else:
+            sql = ('ALTER TABLE {0} ALTER COLUMN {1} TYPE varchar(32) '
+                   "USING replace({1}::text, '-', '')")
+        cursor.execute(sql.format(table, column))
+        return self.count(cursor, table)
+
+    def convert_mysql(self, cursor, table, column, storage):
+        is_binary = self.column_type(cursor, True) == 'binary'
+        if is_binary == (storage == 'binary'):
+            return 0
+        # Neither representation fits the other's column, so pass through a
+        # VARBINARY column long enough for both.
+        modify = 'ALTER TABLE {0} MODIFY {1} {2} NOT NULL'
+        cursor.execute(modify.format(table, column, 'varbinary(32)'))
+        if storage == 'binary':
+            cursor.execute('UPDATE {0} SET {1} = UNHEX({1})'.format(table,
+                                                                    column))
+            cursor.execute(modify.format(table, column, 'binary(16)'))
+        else:
+            cursor.execute('UPDATE {0} SET {1} = LOWER(HEX({1}))'.format(table,
+                                                                    column))
+            cursor.execute(modify.format(table, column, 'varchar(32)'))
+        return self.count(cursor, table)
+
@@ -0,0 +1,17 @@
+"""
+    Recompute AccessHistograms from the Access table.
+"""
+from django.core.management.base import BaseCommand
+
+from linkanalytics.models import AccessHistogram
+
+class Command(BaseCommand):
+    args = '[tracker_id ...]'
+    help = ('Recomputes the hourly and daily AccessHistograms of each '
+            'Tracker from its Accesses.  If Tracker ids are given, only '
+            'those histograms are rebuilt.')
+
+    def handle(self, *args, **options):
+        tracker_ids = [int(a) for a in args]  if args else  None
+        n = AccessHistogram.rebuild(tracker_ids)
+        self.stdout.write('Wrote {0} histogram rows.\n'.format(n))
@@ -0,0 +1,25 @@
+"""
+    Recompute AccessSummaries from the Access table.
+"""
+from django.core.management.base import BaseCommand
+
+from linkanalytics.models import AccessSummary, TrackerStats, TrackedInstance
+
+class Command(BaseCommand):
+    args = '[instance_id ...]'
+    help = ('Recomputes the AccessSummary of each TrackedInstance from its '
+            'Accesses.  If TrackedInstance ids are given, only those '
+            'summaries are rebuilt.  The TrackerStats of the affected '
+            'Trackers are then reconciled.')
+
+    def handle(self, *args, **options):
+        instance_ids = [int(a) for a in args]  if args else  None
+        n = AccessSummary.rebuild(instance_ids)
+        self.stdout.write('Rebuilt {0} access summaries.\n'.format(n))
+        
+        tracker_ids = None
+        if instance_ids is not None:
+            qs = TrackedInstance.objects.filter(pk__in=instance_ids)
+            tracker_ids = set(qs.values_list('tracker', flat=True))
+        n = TrackerStats.reconcile(tracker_ids)
+        self.stdout.write('Corrected {0} tracker stats.\n'.format(n))
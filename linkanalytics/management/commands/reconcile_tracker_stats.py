@@ -0,0 +1,18 @@
+"""
+    Recompute TrackerStats and correct any which are out of date.
+"""
+from django.core.management.base import BaseCommand
+
+from linkanalytics.models import TrackerStats
+
+class Command(BaseCommand):
+    args = '[tracker_id ...]'
+    help = ('Recomputes the TrackerStats of each Tracker from its '
+            'TrackedInstances and their AccessSummaries, and corrects any '
+            'which differ.  If Tracker ids are given, only those are '
+            'reconciled.')
+
+    def handle(self, *args, **options):
+        tracker_ids = [int(a) for a in args]  if args else  None
+        n = TrackerStats.reconcile(tracker_ids)
+        self.stdout.write('Corrected {0} tracker stats.\n'.format(n))
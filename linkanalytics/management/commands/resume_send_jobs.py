@@ -0,0 +1,32 @@
+"""
+    Resume email SendJobs which did not finish.
+"""
+from django.core.management.base import BaseCommand
+
+from linkanalytics.email.models import SendJob, ClaimLost
+from linkanalytics.email.delivery import DeliveryError
+
+class Command(BaseCommand):
+    args = '[sendjob_id ...]'
+    help = ('Resumes each unfinished SendJob from its last checkpoint.  If '
+            'SendJob ids are given, only those are resumed.  Jobs claimed by '
+            'a running worker (or send) are left alone, unless their claim '
+            'has expired.')
+
+    def handle(self, *args, **options):
+        pks = [int(a) for a in args]  if args else  None
+        while True:
+            job = SendJob.claim_next(pks)
+            if job is None:
+                return
+            try:
+                job.run()
+            except DeliveryError as e:
+                self.stdout.write('SendJob {0}: {1}.\n'.format(job.pk, e))
+            except ClaimLost:
+                self.stdout.write('SendJob {0}: claimed by another '
+                                  'worker.\n'.format(job.pk))
+                continue
+            self.stdout.write('SendJob {0}: sent {1}, failed {2}, '
+                              'uncertain {3}.\n'.format(job.pk, job.sent,
+                                                job.failed, job.uncertain))
@@ -0,0 +1,51 @@
+"""
+    Run queued email SendJobs.
+"""
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from linkanalytics.email.models import SendJob, ClaimLost
+from linkanalytics.email.delivery import DeliveryPool, DeliveryError
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Exit once no jobs are waiting.'),
+        make_option('--poll', type='float', dest='poll', default=5.0,
+                    help='Seconds to wait before looking for new jobs.'),
+    )
+    help = ('Claims and runs queued SendJobs, one at a time, and waits for '
+            'more.  Several workers may run at once.  Jobs abandoned by '
+            'another worker are resumed from their last checkpoint.')
+
+    def handle(self, *args, **options):
+        while True:
+            job = SendJob.claim_next()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['poll'])
+                continue
+            pool = DeliveryPool()
+            try:
+                job.run(pool)
+            except DeliveryError as e:
+                self.stdout.write('SendJob {0}: {1}.\n'.format(job.pk, e))
+            except ClaimLost:
+                self.stdout.write('SendJob {0}: claimed by another '
+                                  'worker.\n'.format(job.pk))
+                continue
+            self.stdout.write('SendJob {0}: sent {1}, failed {2}, '
+                              'uncertain {3}.\n'.format(job.pk, job.sent,
+                                                job.failed, job.uncertain))
+            stats = pool.scheduler.stats()
+            for domain in sorted(stats):
+                d = stats[domain]
+                rate = '-'
+                if d['rate'] is not None:
+                    rate = '{0:.1f}'.format(d['rate'])
+                self.stdout.write('    {0}: sent {1}, failed {2}, {3} per '
+                                  'second.\n'.format(domain, d['sent'],
+                                                     d['failed'], rate))
@@ -1,9 +1,12 @@
 import uuid
+import binascii
 import datetime
 import itertools
 import re
+import sys
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import signals
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.core.urlresolvers import reverse as urlreverse
@@ -139,6 +142,78 @@ def _create_uuid():
     """Returns a 32-character string containing a randomly-generated UUID."""
     return uuid.uuid4().hex
 
+
+#==============================================================================#
+# Column types used for uuids when UUID_STORAGE is 'binary'.  Other databases 
+# get a BINARY(16) column.
+_BINARY_UUID_TYPES = {
+    'postgresql':   'uuid',
+    'mysql':        'binary(16)',
+    'oracle':       'raw(16)',
+    'sqlite':       'blob',
+}
+
+class UuidField(models.Field):
+    """A field holding a UUID.  In Python the value is always a 32-character 
+       hexadecimal string.  In the database it is stored as selected by the 
+       UUID_STORAGE setting: either that same string, or the 16 raw bytes (a 
+       native uuid column on PostgreSQL)."""
+    __metaclass__ = models.SubfieldBase
+    
+    def __init__(self, *args, **kwargs):
+        kwargs['max_length'] = 32
+        super(UuidField, self).__init__(*args, **kwargs)
+        
+    def db_type(self, connection):
+        if app_settings.UUID_STORAGE == 'binary':
+            return _BINARY_UUID_TYPES.get(connection.vendor, 'binary(16)')
+        return connection.creation.data_types['CharField'] % {'max_length':32}
+        
+    def to_python(self, value):
+        if isinstance(value, uuid.UUID):
+            return value.hex
+        if isinstance(value, (buffer, bytearray)):
+            value = str(value)
+        if isinstance(value, str) and len(value) == 16:
+            return binascii.hexlify(value)
+        if isinstance(value, basestring) and len(value) == 36:
+            return value.replace('-', '')
+        return value
+        
+    def get_prep_value(self, value):
+        return self.to_python(value)
+        
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+        return self.encode(value, connection, app_settings.UUID_STORAGE)
+        
+    def encode(self, value, connection, storage):
+        """Returns the database representation of the given (hexadecimal) 
+           value using the given storage, 'char' or 'binary'."""
+        if value is None or storage != 'binary':
+            return value
+        if connection.vendor == 'postgresql':
+            return str(value)
+        # Django does not expose the DB-API module, but every backend's base 
+        # module imports it as Database.
+        backend = sys.modules[connection.__class__.__module__]
+        return backend.Database.Binary(binascii.unhexlify(value))
+
+    
+    
+_ACCESS_SUCCESS = 1
+_ACCESS_FAILURE_UUID = 2
+_ACCESS_FAILURE_HASH = 3
+_ACCESS_ERROR_TARGETVIEW = 4
+
+_ACCESS_RESULTS = (
+    (_ACCESS_SUCCESS,           'Success'),
+    (_ACCESS_FAILURE_UUID,      'Failure: unknown uuid'),
+    (_ACCESS_FAILURE_HASH,      'Failure: bad hash value'),
+    (_ACCESS_ERROR_TARGETVIEW,  'Error in targetview'),
+    )
+
     
 class Tracker(models.Model):
     """A group of urls whose accesses are tracked by LinkAnalytics.  The 
@@ -164,17 +239,66 @@ class Tracker(models.Model):
     def instances_read(self):
         """A QuerySet of all TrackedInstances associated with this 
            Tracker which have been accessed (or 'read')."""
-        # instances containing Accesses with a count value at least 1
-        return self.trackedinstance_set.annotate(
-                        num_accesses=models.Count('access__count')
-                    ).filter(num_accesses__gt=0)
+        # instances with at least one successful Access
+        return self.trackedinstance_set.filter(summary__success_count__gt=0)
 
     def instances_unread(self):
         """A QuerySet of all TrackedInstances associated with this 
            Tracker which have not been accessed (or 'not read')."""
-        return self.trackedinstance_set.annotate(
-                        num_accesses=models.Count('access__count')
-                    ).filter(num_accesses=0)
+        return self.trackedinstance_set.exclude(summary__success_count__gt=0)
+        
+    def access_histogram(self, granularity='hour', start=None, end=None, 
+                         result=_ACCESS_SUCCESS, fill=False):
+        """Returns the number of Accesses of this Tracker per hour or per day, 
+           as a list of (period, count) pairs in time order.  Each period is 
+           the start of an hour or day.
+           
+           granularity: 'hour' or 'day'
+           start, end: if given, only periods containing times from start up 
+                       to (but not including) end are returned.
+           result: the result of the Accesses counted (see _ACCESS_RESULTS).  
+                   If None, Accesses with any result are counted.
+           fill: if True, periods without Accesses are included with a count 
+                 of zero.
+        """
+        qs = self.accesshistogram_set.filter(granularity=granularity)
+        if start is not None:
+            start = histogram_period(start, granularity)
+            qs = qs.filter(period__gte=start)
+        if end is not None:
+            qs = qs.filter(period__lt=end)
+        if result is not None:
+            qs = qs.filter(result=result)
+        qs = qs.values_list('period').annotate(n=models.Sum('count'))
+        series = list(qs.order_by('period'))
+        if not fill or not (series or (start and end)):
+            return series
+        
+        counts = dict(series)
+        step = _HISTOGRAM_STEPS[granularity]
+        period = start  if start is not None else  series[0][0]
+        if end is None:
+            end = series[-1][0] + step
+        filled = []
+        while period < end:
+            filled.append((period, counts.get(period, 0)))
+            period += step
+        return filled
+        
+    def access_stats(self):
+        """Returns the TrackerStats of this Tracker.  If they were loaded 
+           along with this Tracker (using select_related('stats')), that copy 
+           is returned.  Otherwise they are read from the database, and 
+           computed if they do not exist yet.
+        """
+        s = getattr(self, '_stats_cache', None)
+        if s is not None:
+            return s
+        try:
+            return TrackerStats.objects.get(tracker=self.pk)
+        except TrackerStats.DoesNotExist:
+            TrackerStats.reconcile([self.pk])
+            return TrackerStats.objects.get(tracker=self.pk)
 
     def add_visitor(self, visitor):
         """Creates a TrackedInstance associating the given Visitor with this 
@@ -182,6 +306,36 @@ class Tracker(models.Model):
         i = TrackedInstance(tracker=self, visitor=visitor)
         i.save()
         return i
+        
+    def add_visitors(self, visitors):
+        """Creates TrackedInstances associating each of the given Visitors 
+           with this Tracker, using bulk inserts.  Visitors who already have 
+           a TrackedInstance for this Tracker are skipped.  The new 
+           TrackedInstances are returned, in the order of visitors.
+           
+           No post_save signals are sent for the new TrackedInstances.
+        """
+        unique = []
+        seen = set()
+        for v in visitors:
+            if v.pk not in seen:
+                seen.add(v.pk)
+                unique.append(v)
+                
+        created = []
+        with transaction.commit_on_success():
+            for start in xrange(0, len(unique), _INSTANCE_BATCH_SIZE):
+                batch = unique[start:start+_INSTANCE_BATCH_SIZE]
+                # Only the batch's visitors are looked up, so the work does 
+                # not grow with the number of instances the Tracker has.
+                qs = TrackedInstance.objects.filter(tracker=self, 
+                                    visitor__in=[v.pk for v in batch])
+                existing = set(qs.values_list('visitor', flat=True))
+                batch = [v for v in batch if v.pk not in existing]
+                if batch:
+                    created.extend(_create_instances(self, batch))
+            update_tracker_stats(self.pk, recipients=len(created))
+        return created
                         
     @staticmethod
     def unknown():
@@ -195,17 +349,86 @@ class Tracker(models.Model):
             return t
         
 
-_ACCESS_SUCCESS = 1
-_ACCESS_FAILURE_UUID = 2
-_ACCESS_FAILURE_HASH = 3
-_ACCESS_ERROR_TARGETVIEW = 4
+class TrackerStats(models.Model):
+    """Counts of the TrackedInstances of one Tracker, and of their Accesses.  
+       These are kept up to date as TrackedInstances are created and 
+       deleted one at a time, and as Accesses are saved, so that they can 
+       be listed without aggregating.  (See reconcile().)"""
+    tracker =       models.OneToOneField(Tracker, primary_key=True, 
+                                         related_name='stats')
+    # Number of TrackedInstances
+    recipients =    models.IntegerField(default=0)
+    # Number of TrackedInstances with at least one successful Access
+    read =          models.IntegerField(default=0)
+    # Total number of successful Accesses
+    accesses =      models.IntegerField(default=0)
+    
+    def __unicode__(self):
+        """Returns a unicode representation of a TrackerStats."""
+        return u'%s: %s/%s' % (self.tracker, self.read, self.recipients)
+    
+    def _unread(self):
+        """Getter for unread property.  Returns the number of TrackedInstances 
+           without a successful Access."""
+        return self.recipients - self.read
+    unread = property(_unread)
+    
+    @staticmethod
+    def reconcile(tracker_ids=None):
+        """Recomputes TrackerStats from the TrackedInstances and 
+           AccessSummaries, correcting any which differ.  If tracker_ids is 
+           given, only the stats of those Trackers are reconciled.  Returns 
+           the number of TrackerStats created or corrected.
+        """
+        trackers = Tracker.objects.all()
+        instances = TrackedInstance.objects.all()
+        summaries = AccessSummary.objects.all()
+        existing = TrackerStats.objects.all()
+        if tracker_ids is not None:
+            trackers = trackers.filter(pk__in=tracker_ids)
+            instances = instances.filter(tracker__in=tracker_ids)
+            summaries = summaries.filter(instance__tracker__in=tracker_ids)
+            existing = existing.filter(tracker__in=tracker_ids)
+            
+        totals = dict((pk, TrackerStats(tracker_id=pk)) 
+                      for pk in trackers.values_list('pk', flat=True))
+        for row in instances.values('tracker').annotate(n=models.Count('id')):
+            totals[row['tracker']].recipients = row['n']
+        summaries = summaries.values('instance__tracker')
+        for row in summaries.annotate(n=models.Sum('success_count')):
+            totals[row['instance__tracker']].accesses = row['n']
+        summaries = summaries.filter(success_count__gt=0)
+        for row in summaries.annotate(n=models.Count('instance')):
+            totals[row['instance__tracker']].read = row['n']
+            
+        existing = dict((s.pk, s) for s in existing)
+        n = 0
+        with transaction.commit_on_success():
+            for pk, s in totals.iteritems():
+                old = existing.get(pk)
+                if old is not None and (old.recipients, old.read, 
+                    old.accesses) == (s.recipients, s.read, s.accesses):
+                    continue
+                s.save(force_insert=(old is None))
+                n += 1
+        return n
+        
+def update_tracker_stats(tracker_id, recipients=0, read=0, accesses=0):
+    """Adds to the counts of the TrackerStats of the given Tracker.  If the 
+       Tracker has no TrackerStats, nothing is done; they are computed when 
+       they are first needed."""
+    TrackerStats.objects.filter(tracker=tracker_id).update(
+            recipients= models.F('recipients') + recipients,
+            read=       models.F('read') + read,
+            accesses=   models.F('accesses') + accesses )
+            
+def _on_tracker_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        TrackerStats(tracker=instance).save(force_insert=True)
+
+signals.post_save.connect(_on_tracker_saved, sender=Tracker)
+        
 
-_ACCESS_RESULTS = (
-    (_ACCESS_SUCCESS,           'Success'),
-    (_ACCESS_FAILURE_UUID,      'Failure: unknown uuid'),
-    (_ACCESS_FAILURE_HASH,      'Failure: bad hash value'),
-    (_ACCESS_ERROR_TARGETVIEW,  'Error in targetview'),
-    )
 
 
 class TrackedInstance(models.Model):
@@ -213,8 +436,8 @@ class TrackedInstance(models.Model):
        class (and owned objects) that access statistics are kept."""
     tracker =       models.ForeignKey(Tracker)
     visitor =       models.ForeignKey(Visitor)
-    uuid =          models.CharField(max_length=32, editable=False, 
-                                     default=_create_uuid, unique=True)
+    uuid =          UuidField(editable=False, default=_create_uuid, 
+                              unique=True)
     notified =      models.DateField(null=True, blank=True)
 
     class Meta:
@@ -224,6 +447,16 @@ class TrackedInstance(models.Model):
         """Returns a unicode representation of a TrackedInstance."""
         return u'%s, %s' % (self.tracker, self.visitor)
 
+    def delete(self, *args, **kwargs):
+        """Deletes the TrackedInstance, then reconciles the TrackerStats of 
+           its Tracker.  TrackedInstances deleted in bulk (through a QuerySet, 
+           or along with their Visitor) are not counted out of the 
+           TrackerStats; call TrackerStats.reconcile() for their Trackers 
+           afterwards."""
+        tracker_id = self.tracker_id
+        super(TrackedInstance, self).delete(*args, **kwargs)
+        TrackerStats.reconcile([tracker_id])
+
     def was_accessed(self):
         """Returns True if this TrackedInstance has been accessed; returns 
            False otherwise."""
@@ -237,37 +470,46 @@ class TrackedInstance(models.Model):
                    it failed.  See _ACCESS_RESULTS tuple.
            url: the url used (*not* the url redirected to)
         """
-        count = 0
-        time = datetime.datetime.now()
-        if result == _ACCESS_SUCCESS:
-            count = 1
-        a = Access(instance=self, time=time, count=count, url=url, 
-                   result=result)
+        a = new_access(self.pk, result, url, tracker_id=self.tracker_id)
         a.save()
 
+    def access_summary(self):
+        """Returns the AccessSummary of this TrackedInstance, or None if it 
+           has never been accessed.  If the summary was loaded along with 
+           this TrackedInstance (using select_related('summary')), that copy 
+           is returned.  Otherwise it is read from the database.
+        """
+        try:
+            return self._summary_cache
+        except AttributeError:
+            pass
+        try:
+            return AccessSummary.objects.get(instance=self.pk)
+        except AccessSummary.DoesNotExist:
+            return None
+
     def _first_access(self):
-        """Getter for first_access property.  Returns the Access 
-           object representing the first access of this TrackedInstance, or 
-           None if it has not yet been accessed.
+        """Getter for first_access property.  Returns the time of the first 
+           successful access of this TrackedInstance, or None if it has not 
+           yet been accessed.
         """
-        ag = self.access_set.filter(count__gte=1).aggregate(models.Min('time'))
-        return ag['time__min']
+        s = self.access_summary()
+        return s.first_success  if s else  None
         
     def _recent_access(self):
-        """Getter for recent_access property.  Returns the Access 
-           object representing the most recent access of this 
-           TrackedInstance, or None if it has not yet been accessed.
+        """Getter for recent_access property.  Returns the time of the most 
+           recent successful access of this TrackedInstance, or None if it 
+           has not yet been accessed.
         """
-        ag = self.access_set.filter(count__gte=1).aggregate(models.Max('time'))
-        return ag['time__max']
+        s = self.access_summary()
+        return s.last_success  if s else  None
         
     def _access_count(self):
         """Getter for access_count property.  Returns the access count for this 
            TrackedInstance.
         """
-        tset = self.access_set
-        r = tset.aggregate(models.Sum('count'))['count__sum']
-        return r  if r else  0  # handles case where r is None
+        s = self.access_summary()
+        return s.success_count  if s else  0
     
     first_access = property(_first_access)
     recent_access = property(_recent_access)
@@ -289,8 +531,7 @@ class TrackedInstance(models.Model):
         """Returns True if hash == self.generate_hash(data).  Returns False 
            otherwise.
         """
-        newhash = self.generate_hash(data)
-        return hash == newhash
+        return urlex.validate_urlhash(hash, self.uuid, data)
         
     @staticmethod
     def unknown():
@@ -304,6 +545,63 @@ class TrackedInstance(models.Model):
             i = TrackedInstance(tracker=t, visitor=v)
             i.save()
             return i
+            
+    @staticmethod
+    def unknown_pk():
+        """Return the primary key of the unknown TrackedInstance object.  It 
+           is looked up only once per process (unless the object is deleted), 
+           so recording failed accesses does not require extra queries."""
+        global _unknown_instance_pk
+        if _unknown_instance_pk is None:
+            _unknown_instance_pk = TrackedInstance.unknown().pk
+        return _unknown_instance_pk
+    
+# Cached primary key of the unknown TrackedInstance.  See unknown_pk().
+_unknown_instance_pk = None
+
+# Number of TrackedInstances written by each INSERT in Tracker.add_visitors().  
+# SQLite allows at most 999 parameters per statement, four per instance.
+_INSTANCE_BATCH_SIZE = 200
+
+def _create_instances(tracker, visitors):
+    """Bulk inserts TrackedInstances associating the given Visitors with 
+       tracker, and returns them with their primary keys set.  If another 
+       process has meanwhile added any of the visitors, those are skipped."""
+    instances = [TrackedInstance(tracker=tracker, visitor=v, 
+                                 uuid=_create_uuid()) for v in visitors]
+    sid = transaction.savepoint()
+    try:
+        TrackedInstance.objects.bulk_create(instances)
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        qs = TrackedInstance.objects.filter(tracker=tracker, 
+                                            visitor__in=visitors)
+        taken = set(qs.values_list('visitor', flat=True))
+        instances = [i for i in instances if i.visitor_id not in taken]
+        TrackedInstance.objects.bulk_create(instances)
+        
+    # bulk_create() does not set primary keys, so read them back by uuid.
+    to_python = TrackedInstance._meta.get_field('uuid').to_python
+    qs = TrackedInstance.objects.filter(uuid__in=[i.uuid for i in instances])
+    pks = dict((to_python(u), pk) for u, pk in qs.values_list('uuid', 'pk'))
+    for i in instances:
+        i.pk = pks[i.uuid]
+    return instances
+
+def _on_trackedinstance_saved(sender, instance, created, raw=False, 
+                              **kwargs):
+    if created and not raw:
+        update_tracker_stats(instance.tracker_id, recipients=1)
+
+def _on_trackedinstance_deleted(sender, instance, **kwargs):
+    global _unknown_instance_pk
+    if instance.pk == _unknown_instance_pk:
+        _unknown_instance_pk = None
+
+signals.post_save.connect(_on_trackedinstance_saved, sender=TrackedInstance)
+signals.post_delete.connect(_on_trackedinstance_deleted, 
+                            sender=TrackedInstance)
     
 
 class Access(models.Model):
@@ -318,6 +616,312 @@ class Access(models.Model):
                              blank=True)
     result =    models.SmallIntegerField(choices=_ACCESS_RESULTS)
     
+    def save(self, *args, **kwargs):
+        """Saves the Access.  A new Access is also added to the totals kept 
+           for it, in the same transaction.  (See update_access_totals().)"""
+        is_new = self.pk is None
+        with transaction.commit_on_success():
+            super(Access, self).save(*args, **kwargs)
+            if is_new:
+                update_access_totals([self])
+    
+def _on_access_saved(sender, instance, created, raw=False, **kwargs):
+    # Accesses loaded from fixtures are saved raw, without Access.save().
+    if created and raw:
+        update_access_totals([instance])
+
+signals.post_save.connect(_on_access_saved, sender=Access)
+    
+
+class AccessSummary(models.Model):
+    """Totals of the Accesses of one TrackedInstance.  These are updated as 
+       each Access is saved, so that reading them does not require 
+       aggregating over the Access table.  (Accesses which are later changed 
+       or deleted are not reflected; see rebuild().)"""
+    instance =      models.OneToOneField(TrackedInstance, primary_key=True, 
+                                         related_name='summary')
+    success_count = models.IntegerField(default=0)
+    first_success = models.DateTimeField(null=True, blank=True)
+    last_success =  models.DateTimeField(null=True, blank=True)
+    failure_count = models.IntegerField(default=0)
+    
+    def __unicode__(self):
+        """Returns a unicode representation of an AccessSummary."""
+        return u'%s: %s' % (self.instance, self.success_count)
+    
+    def add(self, other):
+        """Adds the totals of another AccessSummary to this one."""
+        self.success_count += other.success_count
+        self.failure_count += other.failure_count
+        if other.first_success is not None:
+            if self.first_success is None or \
+               other.first_success < self.first_success:
+                self.first_success = other.first_success
+        if other.last_success is not None:
+            if self.last_success is None or \
+               other.last_success > self.last_success:
+                self.last_success = other.last_success
+    
+    def add_access(self, access):
+        """Adds a single Access to the totals.  An Access without a time 
+           is counted, but does not change first_success or last_success."""
+        if access.count:
+            self.success_count += access.count
+            if access.time is None:
+                return
+            if self.first_success is None or access.time < self.first_success:
+                self.first_success = access.time
+            if self.last_success is None or access.time > self.last_success:
+                self.last_success = access.time
+        else:
+            self.failure_count += 1
+    
+    @staticmethod
+    def rebuild(instance_ids=None):
+        """Recomputes AccessSummaries from the Access table.  If instance_ids 
+           is given, only the summaries of those TrackedInstances are 
+           rebuilt.  Returns the number of summaries written.
+        """
+        accesses = Access.objects.all()
+        summaries = AccessSummary.objects.all()
+        if instance_ids is not None:
+            accesses = accesses.filter(instance__in=instance_ids)
+            summaries = summaries.filter(instance__in=instance_ids)
+        totals = {}
+        successes = accesses.filter(count__gte=1).values('instance').annotate(
+                        n=models.Sum('count'), first=models.Min('time'), 
+                        last=models.Max('time'))
+        for row in successes:
+            totals[row['instance']] = AccessSummary(
+                    instance_id=row['instance'], success_count=row['n'], 
+                    first_success=row['first'], last_success=row['last'])
+        failures = accesses.filter(count=0).values('instance').annotate(
+                        n=models.Count('id'))
+        for row in failures:
+            s = totals.get(row['instance'])
+            if s is None:
+                s = totals[row['instance']] = AccessSummary(
+                                                instance_id=row['instance'])
+            s.failure_count = row['n']
+        with transaction.commit_on_success():
+            summaries.delete()
+            AccessSummary.objects.bulk_create(totals.values())
+        return len(totals)
+    
+
+def new_access(instance_id, result, url, time=None, tracker_id=None):
+    """Returns a new, unsaved Access for the TrackedInstance with the given 
+       primary key.  If time is not given, the current time is used.  If the 
+       primary key of the TrackedInstance's Tracker is known, it may be 
+       given as tracker_id, which saves looking it up when the Access is 
+       added to the totals.
+    """
+    if time is None:
+        time = datetime.datetime.now()
+    count = 1  if result == _ACCESS_SUCCESS else  0
+    access = Access(instance_id=instance_id, time=time, count=count, url=url, 
+                    result=result)
+    access.tracker_id = tracker_id
+    return access
+
+def save_accesses(accesses):
+    """Saves a sequence of new (unsaved) Access objects using a single bulk 
+       insert, and adds them to the totals kept for them."""
+    with transaction.commit_on_success():
+        Access.objects.bulk_create(accesses)
+        update_access_totals(accesses)
+        
+def update_access_totals(accesses):
+    """Adds a sequence of new Accesses to the AccessSummaries of their 
+       TrackedInstances, and to the TrackerStats and AccessHistograms of 
+       their Trackers.  The Trackers are only looked up for Accesses created 
+       without a tracker_id (see new_access())."""
+    # {instance_id: tracker_id}
+    trackers = {}
+    for a in accesses:
+        tracker_id = getattr(a, 'tracker_id', None)
+        if tracker_id is not None:
+            trackers[a.instance_id] = tracker_id
+    missing = set(a.instance_id for a in accesses) - set(trackers)
+    if missing:
+        qs = TrackedInstance.objects.filter(pk__in=missing)
+        trackers.update(qs.values_list('pk', 'tracker'))
+        
+    with transaction.commit_on_success():
+        first_reads = update_access_summaries(accesses)
+        
+        # Changes to the TrackerStats: {tracker_id: [read, accesses]}
+        stats = {}
+        for a in accesses:
+            if a.count:
+                t = stats.setdefault(trackers[a.instance_id], [0, 0])
+                t[1] += a.count
+        for pk in first_reads:
+            stats[trackers[pk]][0] += 1
+        for tracker_id in sorted(stats):
+            read, n = stats[tracker_id]
+            update_tracker_stats(tracker_id, read=read, accesses=n)
+            
+        update_access_histograms(accesses, trackers)
+    
+def update_access_summaries(accesses):
+    """Adds a sequence of new Accesses to the AccessSummaries of their 
+       TrackedInstances.  Each summary is locked while it is updated, so 
+       concurrent writers do not lose counts.  Returns the set of primary 
+       keys of TrackedInstances which were accessed successfully for the 
+       first time."""
+    deltas = {}
+    for a in accesses:
+        d = deltas.get(a.instance_id)
+        if d is None:
+            d = deltas[a.instance_id] = AccessSummary(instance_id=a.instance_id)
+        d.add_access(a)
+    first_reads = set()
+    with transaction.commit_on_success():
+        # Lock in a consistent order to avoid deadlocks between writers.
+        for pk in sorted(deltas):
+            d = deltas[pk]
+            qs = AccessSummary.objects.select_for_update()
+            s, created = qs.get_or_create(instance_id=pk, defaults={
+                                'success_count': d.success_count,
+                                'first_success': d.first_success,
+                                'last_success':  d.last_success,
+                                'failure_count': d.failure_count, })
+            if d.success_count and (created or s.success_count == 0):
+                first_reads.add(pk)
+            if not created:
+                s.add(d)
+                s.save(force_update=True)
+    return first_reads
+    
+
+_HISTOGRAM_GRANULARITIES = (
+    ('hour',    'Hourly'),
+    ('day',     'Daily'),
+    )
+
+def histogram_period(time, granularity):
+    """Returns the start of the histogram period of the given granularity 
+       ('hour' or 'day') which contains the given time."""
+    if granularity == 'hour':
+        return time.replace(minute=0, second=0, microsecond=0)
+    elif granularity == 'day':
+        return time.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError('Unknown histogram granularity: %r' % (granularity,))
+    
+_HISTOGRAM_STEPS = { 'hour': datetime.timedelta(hours=1),
+                     'day':  datetime.timedelta(days=1), }
+
+class AccessHistogram(models.Model):
+    """The number of Accesses of a Tracker with one result during one hour or 
+       one day.  These are incremented as Accesses are saved, so that access 
+       trends can be read without scanning the Access table.  (See 
+       Tracker.access_histogram().)"""
+    tracker =       models.ForeignKey(Tracker)
+    granularity =   models.CharField(max_length=4, 
+                                     choices=_HISTOGRAM_GRANULARITIES)
+    # The start of the hour or day
+    period =        models.DateTimeField()
+    result =        models.SmallIntegerField(choices=_ACCESS_RESULTS)
+    count =         models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = (("tracker", "granularity", "period", "result", ),)
+        
+    def __unicode__(self):
+        """Returns a unicode representation of an AccessHistogram."""
+        return u'%s, %s: %s' % (self.tracker, self.period, self.count)
+        
+    @staticmethod
+    def rebuild(tracker_ids=None):
+        """Recomputes AccessHistograms from the Access table.  If tracker_ids 
+           is given, only the histograms of those Trackers are rebuilt.  
+           Returns the number of histogram rows written.
+        """
+        accesses = Access.objects.all()
+        histograms = AccessHistogram.objects.all()
+        if tracker_ids is not None:
+            accesses = accesses.filter(instance__tracker__in=tracker_ids)
+            histograms = histograms.filter(tracker__in=tracker_ids)
+        counts = {}
+        rows = accesses.filter(time__isnull=False).values_list(
+                                        'instance__tracker', 'time', 'result')
+        for tracker_id, time, result in rows.iterator():
+            for granularity, name in _HISTOGRAM_GRANULARITIES:
+                key = (tracker_id, granularity, 
+                       histogram_period(time, granularity), result)
+                counts[key] = counts.get(key, 0) + 1
+        with transaction.commit_on_success():
+            histograms.delete()
+            AccessHistogram.objects.bulk_create([
+                    AccessHistogram(tracker_id=t, granularity=g, period=p, 
+                                    result=r, count=n)
+                    for (t, g, p, r), n in counts.iteritems() ])
+        return len(counts)
+        
+def update_access_histograms(accesses, trackers):
+    """Adds a sequence of new Accesses to the AccessHistograms.  trackers 
+       maps the primary key of each Access's TrackedInstance to that of its 
+       Tracker.  Accesses without a time are left out."""
+    counts = {}
+    for a in accesses:
+        if a.time is None:
+            continue
+        for granularity, name in _HISTOGRAM_GRANULARITIES:
+            key = (trackers[a.instance_id], granularity, 
+                   histogram_period(a.time, granularity), a.result)
+            counts[key] = counts.get(key, 0) + 1
+    with transaction.commit_on_success():
+        for key in sorted(counts):
+            tracker_id, granularity, period, result = key
+            n = counts[key]
+            qs = AccessHistogram.objects.filter(tracker=tracker_id, 
+                        granularity=granularity, period=period, result=result)
+            if qs.update(count=models.F('count')+n):
+                continue
+            sid = transaction.savepoint()
+            try:
+                AccessHistogram(tracker_id=tracker_id, granularity=granularity, 
+                                period=period, result=result, 
+                                count=n).save(force_insert=True)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # Created by another process in the meantime.
+                transaction.savepoint_rollback(sid)
+                qs.update(count=models.F('count')+n)
+    
+
+class AccessFailureCount(models.Model):
+    """The number of failed accesses of one kind during one minute.  Failed 
+       accesses are counted here rather than each creating an Access; only a 
+       few samples per minute are kept as Access objects.  (See the 
+       ACCESS_FAILURE_SAMPLES setting.)"""
+    minute =    models.DateTimeField()
+    result =    models.SmallIntegerField(choices=_ACCESS_RESULTS)
+    count =     models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = (("minute", "result", ),)
+        
+def save_failure_counts(counts):
+    """Adds to the stored AccessFailureCounts.  counts is a dict mapping 
+       (minute, result) pairs to the number of failures to add."""
+    with transaction.commit_on_success():
+        for (minute, result), n in counts.iteritems():
+            qs = AccessFailureCount.objects.filter(minute=minute, 
+                                                   result=result)
+            if qs.update(count=models.F('count')+n):
+                continue
+            sid = transaction.savepoint()
+            try:
+                AccessFailureCount(minute=minute, result=result, 
+                                   count=n).save(force_insert=True)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # Created by another process in the meantime.
+                transaction.savepoint_rollback(sid)
+                qs.update(count=models.F('count')+n)
+    
 
 #==============================================================================#
 # import models from sub packages
@@ -0,0 +1,65 @@
+"""
+    The one-pixel images returned when a pixel image is tracked.
+"""
+
+import hashlib
+import os.path
+from collections import namedtuple
+
+from django.http import HttpResponse
+
+from linkanalytics import app_settings
+
+#==============================================================================#
+# Pixel images are the most frequently accessed targets.  Their content never
+# changes, so each image is loaded once, and its response headers are computed
+# along with it.  Responses forbid caching so that every open of an email
+# requests the image again.
+
+Pixel = namedtuple('Pixel', 'content mimetype headers')
+
+# A one-pixel transparent GIF.
+_GIF_CONTENT = ('GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff'
+                '!\xf9\x04\x01\x00\x00\x00\x00'
+                ',\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;')
+
+_NOCACHE_HEADERS = (
+    ('Cache-Control', 'no-cache, no-store, must-revalidate, private'),
+    ('Pragma', 'no-cache'),
+    ('Expires', 'Thu, 01 Jan 1970 00:00:00 GMT'),
+    )
+
+def _make_pixel(content, mimetype):
+    etag = '"{0}"'.format(hashlib.md5(content).hexdigest())
+    headers = (('Content-Type', mimetype),
+               ('Content-Length', str(len(content))),
+               ('ETag', etag),) + _NOCACHE_HEADERS
+    return Pixel(content, mimetype, headers)
+
+def _load_png():
+    fname = os.path.join(app_settings.PIXEL_IMGDIR, 'blank.png')
+    with open(fname, 'rb') as f:
+        return _make_pixel(f.read(), 'image/png')
+
+_loaders = { 'gif': lambda: _make_pixel(_GIF_CONTENT, 'image/gif'),
+             'png': _load_png, }
+_pixels = {}
+
+def get_pixel(imgtype):
+    """Returns the Pixel for the given image type, 'gif' or 'png'."""
+    p = _pixels.get(imgtype)
+    if p is None:
+        p = _pixels[imgtype] = _loaders[imgtype]()
+    return p
+
+def pixel_response(request, imgtype):
+    """Returns an HttpResponse containing the pixel image of the given type.
+       Responses to HEAD requests have the same headers but no content."""
+    p = get_pixel(imgtype)
+    content = p.content  if request.method != 'HEAD' else  ''
+    response = HttpResponse(content, mimetype=p.mimetype)
+    for name, value in p.headers:
+        response[name] = value
+    return response
+
+#==============================================================================#
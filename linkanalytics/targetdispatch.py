@@ -0,0 +1,99 @@
+"""
+    Resolution of urltails to targetview functions.
+"""
+
+from django.core.urlresolvers import resolve, Resolver404, NoReverseMatch
+from django.core.urlresolvers import get_script_prefix
+
+from linkanalytics.util.lrucache import LRUCache
+from linkanalytics import app_settings, urlex
+
+#==============================================================================#
+# Each tracked access must find the targetview for its urltail.  Resolving the
+# urltail against the targets urlconf tries each pattern in turn, so the
+# results are kept instead.  Targets that take no arguments (pixel images and
+# the email targets) are resolved once into a fixed table which is never
+# evicted.  Other urltails are kept in a bounded LRU cache.  The urlconf
+# remains the only place targets are defined.
+#==============================================================================#
+
+# Names of targets whose urltails do not vary.
+FIXED_TARGETS = ( 'targetview-pixelpng',
+                  'targetview-pixelgif',
+                  'targetview-email-render',
+                  'targetview-email-acknowledge', )
+
+class TargetDispatcher(object):
+    """Resolves urltails to (viewfunc, args, kwargs) using the given
+       urlconf."""
+
+    def __init__(self, urlconf, cache_size):
+        self.urlconf = urlconf
+        self._fixed = None
+        self._cache = LRUCache(cache_size)
+
+    def resolve(self, tailpath):
+        """Returns a (viewfunc, args, kwargs) tuple for the given urltail,
+           which must begin with a slash.  The kwargs dict is a new object
+           that the caller may modify.  Raises Resolver404 if the urltail
+           does not match any target.
+        """
+        match = self.fixed_targets().get(tailpath)
+        if match is None:
+            match = self._cache.get(tailpath)
+            if match is None:
+                match = self._resolve(tailpath)
+                self._cache.set(tailpath, match)
+        viewfunc, args, kwargs = match
+        return viewfunc, args, dict(kwargs)
+
+    def fixed_targets(self):
+        """Returns a dict mapping the urltails of FIXED_TARGETS to their
+           resolved (viewfunc, args, kwargs)."""
+        if self._fixed is None:
+            prefix = get_script_prefix()
+            table = {}
+            for name in FIXED_TARGETS:
+                try:
+                    tail = urlex.constant_urltail(name, self.urlconf)
+                except NoReverseMatch:
+                    continue
+                tail = '/' + tail[len(prefix):].rstrip('/')
+                # The trailing slash is optional in the target patterns.
+                for t in (tail, tail+'/'):
+                    try:
+                        table[t] = self._resolve(t)
+                    except Resolver404:
+                        pass
+            self._fixed = table
+        return self._fixed
+
+    def clear(self):
+        """Forget all resolved urltails."""
+        self._fixed = None
+        self._cache.clear()
+
+    def _resolve(self, tailpath):
+        m = resolve(tailpath, urlconf=self.urlconf)
+        return (m.func, tuple(m.args), m.kwargs)
+
+#==============================================================================#
+_dispatchers = {}
+
+def get_dispatcher(urlconf=None):
+    """Returns the TargetDispatcher for the given urlconf.  The default is the
+       TARGETS_URLCONF setting."""
+    if urlconf is None:
+        urlconf = app_settings.TARGETS_URLCONF
+    d = _dispatchers.get(urlconf)
+    if d is None:
+        d = TargetDispatcher(urlconf, app_settings.TARGET_CACHE_SIZE)
+        _dispatchers[urlconf] = d
+    return d
+
+def resolve_target(tailpath):
+    """Returns (viewfunc, args, kwargs) for the given urltail using the
+       TARGETS_URLCONF setting."""
+    return get_dispatcher().resolve(tailpath)
+
+#==============================================================================#
@@ -1,12 +1,10 @@
-import os.path
-
 from django.shortcuts import render_to_response, redirect
 from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.template import RequestContext
 
 from django.template import TemplateDoesNotExist
 
-from linkanalytics import app_settings, decorators
+from linkanalytics import app_settings, decorators, pixels
 
 
 #==============================================================================#
@@ -32,7 +30,13 @@ def targetview_redirect(request, uuid, scheme=None, domain=None, filepath=None):
        not present, the filepath is appended to the default site, and the 
        scheme argument is ignored.
     """
+    response = redirect(redirect_url(scheme, domain, filepath))
+    return response
     
+def redirect_url(scheme=None, domain=None, filepath=None):
+    """Returns the URL to which targetview_redirect redirects, given the same 
+       arguments.  If domain is not given, the URL is relative to the current 
+       site."""
     if (not domain) and (not filepath):
         msg = 'Either "domain" or "filepath" (or both) must be provided.'
         raise TypeError(msg)
@@ -46,22 +50,17 @@ def targetview_redirect(request, uuid, scheme=None, domain=None, filepath=None):
         if not filepath:
             filepath = ''
         url = '{s}://{d}/{f}'.format(s=scheme, d=domain, f=filepath)
-    
-    response = redirect(url)
-    return response
+    return url
 
 @decorators.targetview()
 def targetview_pixelgif(request, uuid):
     """Returns a response to a one-pixel transparent GIF image."""
-    msg = 'Target view: targetview_pixelgif().  Under Construction'
-    return HttpResponse(msg)
+    return pixels.pixel_response(request, 'gif')
     
 @decorators.targetview()
 def targetview_pixelpng(request, uuid):
     """Returns a response to a one-pixel transparent PNG image."""
-    fname = os.path.join(app_settings.PIXEL_IMGDIR,'blank.png')
-    with open(fname, 'rb') as f:
-        return HttpResponse(f.read(), mimetype='image/png')
+    return pixels.pixel_response(request, 'png')
         
 #==============================================================================#
 
@@ -1,6 +1,5 @@
 from django import template
 import urlparse
-from django.core.urlresolvers import reverse as urlreverse
 
 from linkanalytics import urlex, app_settings
 
@@ -56,9 +55,9 @@ class TrackEmailNode(TrackNode):
     def __init__(self, option):
         TrackNode.__init__(self)
         if option=='render':
-            url = urlreverse('targetview-email-render')
+            url = urlex.constant_urltail('targetview-email-render')
         elif option=='acknowledge':
-            url = urlreverse('targetview-email-acknowledge')
+            url = urlex.constant_urltail('targetview-email-acknowledge')
         else:
             raise RuntimeError('Unknown email option')
         self.text = create_trackedurl_tag(url)
@@ -108,11 +107,25 @@ class TrackedurlNode(template.Node):
     def render(self, context):
         try:
             linkid = self.linkid.resolve(context)
-            urlpart = urlex.create_hashedurl(linkid, self.trailpath)
+            builder = urlex.hashedurl_builder(self.trailpath)
             urlbase = self.urlbase.resolve(context)
-            return '{base}{p}'.format(base=urlbase, p=urlpart)
         except Exception:
             return ''
+        # When rendering for many recipients at once, the linkid is a 
+        # placeholder and the URL is filled in later for each recipient.
+        slots = context.get(app_settings.SLOTS_VARNAME)
+        if slots is not None and linkid is slots.linkid:
+            return slots.add(urlbase, builder)
+        return render_trackedurl(urlbase, builder, linkid)
+    
+    
+def render_trackedurl(urlbase, builder, linkid):
+    """Returns the tracked URL built by builder for linkid, following 
+       urlbase, or an empty string if it cannot be built."""
+    try:
+        return '{base}{p}'.format(base=urlbase, p=builder(linkid))
+    except Exception:
+        return ''
     
 
 def trackedurl(parser, token):
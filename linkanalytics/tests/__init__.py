@@ -5,9 +5,10 @@ from linkanalytics.tests import base
 #==============================================================================#
 # Test modules...
 from linkanalytics.tests import views, templatetags, models, util, email
+from linkanalytics.tests import recording
 
 # List of all test modules containing tests.  
-_testmodules = [views,templatetags,models,util,email]
+_testmodules = [views,templatetags,models,util,email,recording]
 
 # Import all test cases so they appear in this module.  This appears to be 
 # needed for Hudson automated testing.
@@ -3,10 +3,12 @@ from linkanalytics.tests.email import base
 
 #==============================================================================#
 # Test modules...
-from linkanalytics.tests.email import views, models, email
+from linkanalytics.tests.email import views, models, email, delivery, \
+                                   scheduler, rendering
 
 # List of all test modules containing tests.  
-_testmodules = [views, models, email]
+_testmodules = [views, models, email, delivery, scheduler,
+                rendering]
 
 # Import all test cases so they appear in this module.  This appears to be 
 # needed for Hudson automated testing.
@@ -1,3 +1,8 @@
+# The sibling module email.py would otherwise hide the standard library's.
+from __future__ import absolute_import
+
+import email
+
 from linkanalytics.email.models import Email, DraftEmail, EmailRecipients
 
 from linkanalytics.tests import base
@@ -35,4 +40,11 @@ class LinkAnalytics_EmailTestCaseBase(base.LinkAnalytics_DBTestCaseBase):
         return e
         
 #==============================================================================#
-
+def message_parts(data):
+    """Returns the recipient, subject and decoded alternatives of an encoded 
+       message."""
+    m = email.message_from_string(data)
+    return (m['To'], m['Subject'], 
+            [p.get_payload(decode=True) for p in m.get_payload()])
+    
+#==============================================================================#
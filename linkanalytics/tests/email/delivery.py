@@ -0,0 +1,385 @@
+import asyncore
+import datetime
+import smtpd
+import threading
+
+from StringIO import StringIO
+
+from django.core import mail as django_email
+from django.core.mail.backends.locmem import EmailBackend as LocmemBackend
+from django.core.mail.backends.smtp import EmailBackend as SMTPBackend
+from django.core.management import call_command
+from django.test.utils import override_settings
+
+from linkanalytics.models import TrackedInstance, Visitor
+from linkanalytics import app_settings
+from linkanalytics.email.models import DraftEmail, EmailRecipients, SendJob
+from linkanalytics.email.models import ClaimLost
+from linkanalytics.email.delivery import DeliveryPool, DeliveryError
+from linkanalytics.email.delivery import MessageNotSent
+from linkanalytics.email.rendering import Renderer
+
+from linkanalytics.tests import base as testsbase
+from linkanalytics.tests.email import base
+
+#==============================================================================#
+class FailingBackend(LocmemBackend):
+    """A locmem backend which fails to send messages to addresses beginning
+       with 'fail' or 'drop' (raising an exception or not), and counts the
+       connections opened."""
+    opened = 0
+    lock = threading.Lock()
+
+    def open(self):
+        with FailingBackend.lock:
+            FailingBackend.opened += 1
+
+    def send_messages(self, messages):
+        for m in messages:
+            if m.to[0].startswith('fail'):
+                raise IOError('refused')
+            if m.to[0].startswith('drop'):
+                return 0
+        return super(FailingBackend, self).send_messages(messages)
+
+
+class SMTPStandIn(smtpd.SMTPServer):
+    """A local SMTP server which keeps the messages it receives."""
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.received = []
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            asyncore.loop(timeout=0.01, count=1)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received.append((rcpttos, data))
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.close()
+
+
+def new_message(address):
+    return django_email.EmailMessage('Subject', 'Body', 'from@example.com',
+                                     [address])
+
+#==============================================================================#
+class DeliveryPool_TestCase(testsbase.LinkAnalytics_TestCaseBase):
+    def setUp(self):
+        super(DeliveryPool_TestCase, self).setUp()
+        django_email.outbox = []
+        FailingBackend.opened = 0
+
+    def test_locmem(self):
+        addresses = ['user{0}@example.com'.format(n) for n in range(20)]
+        pool = DeliveryPool(workers=4)
+        results = pool.deliver(new_message(a) for a in addresses)
+        self.assertEquals(results, [None]*20)
+        self.assertEquals(sorted(m.to[0] for m in django_email.outbox),
+                          sorted(addresses))
+
+    def test_failures(self):
+        addresses = ['user0@example.com', 'fail1@example.com',
+                     'user2@example.com', 'drop3@example.com',
+                     'user4@example.com']
+        pool = DeliveryPool(workers=2, connection_factory=FailingBackend)
+        results = pool.deliver(new_message(a) for a in addresses)
+
+        self.assertEquals(results[0::2], [None]*3)
+        self.assertTrue(isinstance(results[1], IOError))
+        self.assertTrue(isinstance(results[3], MessageNotSent))
+        self.assertEquals(sorted(m.to[0] for m in django_email.outbox),
+                          addresses[0::2])
+
+    def test_serial(self):
+        pool = DeliveryPool(workers=1, connection_factory=FailingBackend)
+        results = pool.deliver([new_message('user@example.com')]*3)
+        self.assertEquals(results, [None]*3)
+        self.assertEquals(FailingBackend.opened, 1)
+
+        # The connection is reopened after a failure.
+        addresses = ['fail@example.com', 'user@example.com', 'user@example.com']
+        results = pool.deliver(new_message(a) for a in addresses)
+        self.assertEquals(results[1:], [None, None])
+        self.assertEquals(FailingBackend.opened, 3)
+        self.assertEquals(DeliveryPool(workers=3).deliver([]), [])
+
+    def test_smtp(self):
+        server = SMTPStandIn()
+        try:
+            def factory():
+                return SMTPBackend(host='127.0.0.1', port=server.port)
+            addresses = ['user{0}@example.com'.format(n) for n in range(10)]
+            pool = DeliveryPool(workers=3, connection_factory=factory)
+            results = pool.deliver(new_message(a) for a in addresses)
+        finally:
+            server.stop()
+        self.assertEquals(results, [None]*10)
+        self.assertEquals(sorted(r[0][0] for r in server.received),
+                          sorted(addresses))
+
+
+class DeliveryEmail_TestCase(base.LinkAnalytics_EmailTestCaseBase):
+    def setUp(self):
+        super(DeliveryEmail_TestCase, self).setUp()
+        django_email.outbox = []
+
+    @override_settings(EMAIL_BACKEND='linkanalytics.tests.email.delivery.'
+                                     'FailingBackend')
+    def test_send(self):
+        vs = []
+        for name in ('user1', 'fail2', 'user3'):
+            v = Visitor(username=name, emailaddress=name+'@example.com')
+            v.save()
+            vs.append(v)
+        de = self.new_draftemail(fromemail='', subject='Subject',
+                                 pixelimage=False, recipients=vs,
+                                 message='<html><head></head>'
+                                         '<body></body></html>')
+        try:
+            de.send()
+        except DeliveryError as e:
+            self.assertEquals(e.failures[0][0], vs[1])
+            self.assertEquals(len(e.failures), 1)
+        else:
+            self.fail('DeliveryError not raised')
+
+        # The draft was sent, even though not to everyone.
+        de = DraftEmail.objects.get(pk=de.pk)
+        self.assertTrue(de.sent)
+        self.assertEquals(de.pending_recipients.count(), 0)
+
+        # Only the recipients who were sent the email are recorded.
+        self.assertEquals(len(django_email.outbox), 2)
+        today = datetime.date.today()
+        notified = dict((i.visitor_id, i.notified)
+                        for i in TrackedInstance.objects.all())
+        self.assertEquals(notified, {vs[0].pk: today, vs[1].pk: None,
+                                     vs[2].pk: today})
+        er = EmailRecipients.objects.get()
+        self.assertEquals(sorted(er.recipients.values_list('pk', flat=True)),
+                          [vs[0].pk, vs[2].pk])
+
+    def test_chunks(self):
+        vs = []
+        for n in range(5):
+            v = Visitor(username='user'+str(n), 
+                        emailaddress='user{0}@example.com'.format(n))
+            v.save()
+            vs.append(v)
+        de = self.new_draftemail(fromemail='', subject='Subject',
+                                 pixelimage=False, recipients=vs,
+                                 message='<html><head></head>'
+                                         '<body></body></html>')
+        
+        # Each chunk is sent, and its recipients recorded, before the next 
+        # chunk is read.
+        batches = []
+        def deliver(pool, messages):
+            batches.append(([m.to[0] for m in messages], 
+                            TrackedInstance.objects.count(),
+                            EmailRecipients.objects.get().recipients.count()))
+            return [None] * len(messages)
+        old = (app_settings.EMAIL_SEND_CHUNK_SIZE, DeliveryPool.deliver)
+        app_settings.EMAIL_SEND_CHUNK_SIZE = 2
+        DeliveryPool.deliver = deliver
+        try:
+            e = de.send()
+        finally:
+            app_settings.EMAIL_SEND_CHUNK_SIZE, DeliveryPool.deliver = old
+            
+        addresses = [v.emailaddress for v in vs]
+        self.assertEquals(batches, [(addresses[0:2], 2, 0), 
+                                    (addresses[2:4], 4, 2), 
+                                    (addresses[4:], 5, 4)])
+        self.assertEquals(e.recipient_count(), 5)
+        self.assertEquals(EmailRecipients.objects.get().recipients.count(), 5)
+        self.assertFalse(TrackedInstance.objects.filter(notified=None).exists())
+
+
+    def test_query_count(self):
+        # The number of queries made to send an email does not depend on the 
+        # number of recipients (within one chunk).
+        pks = []
+        for n in range(10):
+            v = Visitor(username='user'+str(n), 
+                        emailaddress='user{0}@example.com'.format(n))
+            v.save()
+            pks.append(v.pk)
+        for n in (1, 10):
+            de = self.new_draftemail(fromemail='', subject='Subject', 
+                                     pixelimage=False, message='<html><head>'
+                                     '</head><body></body></html>')
+            e = de._compile()
+            e.save()
+            with self.assertNumQueries(20):
+                e.send(Visitor.objects.filter(pk__in=pks[:n]))
+            self.assertEquals(e.recipient_count(), n)
+        
+        
+class SendJob_TestCase(base.LinkAnalytics_EmailTestCaseBase):
+    def setUp(self):
+        super(SendJob_TestCase, self).setUp()
+        django_email.outbox = []
+        self.visitors = []
+        for n in range(6):
+            v = Visitor(username='user'+str(n), 
+                        emailaddress='user{0}@example.com'.format(n))
+            v.save()
+            self.visitors.append(v)
+        self.old_chunk_size = app_settings.EMAIL_SEND_CHUNK_SIZE
+        app_settings.EMAIL_SEND_CHUNK_SIZE = 2
+        
+        de = self.new_draftemail(fromemail='', subject='Subject', 
+                                 pixelimage=False, message='<html><head>'
+                                 '</head><body></body></html>')
+        self.email = de._compile()
+        self.email.save()
+        
+    def tearDown(self):
+        app_settings.EMAIL_SEND_CHUNK_SIZE = self.old_chunk_size
+        super(SendJob_TestCase, self).tearDown()
+        
+    def recipients(self):
+        return Visitor.objects.filter(pk__in=[v.pk for v in self.visitors])
+        
+    def sent_to(self):
+        return sorted(m.to[0] for m in django_email.outbox)
+        
+    def addresses(self, *indices):
+        return sorted(self.visitors[n].emailaddress for n in indices)
+        
+    def expire_claim(self, job):
+        old = datetime.datetime.now() - datetime.timedelta(
+                        seconds=app_settings.EMAIL_SEND_JOB_TIMEOUT + 1)
+        SendJob.objects.filter(pk=job.pk).update(claimed=old)
+        
+    def run_interrupted(self, job, method, nth):
+        """Runs job, raising an exception from method of DeliveryPool or 
+           Renderer at its nth call."""
+        cls = DeliveryPool  if method == 'deliver' else  Renderer
+        old = getattr(cls, method)
+        calls = []
+        def interrupted(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == nth:
+                raise KeyboardInterrupt()
+            return old(*args, **kwargs)
+        setattr(cls, method, interrupted)
+        try:
+            self.assertRaises(KeyboardInterrupt, job.run)
+        finally:
+            setattr(cls, method, old)
+        
+    def test_run(self):
+        job = self.email.send(self.recipients())
+        self.assertNotEquals(job.finished, None)
+        self.assertEquals((job.sent, job.failed, job.uncertain), (6, 0, 0))
+        self.assertEquals(self.sent_to(), self.addresses(*range(6)))
+        self.assertEquals(job.sentrecord.recipients.count(), 6)
+        
+        # A finished job does nothing.
+        job.run()
+        self.assertEquals(len(django_email.outbox), 6)
+        
+    def test_interrupted_delivery(self):
+        job = SendJob.create(self.email, self.recipients())
+        self.run_interrupted(job, 'deliver', 2)
+        self.assertEquals(self.sent_to(), self.addresses(0, 1))
+        
+        # The interrupted chunk may have been sent, so it is skipped.
+        job = SendJob.objects.get(pk=job.pk)
+        job.run()
+        self.assertEquals(self.sent_to(), self.addresses(0, 1, 4, 5))
+        self.assertEquals((job.sent, job.failed, job.uncertain), (4, 0, 2))
+        self.assertEquals(TrackedInstance.objects.count(), 6)
+        self.assertEquals(job.sentrecord.recipients.count(), 4)
+        
+        # The skipped recipients can be sent the email later.
+        self.email.send(self.recipients())
+        self.assertEquals(self.sent_to(), self.addresses(*range(6)))
+        
+    def test_interrupted_rendering(self):
+        job = SendJob.create(self.email, self.recipients())
+        self.run_interrupted(job, 'render', 2)
+        self.assertEquals(self.sent_to(), self.addresses(0, 1))
+        self.assertEquals(TrackedInstance.objects.count(), 4)
+        
+        # The job is left alone while its claim lasts, since the process 
+        # running it might still be.
+        out = StringIO()
+        call_command('resume_send_jobs', stdout=out)
+        self.assertEquals(out.getvalue(), '')
+        self.expire_claim(job)
+        
+        # Nothing of the second chunk was sent, so it is sent on resuming, 
+        # without creating new instances.
+        call_command('resume_send_jobs', stdout=out)
+        self.assertEquals(out.getvalue(), 
+                          'SendJob {0}: sent 6, failed 0, '
+                          'uncertain 0.\n'.format(job.pk))
+        self.assertEquals(self.sent_to(), self.addresses(*range(6)))
+        self.assertEquals(TrackedInstance.objects.count(), 6)
+        self.assertFalse(TrackedInstance.objects.filter(notified=None).exists())
+
+    def test_claim(self):
+        job1 = SendJob.create(self.email, self.recipients(), queued=True)
+        job2 = SendJob.create(self.email, self.recipients(), queued=True)
+        self.assertEquals(SendJob.claim_next(), job1)
+        self.assertEquals(SendJob.claim_next(), job2)
+        self.assertEquals(SendJob.claim_next(), None)
+        
+        # An expired claim may be taken again.
+        self.expire_claim(job2)
+        self.assertEquals(SendJob.claim_next(), job2)
+        
+    def test_claim_lost(self):
+        job = SendJob.create(self.email, self.recipients())
+        old = DeliveryPool.deliver
+        def deliver(pool, messages):
+            # Another claim replaces the first while the first chunk is sent.
+            self.expire_claim(job)
+            return old(pool, messages)
+        DeliveryPool.deliver = deliver
+        try:
+            self.assertRaises(ClaimLost, job.run)
+        finally:
+            DeliveryPool.deliver = old
+            
+        # The first chunk was recorded, but no more was sent.
+        self.assertEquals(self.sent_to(), self.addresses(0, 1))
+        job = SendJob.objects.get(pk=job.pk)
+        self.assertEquals((job.sent, job.checkpoint), (2, 0))
+        self.assertEquals(job.finished, None)
+        
+        # The worker which took it sends the rest, once each.
+        job.run()
+        self.assertEquals(self.sent_to(), self.addresses(*range(6)))
+        self.assertEquals((job.sent, job.failed, job.uncertain), (6, 0, 0))
+        
+    def test_worker(self):
+        job = SendJob.create(self.email, self.recipients(), queued=True)
+        self.assertEquals(job.progress(), 
+                          {'sent': 0, 'failed': 0, 'uncertain': 0, 
+                           'remaining': 6, 'total': 6, 'finished': False})
+        
+        # Jobs run directly are not taken by workers.
+        self.email.send(Visitor.objects.filter(pk=self.visitors[0].pk))
+        
+        call_command('run_send_worker', once=True, stdout=StringIO())
+        job = SendJob.objects.get(pk=job.pk)
+        self.assertEquals(job.progress(), 
+                          {'sent': 5, 'failed': 0, 'uncertain': 0, 
+                           'remaining': 0, 'total': 6, 'finished': True})
+        self.assertEquals(self.sent_to(), self.addresses(*range(6)))
+
+
+#==============================================================================#
@@ -80,4 +80,61 @@ class InstantiateEmails_TestCase(base.LinkAnalytics_TestCaseBase):
         self.assertEquals(html, expecthtml)
 
         
-#==============================================================================#
\ No newline at end of file
+#==============================================================================#
+        
+class SegmentedInstantiator_TestCase(base.LinkAnalytics_TestCaseBase):
+    urlbase = 'http://example.com'
+    uuids = ['0'*32, '0123456789abcdef0123456789abcdef', 'f'*32]
+    
+    def assertSameEmails(self, textsrc, htmlsrc, **kwargs):
+        inst = _email.email_instantiator(textsrc, htmlsrc, self.urlbase, 
+                                         **kwargs)
+        seg = _email.segmented_email_instantiator(textsrc, htmlsrc, 
+                                                  self.urlbase, **kwargs)
+        for uuid in self.uuids:
+            self.assertEquals(seg(uuid), inst(uuid))
+            
+    def test_compiled(self):
+        html = "<html><head></head><body><p>Hello</p>"
+        html += "{% track 'url' 'http://example.com/a?b=1' %} "
+        html += "{% track 'trail' 'linkanalytics/r/path/to/file.ext' %} "
+        html += "{% track 'url' 'http://example.com/a?b=1' %}"
+        html += "</body></html>"
+        header = '<p>{% if 1 %}Header{% endif %}</p>'
+        text, html = _email.compile_email(html, pixelimage_type='png', 
+                                          html_header=header,
+                                          html_footer='<p>Footer</p>')
+        self.assertSameEmails(text, html)
+        self.assertSameEmails(text, html, disable_pixelimages=True)
+        
+    def test_rendered_once(self):
+        textsrc = "{% trackedurl linkid 'linkanalytics/r/path/to/file.ext' %}"
+        htmlsrc = "<a href=\"{0}\">{0}</a>".format(textsrc)
+        seg = _email.segmented_email_instantiator(textsrc, htmlsrc, 
+                                                  self.urlbase)
+        
+        # No template is rendered per email.
+        old, _email.Template = _email.Template, None
+        try:
+            text, html = seg(self.uuids[0])
+        finally:
+            _email.Template = old
+        url = urlex.hashedurl_redirect_local(self.uuids[0], 'path/to/file.ext')
+        self.assertEquals(text, self.urlbase + url)
+        self.assertEquals(html, '<a href="{0}">{0}</a>'.format(text))
+        
+    def test_fallback(self):
+        # The uuid itself, and tracked urls altered by a filter, are rendered 
+        # per email.
+        tag = "{% trackedurl linkid 'linkanalytics/r/file.ext' %}"
+        self.assertSameEmails('{{ linkid }}', '<p>{{ linkid }}</p>')
+        self.assertSameEmails('{% filter upper %}'+tag+'{% endfilter %}', tag)
+        self.assertSameEmails('{% filter slice:":30" %}'+tag+'{% endfilter %}', 
+                              tag)
+        
+    def test_invalid_trail(self):
+        tag = "{% trackedurl linkid '/not/a/valid/trail' %}"
+        self.assertSameEmails(tag, '<p>'+tag+'</p>')
+        
+        
+#==============================================================================#
@@ -8,7 +8,7 @@ from django.core.urlresolvers import reverse as urlreverse
 from linkanalytics.models import Tracker, TrackedInstance, Visitor
 from linkanalytics.email.models import DraftEmail, Email
 from linkanalytics import app_settings
-from linkanalytics import urlex
+from linkanalytics import urlex, instancecache
 
 from linkanalytics.tests.email import base
 
@@ -134,9 +134,40 @@ class Email_TestCase(base.LinkAnalytics_EmailTestCaseBase):
         
         self.assertEquals(src, '{0}{1}'.format(app_settings.URLBASE, url))
         
+    def test_send_primes_instancecache(self):
+        """Sending an email caches the new TrackedInstances."""
+        v = Visitor(username='user', emailaddress='user@example.com')
+        v.save()
+        de = DraftEmail(fromemail='', subject='Subject', pixelimage=False)
+        de.message = '<html><head></head><body></body></html>'
+        de.save()
+        de.pending_recipients.add(v)
+        de.send()
+        
+        i = TrackedInstance.objects.get(visitor=v)
+        with self.assertNumQueries(0):
+            ref = instancecache.lookup(i.uuid)
+        self.assertEquals(ref.pk, i.pk)
+        
+    def test_send_again(self):
+        """Recipients who were already sent an Email are skipped."""
+        v1 = Visitor(username='user1', emailaddress='user1@example.com')
+        v1.save()
+        v2 = Visitor(username='user2', emailaddress='user2@example.com')
+        v2.save()
+        de = DraftEmail(fromemail='', subject='Subject', pixelimage=False)
+        de.message = '<html><head></head><body></body></html>'
+        de.save()
+        de.pending_recipients.add(v1)
+        e = de.send()
+        self.assertEquals(len(django_email.outbox), 1)
+        
+        e.send(Visitor.objects.filter(pk__in=[v1.pk, v2.pk]))
+        self.assertEquals(len(django_email.outbox), 2)
+        self.assertEquals(django_email.outbox[1].to, ['user2@example.com'])
+        self.assertEquals(e.recipient_count(), 2)
+        
     # check that DraftEmails cannot be sent more than once
-    # check that the same email cannot be sent to the same recipient more than 
-    #   once
     # check that emails actually get sent
     # check that each recipient has a different uuid
     # check that EmailRecipients contains the new recipients of the email
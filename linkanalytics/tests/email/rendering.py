@@ -0,0 +1,179 @@
+# The sibling module email.py would otherwise hide the standard library's.
+from __future__ import absolute_import
+
+import email
+
+from django.core import mail as django_email
+from django.core.mail.backends.smtp import EmailBackend as SMTPBackend
+
+from linkanalytics.models import Visitor, TrackedInstance
+from linkanalytics import app_settings
+from linkanalytics.email import _email
+from linkanalytics.email.delivery import DeliveryPool
+from linkanalytics.email.rendering import Renderer, RenderPool
+from linkanalytics.email.rendering import MessageTemplate, PreparedMessage
+
+from linkanalytics.tests import base as testsbase
+from linkanalytics.tests.email import base
+from linkanalytics.tests.email.delivery import SMTPStandIn
+
+#==============================================================================#
+class MessageTemplate_TestCase(testsbase.LinkAnalytics_TestCaseBase):
+    urlbase = 'http://example.com'
+    uuids = ['0123456789abcdef0123456789abcdef', 'f'*32]
+    html = (u"<html><head></head><body><p>H\xe9llo</p>"
+            u"{% trackedurl linkid 'linkanalytics/r/path/to/file.ext' %}\n"
+            u"From {% trackedurl linkid 'linkanalytics/r/a' %}"
+            u"</body></html>")
+    text = u"{% trackedurl linkid 'linkanalytics/r/a' %} and more"
+
+    def template(self, text=None, html=None):
+        return MessageTemplate('Subject', 'from@example.com', 
+                               text or self.text, html or self.html, 
+                               self.urlbase)
+
+    def encoded(self, uuid, address, text=None, html=None):
+        """Returns the message encoded in full, as without a template."""
+        inst = _email.email_instantiator(text or self.text, html or self.html,
+                                         self.urlbase)
+        t, h = inst(uuid)
+        msg = _email.multipart_email('Subject', 'from@example.com', t, h,
+                                     address)
+        return msg.message().as_string()
+
+    def headers(self, data):
+        m = email.message_from_string(data)
+        return ([(k, v) for k, v in m.items() 
+                 if k not in ('Message-ID', 'Date', 'Content-Type')],
+                [p.items() for p in m.get_payload()])
+
+    def assertSameMessage(self, template, uuid, address, **kwargs):
+        data = template.render(uuid, address)
+        expected = self.encoded(uuid, address, **kwargs)
+        self.assertEquals(base.message_parts(data), 
+                          base.message_parts(expected))
+        self.assertEquals(self.headers(data), self.headers(expected))
+        return data
+
+    def test_render(self):
+        template = self.template()
+        self.assertNotEquals(template.parts, None)
+        for uuid in self.uuids:
+            self.assertSameMessage(template, uuid, 'user@example.com')
+
+        # Nothing is encoded per message.
+        old, _email.multipart_email = _email.multipart_email, None
+        try:
+            data = [template.render(uuid, 'user@example.com') 
+                    for uuid in self.uuids]
+        finally:
+            _email.multipart_email = old
+        m0, m1 = [email.message_from_string(d) for d in data]
+        self.assertNotEquals(m0['Message-ID'], m1['Message-ID'])
+        self.assertNotEquals(m0['Date'], None)
+        
+        msg = template.message(self.uuids[0], u'user@example.com')
+        self.assertTrue(isinstance(msg, PreparedMessage))
+        self.assertEquals(msg.to, [u'user@example.com'])
+        # The body and alternatives hold what was encoded.
+        text, html = base.message_parts(msg.message().as_string())[2]
+        self.assertEquals(msg.body.encode('utf-8'), text)
+        self.assertEquals(msg.alternatives, [(html.decode('utf-8'), 
+                                              'text/html')])
+
+    def test_unsafe_address(self):
+        template = self.template()
+        data = self.assertSameMessage(template, self.uuids[0], 
+                                      u'j\xf6rg@example.com')
+        self.assertTrue('=?utf-8?' in data)
+        self.assertSameMessage(template, self.uuids[0], 
+                               u'Someone <user@example.com>')
+
+    def test_unsplit(self):
+        text = u'{{ linkid }}'
+        template = self.template(text=text)
+        self.assertEquals(template.parts, None)
+        self.assertSameMessage(template, self.uuids[0], 'user@example.com', 
+                               text=text)
+
+
+#==============================================================================#
+class RenderPool_TestCase(base.LinkAnalytics_EmailTestCaseBase):
+    def setUp(self):
+        super(RenderPool_TestCase, self).setUp()
+        django_email.outbox = []
+        self.visitors = []
+        for n in range(5):
+            v = Visitor(username='user'+str(n),
+                        emailaddress='user{0}@example.com'.format(n))
+            v.save()
+            self.visitors.append(v)
+        html = ("<html><head></head><body><p>Hello</p>"
+                "{% track 'url' 'http://example.com/a?b=1' %} "
+                "{% track 'trail' 'linkanalytics/r/path/to/file.ext' %}"
+                "</body></html>")
+        de = self.new_draftemail(fromemail='from@example.com',
+                                 subject='Subject', pixelimage=True,
+                                 message=html)
+        self.email = de._compile()
+        self.email.save()
+
+    def instances(self):
+        self.email.tracker.add_visitors(self.visitors)
+        return list(TrackedInstance.objects.filter(tracker=self.email.tracker)
+                        .select_related('visitor').order_by('pk'))
+
+    def test_render(self):
+        instances = self.instances()
+        expected = [base.message_parts(m.data)
+                    for m in Renderer(self.email).render(instances)]
+        pool = RenderPool(self.email, 2)
+        try:
+            msgs = pool.render(instances)
+        finally:
+            pool.close()
+        self.assertEquals([m.to for m in msgs],
+                          [[v.emailaddress] for v in self.visitors])
+        self.assertEquals([base.message_parts(m.data) for m in msgs], expected)
+        self.assertEquals([m.alternatives[0][0].encode('utf-8') for m in msgs],
+                          [parts[2][-1] for parts in expected])
+        # Each message has its own tracked URLs.
+        self.assertTrue(instances[0].uuid in expected[0][2][1])
+        self.assertFalse(instances[0].uuid in expected[1][2][1])
+
+    def test_send(self):
+        old = app_settings.EMAIL_RENDER_PROCESSES
+        app_settings.EMAIL_RENDER_PROCESSES = 2
+        try:
+            job = self.email.send(Visitor.objects.all())
+        finally:
+            app_settings.EMAIL_RENDER_PROCESSES = old
+        self.assertEquals((job.sent, job.failed), (5, 0))
+        self.assertEquals(sorted(m.to[0] for m in django_email.outbox),
+                          sorted(v.emailaddress for v in self.visitors))
+        for m in django_email.outbox:
+            self.assertTrue(isinstance(m, PreparedMessage))
+            self.assertEquals(base.message_parts(m.data)[0], m.to[0])
+        self.assertFalse(TrackedInstance.objects.filter(notified=None).exists())
+
+    def test_smtp(self):
+        pool = RenderPool(self.email, 2)
+        try:
+            msgs = pool.render(self.instances()[:2])
+        finally:
+            pool.close()
+        server = SMTPStandIn()
+        try:
+            def factory():
+                return SMTPBackend(host='127.0.0.1', port=server.port)
+            results = DeliveryPool(workers=1,
+                                   connection_factory=factory).deliver(msgs)
+        finally:
+            server.stop()
+        self.assertEquals(results, [None, None])
+        self.assertEquals([base.message_parts(data) 
+                           for rcpttos, data in server.received],
+                          [base.message_parts(m.data) for m in msgs])
+
+
+#==============================================================================#
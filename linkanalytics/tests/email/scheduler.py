@@ -0,0 +1,141 @@
+import threading
+import time
+
+from django.core import mail as django_email
+from django.core.mail.backends.locmem import EmailBackend as LocmemBackend
+
+from linkanalytics.email.delivery import DeliveryPool
+from linkanalytics.email.scheduler import DeliveryScheduler, TokenBucket
+
+from linkanalytics.tests import base as testsbase
+
+#==============================================================================#
+class FakeClock(object):
+    """A clock which only moves when told to.  Its sleep() advances it."""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class ConcurrencyBackend(LocmemBackend):
+    """A locmem backend which takes a little while to send each message, and
+       records the most messages sent to each domain at the same time."""
+    lock = threading.Lock()
+    active = {}
+    peak = {}
+
+    def send_messages(self, messages):
+        domain = messages[0].to[0].rpartition('@')[2]
+        cls = ConcurrencyBackend
+        with cls.lock:
+            cls.active[domain] = cls.active.get(domain, 0) + 1
+            cls.peak[domain] = max(cls.peak.get(domain, 0),
+                                   cls.active[domain])
+        try:
+            time.sleep(0.005)
+            return super(ConcurrencyBackend, self).send_messages(messages)
+        finally:
+            with cls.lock:
+                cls.active[domain] -= 1
+
+
+def new_messages(*addresses):
+    return [django_email.EmailMessage('Subject', 'Body', 'from@example.com',
+                                      [a]) for a in addresses]
+
+def sent_to():
+    return [m.to[0] for m in django_email.outbox]
+
+#==============================================================================#
+class TokenBucket_TestCase(testsbase.LinkAnalytics_TestCaseBase):
+    def test_take(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, burst=3, clock=clock)
+        self.assertEquals([bucket.take() for i in range(4)],
+                          [True, True, True, False])
+        self.assertEquals(bucket.wait_time(), 0.5)
+        clock.sleep(0.5)
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+        # No more than burst tokens are saved up.
+        clock.sleep(60)
+        self.assertEquals([bucket.take() for i in range(4)],
+                          [True, True, True, False])
+
+
+#==============================================================================#
+class DeliveryScheduler_TestCase(testsbase.LinkAnalytics_TestCaseBase):
+    def setUp(self):
+        super(DeliveryScheduler_TestCase, self).setUp()
+        django_email.outbox = []
+
+    def test_interleave(self):
+        messages = new_messages('a1@a.com', 'a2@a.com', 'a3@a.com',
+                                'b1@b.com', 'b2@b.com', 'c1@C.com')
+        results = DeliveryPool(workers=1).deliver(messages)
+        self.assertEquals(results, [None] * 6)
+        self.assertEquals(sent_to(), ['a1@a.com', 'b1@b.com', 'c1@C.com',
+                                      'a2@a.com', 'b2@b.com', 'a3@a.com'])
+
+    def test_rate(self):
+        clock = FakeClock()
+        limits = {'slow.com': {'rate': 2, 'burst': 1},
+                  '*': {'rate': 10, 'burst': 5}}
+        scheduler = DeliveryScheduler(limits, clock=clock, sleep=clock.sleep)
+        pool = DeliveryPool(workers=1, scheduler=scheduler)
+        addresses = ['s{0}@slow.com'.format(n) for n in range(3)] + \
+                    ['f{0}@fast.com'.format(n) for n in range(10)]
+        results = pool.deliver(new_messages(*addresses))
+        self.assertEquals(results, [None] * 13)
+
+        # slow.com is sent one message at first, then one every half second,
+        # while fast.com is sent its burst and then ten per second.
+        self.assertEquals(sent_to()[:7], ['s0@slow.com', 'f0@fast.com',
+                    'f1@fast.com', 'f2@fast.com', 'f3@fast.com', 'f4@fast.com',
+                    'f5@fast.com'])
+        self.assertEquals(sorted(sent_to()), sorted(addresses))
+        self.assertAlmostEquals(clock.now - 1000.0, 1.0)
+
+        stats = scheduler.stats()
+        self.assertEquals(stats['slow.com']['sent'], 3)
+        self.assertEquals(stats['slow.com']['failed'], 0)
+        self.assertAlmostEquals(stats['slow.com']['seconds'], 1.0)
+        self.assertAlmostEquals(stats['slow.com']['rate'], 3.0)
+        self.assertEquals(stats['fast.com']['sent'], 10)
+        self.assertAlmostEquals(stats['fast.com']['seconds'], 0.5)
+
+        # The buckets are kept between deliveries.
+        django_email.outbox = []
+        pool.deliver(new_messages('s3@slow.com', 's4@slow.com'))
+        self.assertAlmostEquals(clock.now - 1000.0, 2.0)
+        self.assertEquals(scheduler.stats()['slow.com']['sent'], 5)
+
+    def test_invalid_limits(self):
+        for limits in ({'a.com': {'rate': 0}}, {'*': {'concurrency': 0}},
+                       {'a.com': {'rate': 1, 'burst': 0}}):
+            self.assertRaises(ValueError, DeliveryScheduler, limits)
+        DeliveryScheduler({'a.com': {'rate': 0.5, 'concurrency': None}})
+
+    def test_concurrency(self):
+        ConcurrencyBackend.active = {}
+        ConcurrencyBackend.peak = {}
+        scheduler = DeliveryScheduler({'a.com': {'concurrency': 1},
+                                       '*': {'concurrency': 2}})
+        pool = DeliveryPool(workers=4, connection_factory=ConcurrencyBackend,
+                            scheduler=scheduler)
+        addresses = ['u{0}@a.com'.format(n) for n in range(8)] + \
+                    ['u{0}@b.com'.format(n) for n in range(8)]
+        results = pool.deliver(new_messages(*addresses))
+        self.assertEquals(results, [None] * 16)
+        self.assertEquals(sorted(sent_to()), sorted(addresses))
+        self.assertEquals(ConcurrencyBackend.peak['a.com'], 1)
+        self.assertTrue(ConcurrencyBackend.peak['b.com'] <= 2)
+        self.assertEquals(scheduler.stats()['b.com']['sent'], 8)
+
+
+#==============================================================================#
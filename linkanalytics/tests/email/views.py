@@ -2,9 +2,14 @@
     Tests for normal views as well as targetviews.
 """
 
+import json
+from StringIO import StringIO
+
+from django.core import mail as django_email
+from django.core.management import call_command
 from django.core.urlresolvers import reverse as urlreverse
 
-from linkanalytics.models import TrackedInstance, Visitor
+from linkanalytics.models import TrackedInstance, Visitor, _ACCESS_SUCCESS
 from linkanalytics.email.models import Email, DraftEmail
 
 from linkanalytics.tests.email import base
@@ -180,10 +185,45 @@ class ComposeEmail_TestCase(base.LinkAnalytics_EmailTestCaseBase):
             self.assertEquals(draft.pending_recipients.all()[0].emailaddress, 
                               'other@example.com')
     
+    def test_send(self):
+        # Sending only queues the email; a send worker sends it.
+        self.create_users(1)
+        t = Visitor(username='visitor', emailaddress='visitor@example.com')
+        t.save()
+        with self.scoped_login('user0', 'password'):
+            url = urlreverse('linkanalytics-email-compose')
+            data = {'do_send':'', 'to':'visitor', 'message':'Message.'}
+            response = self.client.post(url, data)
+            self.assertEquals(response.status_code, 302)
+            self.assertEquals(len(django_email.outbox), 0)
+            
+            e = Email.objects.get()
+            url = urlreverse('linkanalytics-email-sendprogress', 
+                             kwargs={'emailid':e.pk})
+            response = self.client.get(url)
+            self.assertEquals(json.loads(response.content), 
+                              {'sent': 0, 'failed': 0, 'uncertain': 0, 
+                               'remaining': 1, 'total': 1, 'finished': False})
+            
+            call_command('run_send_worker', once=True, stdout=StringIO())
+            self.assertEquals(len(django_email.outbox), 1)
+            response = self.client.get(url)
+            self.assertEquals(json.loads(response.content), 
+                              {'sent': 1, 'failed': 0, 'uncertain': 0, 
+                               'remaining': 0, 'total': 1, 'finished': True})
+        self.assertTrue(DraftEmail.objects.get().sent)
+        
+    def test_progress_unknown(self):
+        self.create_users(1)
+        with self.scoped_login('user0', 'password'):
+            url = urlreverse('linkanalytics-email-sendprogress', 
+                             kwargs={'emailid':1})
+            response = self.client.get(url)
+            self.assertEquals(response.status_code, 404)
+    
     # Hidden pixel
     # Headers and Footers
     # Save button
-    # Send button
     
 class ViewSentEmails_TestCase(base.LinkAnalytics_EmailTestCaseBase):
     def test_basic(self):
@@ -237,6 +277,25 @@ class ViewSentEmails_TestCase(base.LinkAnalytics_EmailTestCaseBase):
             pks = [response.context['emails'][i].pk for i in range(3)]
             pks.sort()
             self.assertEquals(ids, pks)
+            
+    def test_counts(self):
+        # The read/unread/recipient counts are read with the emails.
+        self.create_users(1)
+        u = self.new_tracker('tracker')
+        e = Email(tracker=u, subject='X', txtmsg='Y', htmlmsg='Z')
+        e.save()
+        i = u.add_visitor(self.new_visitor('visitor1'))
+        u.add_visitor(self.new_visitor('visitor2'))
+        i.on_access(_ACCESS_SUCCESS, '')
+        with self.scoped_login('user0', 'password'):
+            url = urlreverse('linkanalytics-email-viewsent')
+            response = self.client.get(url)
+            self.assertEquals(response.status_code, 200)
+            e = response.context['emails'][0]
+            with self.assertNumQueries(0):
+                self.assertEquals(e.read_count(), 1)
+                self.assertEquals(e.unread_count(), 1)
+                self.assertEquals(e.recipient_count(), 2)
     
 class ViewDraftEmails_TestCase(base.LinkAnalytics_EmailTestCaseBase):
     def test_basic(self):
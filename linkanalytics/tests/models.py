@@ -1,11 +1,20 @@
 import datetime
+import hmac
 
-from django.db import IntegrityError
+from StringIO import StringIO
+
+from django.db import IntegrityError, connection
+from django.core import serializers
+from django.core.management import call_command
+from django.core.urlresolvers import reverse as urlreverse, NoReverseMatch
+from django.core.urlresolvers import get_script_prefix, set_script_prefix
 
 from linkanalytics.models import Tracker, TrackedInstance, Visitor, Access
 from linkanalytics.models import _ACCESS_SUCCESS, _ACCESS_FAILURE_UUID
 from linkanalytics.models import _ACCESS_FAILURE_HASH, _ACCESS_ERROR_TARGETVIEW
-from linkanalytics import urlex
+from linkanalytics.models import AccessSummary, TrackerStats, AccessHistogram
+from linkanalytics.models import new_access, save_accesses
+from linkanalytics import urlex, app_settings, instancecache
 
 import base
 
@@ -94,9 +103,195 @@ class TrackedInstance_TestCase(base.LinkAnalytics_DBTestCaseBase):
         self.assertEquals(i.access_count, 2)
         self.assertEquals(i.was_accessed(), True)
         
-       
-        
         
+class UuidStorage_TestCase(base.LinkAnalytics_DBTestCaseBase):
+    def setUp(self):
+        super(UuidStorage_TestCase, self).setUp()
+        t = self.new_tracker('tracker')
+        self.instances = [t.add_visitor(self.new_visitor('visitor'+str(n)))
+                          for n in range(3)]
+        self.old_storage = app_settings.UUID_STORAGE
+        instancecache.clear()
+        
+    def tearDown(self):
+        app_settings.UUID_STORAGE = self.old_storage
+        instancecache.clear()
+        super(UuidStorage_TestCase, self).tearDown()
+        
+    def stored_uuids(self):
+        cursor = connection.cursor()
+        cursor.execute('SELECT uuid FROM {0} ORDER BY id'.format(
+                            TrackedInstance._meta.db_table))
+        return [row[0] for row in cursor.fetchall()]
+        
+    def convert(self, storage):
+        call_command('convert_uuid_storage', storage, stdout=StringIO())
+        app_settings.UUID_STORAGE = storage
+        
+    def test_binary(self):
+        self.convert('binary')
+        uuids = [i.uuid for i in self.instances]
+        self.assertEquals([str(u) for u in self.stored_uuids()], 
+                          [u.decode('hex') for u in uuids])
+        
+        # Instances are loaded and looked up by their hexadecimal uuids.
+        i = self.instances[1]
+        self.assertEquals(TrackedInstance.objects.get(pk=i.pk).uuid, i.uuid)
+        self.assertEquals(TrackedInstance.objects.get(uuid=i.uuid).pk, i.pk)
+        self.assertEquals(instancecache.lookup(i.uuid).uuid, i.uuid)
+        refs = instancecache.lookup_many(uuids)
+        self.assertEquals(sorted(refs), sorted(uuids))
+        
+        t = self.new_tracker('tracker2')
+        n = t.add_visitor(self.new_visitor('visitor3'))
+        self.assertEquals(len(n.uuid), 32)
+        self.assertEquals(TrackedInstance.objects.get(uuid=n.uuid), n)
+        
+    def test_round_trip(self):
+        uuids = self.stored_uuids()
+        self.convert('binary')
+        self.convert('char')
+        self.assertEquals(self.stored_uuids(), uuids)
+        
+        i = self.instances[0]
+        self.assertEquals(TrackedInstance.objects.get(uuid=i.uuid).pk, i.pk)
+        
+    def test_bad_storage(self):
+        # call_command() reports the CommandError and exits.
+        self.assertRaises(SystemExit, call_command, 'convert_uuid_storage', 
+                          'hex', stdout=StringIO(), stderr=StringIO())
+        self.assertEquals(self.stored_uuids(), 
+                          [i.uuid for i in self.instances])
+        
+class AccessSummary_TestCase(base.LinkAnalytics_DBTestCaseBase):
+    def setUp(self):
+        super(AccessSummary_TestCase, self).setUp()
+        t = self.new_tracker('tracker')
+        v = self.new_visitor('visitor')
+        self.instance = t.add_visitor(v)
+        
+    def new_access(self, days_ago, result=_ACCESS_SUCCESS):
+        time = datetime.datetime(2011, 6, 15) - datetime.timedelta(days_ago)
+        return new_access(self.instance.pk, result, '', time=time)
+        
+    def test_batch(self):
+        # Accesses need not arrive in order.
+        save_accesses([self.new_access(3), self.new_access(5), 
+                       self.new_access(1, _ACCESS_ERROR_TARGETVIEW)])
+        save_accesses([self.new_access(7), self.new_access(2)])
+        
+        s = self.instance.access_summary()
+        self.assertEquals(s.success_count, 4)
+        self.assertEquals(s.failure_count, 1)
+        self.assertEquals(s.first_success, datetime.datetime(2011, 6, 8))
+        self.assertEquals(s.last_success, datetime.datetime(2011, 6, 13))
+        
+    def test_raw_save(self):
+        # Accesses loaded from fixtures are added to the totals too.
+        data = serializers.serialize('json', [self.new_access(3)])
+        for obj in serializers.deserialize('json', data):
+            obj.save()
+        self.assertEquals(self.instance.access_count, 1)
+        self.assertEquals(self.instance.first_access, 
+                          datetime.datetime(2011, 6, 12))
+        
+    def test_properties(self):
+        save_accesses([self.new_access(3), self.new_access(5)])
+        
+        # Each property reads the summary, rather than aggregating Accesses.
+        with self.assertNumQueries(1):
+            self.assertEquals(self.instance.access_count, 2)
+            
+        # A summary loaded with select_related needs no further queries.
+        qs = TrackedInstance.objects.select_related('summary')
+        i = qs.get(pk=self.instance.pk)
+        with self.assertNumQueries(0):
+            self.assertEquals(i.first_access, datetime.datetime(2011, 6, 10))
+            self.assertEquals(i.recent_access, datetime.datetime(2011, 6, 12))
+            self.assertEquals(i.access_count, 2)
+        
+    def test_rebuild(self):
+        save_accesses([self.new_access(3), self.new_access(5)])
+        self.new_access(9).save()
+        self.new_access(4, _ACCESS_FAILURE_HASH).save()
+        expected = self.instance.access_summary()
+        
+        # Accesses deleted directly are only reflected after a rebuild.
+        AccessSummary.objects.all().delete()
+        self.assertEquals(self.instance.access_count, 0)
+        self.assertEquals(AccessSummary.rebuild(), 1)
+        s = self.instance.access_summary()
+        for f in ('success_count', 'first_success', 'last_success', 
+                  'failure_count'):
+            self.assertEquals(getattr(s, f), getattr(expected, f))
+            
+        Access.objects.filter(time__lt=datetime.datetime(2011, 6, 8)).delete()
+        call_command('rebuild_access_summaries', str(self.instance.pk), 
+                     stdout=StringIO())
+        self.assertEquals(self.instance.access_count, 2)
+        self.assertEquals(self.instance.first_access, 
+                          datetime.datetime(2011, 6, 10))
+        
+class AccessHistogram_TestCase(base.LinkAnalytics_DBTestCaseBase):
+    def setUp(self):
+        super(AccessHistogram_TestCase, self).setUp()
+        self.tracker = self.new_tracker('tracker')
+        self.instance = self.tracker.add_visitor(self.new_visitor('visitor'))
+        
+    def new_access(self, day, hour, minute=0, result=_ACCESS_SUCCESS):
+        time = datetime.datetime(2011, 6, day, hour, minute)
+        return new_access(self.instance.pk, result, '', time=time)
+        
+    def test_series(self):
+        save_accesses([self.new_access(1, 9, 10), self.new_access(1, 9, 50), 
+                       self.new_access(1, 11), self.new_access(3, 0)])
+        self.new_access(1, 9, 30, _ACCESS_FAILURE_HASH).save()
+        t = self.tracker
+        
+        D = datetime.datetime
+        self.assertEquals(t.access_histogram('hour'), 
+                          [(D(2011,6,1,9), 2), (D(2011,6,1,11), 1), 
+                           (D(2011,6,3,0), 1)])
+        self.assertEquals(t.access_histogram('day', result=None), 
+                          [(D(2011,6,1), 4), (D(2011,6,3), 1)])
+        self.assertEquals(t.access_histogram('day', fill=True), 
+                          [(D(2011,6,1), 3), (D(2011,6,2), 0), 
+                           (D(2011,6,3), 1)])
+        self.assertEquals(t.access_histogram('hour', start=D(2011,6,1,9,30), 
+                                             end=D(2011,6,1,12), fill=True), 
+                          [(D(2011,6,1,9), 2), (D(2011,6,1,10), 0), 
+                           (D(2011,6,1,11), 1)])
+        
+    def test_rebuild(self):
+        save_accesses([self.new_access(1, 9), self.new_access(1, 10), 
+                       self.new_access(1, 10, 5, _ACCESS_ERROR_TARGETVIEW)])
+        expected = self.tracker.access_histogram('hour', result=None)
+        
+        AccessHistogram.objects.all().delete()
+        self.assertEquals(self.tracker.access_histogram('hour'), [])
+        # Three hourly rows and two daily rows.
+        self.assertEquals(AccessHistogram.rebuild(), 5)
+        self.assertEquals(self.tracker.access_histogram('hour', result=None), 
+                          expected)
+        
+        Access.objects.filter(result=_ACCESS_SUCCESS).delete()
+        call_command('rebuild_access_histograms', str(self.tracker.pk), 
+                     stdout=StringIO())
+        self.assertEquals(self.tracker.access_histogram('day'), [])
+        self.assertEquals(self.tracker.access_histogram('day', result=None), 
+                          [(datetime.datetime(2011, 6, 1), 1)])
+        
+    def test_no_time(self):
+        # Accesses without a time are counted, but not in any period.
+        save_accesses([self.new_access(1, 9), 
+                       Access(instance=self.instance, time=None, count=1, 
+                              url='', result=_ACCESS_SUCCESS)])
+        s = self.instance.access_summary()
+        self.assertEquals(s.success_count, 2)
+        self.assertEquals(s.last_success, datetime.datetime(2011, 6, 1, 9))
+        self.assertEquals(self.tracker.access_histogram('hour'), 
+                          [(datetime.datetime(2011, 6, 1, 9), 1)])
+        self.assertEquals(AccessHistogram.rebuild(), 2)
         
 #==============================================================================#
         
@@ -126,6 +321,63 @@ class Visitor_TestCase(base.LinkAnalytics_DBTestCaseBase):
 #==============================================================================#
 
 class Tracker_TestCase(base.LinkAnalytics_DBTestCaseBase):
+    def test_add_visitors(self):
+        t = self.new_tracker('tracker')
+        vs = [self.new_visitor('visitor'+str(n)) for n in range(5)]
+        old = t.add_visitor(vs[1])
+        
+        # For each batch, one query for the existing instances, an INSERT 
+        # and reading back the primary keys, then updating the TrackerStats.
+        with self.assertNumQueries(4):
+            instances = t.add_visitors(vs + [vs[0]])
+            
+        # Visitors who already have an instance, and repeats, are skipped.
+        self.assertEquals([i.visitor for i in instances], 
+                          [vs[0], vs[2], vs[3], vs[4]])
+        self.assertEquals(len(set(i.uuid for i in instances)), 4)
+        for i in instances:
+            self.assertEquals(TrackedInstance.objects.get(uuid=i.uuid).pk, 
+                              i.pk)
+        self.assertEquals(TrackedInstance.objects.get(visitor=vs[1]), old)
+        self.assertEquals(t.access_stats().recipients, 5)
+        self.assertEquals(t.add_visitors(vs), [])
+        
+    def test_add_visitors_batches(self):
+        from linkanalytics import models
+        t = self.new_tracker('tracker')
+        vs = [self.new_visitor('visitor'+str(n)) for n in range(5)]
+        old, models._INSTANCE_BATCH_SIZE = models._INSTANCE_BATCH_SIZE, 2
+        try:
+            with self.assertNumQueries(10):
+                instances = t.add_visitors(vs)
+        finally:
+            models._INSTANCE_BATCH_SIZE = old
+        self.assertEquals([i.visitor for i in instances], vs)
+        self.assertEquals(t.visitors.count(), 5)
+        self.assertEquals(t.access_stats().recipients, 5)
+        
+    def test_add_visitors_bounded(self):
+        # Adding a chunk of visitors only reads the instances of that chunk, 
+        # however many instances the Tracker already has.
+        t = self.new_tracker('tracker')
+        t.add_visitors([self.new_visitor('old'+str(n)) for n in range(20)])
+        vs = [self.new_visitor('visitor0'), self.new_visitor('visitor1')]
+        t.add_visitor(vs[0])
+        old = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            with self.assertNumQueries(4):
+                instances = t.add_visitors(vs)
+            sql = connection.queries[start]['sql']
+        finally:
+            connection.use_debug_cursor = old
+        self.assertEquals([i.visitor for i in instances], [vs[1]])
+        self.assertEquals(TrackedInstance.objects.filter(tracker=t, 
+                                visitor__in=[v.pk for v in vs]).count(), 2)
+        self.assertTrue('IN ({0}, {1})'.format(vs[0].pk, vs[1].pk) in sql, 
+                        sql)
+        
     def test_visitors(self):
         # Check the Tracker.visitors attribute
         t1 = self.new_tracker('tracker1')
@@ -212,6 +464,58 @@ class Tracker_TestCase(base.LinkAnalytics_DBTestCaseBase):
         self.assertEquals(t1.instances_read().count(), 1)
         
         
+class TrackerStats_TestCase(base.LinkAnalytics_DBTestCaseBase):
+    def assertStats(self, tracker, recipients, read, accesses):
+        s = tracker.access_stats()
+        self.assertEquals((s.recipients, s.read, s.unread, s.accesses), 
+                          (recipients, read, recipients-read, accesses))
+        
+    def test_maintained(self):
+        t = self.new_tracker('tracker')
+        self.assertStats(t, 0, 0, 0)
+        
+        i1 = t.add_visitor(self.new_visitor('visitor1'))
+        i2 = t.add_visitor(self.new_visitor('visitor2'))
+        self.assertStats(t, 2, 0, 0)
+        self.assertEquals(t.instances_unread().count(), 2)
+        
+        # Only the first successful access of an instance marks it read.
+        i1.on_access(_ACCESS_SUCCESS, '')
+        i1.on_access(_ACCESS_SUCCESS, '')
+        i2.on_access(_ACCESS_ERROR_TARGETVIEW, '')
+        self.assertStats(t, 2, 1, 2)
+        self.assertEquals(list(t.instances_read()), [i1])
+        self.assertEquals(list(t.instances_unread()), [i2])
+        
+        i1.delete()
+        self.assertStats(t, 1, 0, 0)
+        
+        # Bulk deletes are only counted once the stats are reconciled.
+        TrackedInstance.objects.filter(pk=i2.pk).delete()
+        self.assertStats(t, 1, 0, 0)
+        self.assertEquals(TrackerStats.reconcile([t.pk]), 1)
+        self.assertStats(t, 0, 0, 0)
+        
+    def test_reconcile(self):
+        t = self.new_tracker('tracker')
+        i = t.add_visitor(self.new_visitor('visitor1'))
+        t.add_visitor(self.new_visitor('visitor2'))
+        i.on_access(_ACCESS_SUCCESS, '')
+        
+        TrackerStats.objects.filter(tracker=t).update(read=0, recipients=7)
+        self.assertEquals(TrackerStats.reconcile(), 1)
+        self.assertStats(t, 2, 1, 1)
+        self.assertEquals(TrackerStats.reconcile(), 0)
+        
+        # Missing stats are computed when first needed.
+        TrackerStats.objects.all().delete()
+        self.assertStats(t, 2, 1, 1)
+        
+        TrackerStats.objects.filter(tracker=t).update(accesses=5)
+        call_command('reconcile_tracker_stats', str(t.pk), stdout=StringIO())
+        self.assertStats(t, 2, 1, 1)
+        
+        
 #==============================================================================#
 class GenerateHash_TestCase(base.LinkAnalytics_TestCaseBase):
     def test_basic(self):
@@ -226,6 +530,141 @@ class GenerateHash_TestCase(base.LinkAnalytics_TestCaseBase):
         b = urlex.generate_urlhash(i,s)
         
         self.assertEquals(a, b)
+        
+    def test_validate(self):
+        from linkanalytics.models import _create_uuid
+        i = _create_uuid()
+        s = 'This is some data to be hashed.'
+        
+        a = urlex.generate_urlhash(i,s)
+        
+        self.assertTrue(urlex.validate_urlhash(a, i, s))
+        self.assertFalse(urlex.validate_urlhash(a, i, s+'.'))
+        self.assertFalse(urlex.validate_urlhash(a, _create_uuid(), s))
+        self.assertFalse(urlex.validate_urlhash(a[:-1], i, s))
+        
+    def test_keyed_hmac(self):
+        # Hashes from the pre-keyed HMAC match those computed directly.
+        from linkanalytics.models import _create_uuid
+        i = _create_uuid()
+        s = '/linkanalytics/ppx/'
+        expected = hmac.new(app_settings.SECRET_KEY, i+s, 
+                            app_settings.DIGEST_CTOR).hexdigest()
+        self.assertEquals(urlex.generate_urlhash(i, s), expected)
+        self.assertEquals(urlex.generate_urlhash(i, s), expected)
+        
+        
+class HashedUrls_TestCase(base.LinkAnalytics_TestCaseBase):
+    def reversed_url(self, uuid, urltail):
+        hash = urlex.generate_urlhash(uuid, urltail)
+        kwargs = { 'hash': hash, 'uuid': uuid, 'tailpath': urltail[1:] }
+        return urlreverse('linkanalytics-accesshashedview', kwargs=kwargs)
+        
+    def test_builder(self):
+        from linkanalytics.models import _create_uuid
+        uuids = [_create_uuid() for n in range(3)]
+        tails = [urlex.urltail_pixelpng(), 
+                 urlex.urltail_redirect_http('www.example.com', 'a/b.html'), 
+                 urlex.urltail_html('email/access-thankyou.html')]
+        for tail in tails:
+            b = urlex.HashedUrlBuilder(tail)
+            for uuid in uuids:
+                self.assertEquals(b(uuid), self.reversed_url(uuid, tail))
+            self.assertEquals(urlex.create_hashedurls_for_tail(tail, uuids), 
+                              [self.reversed_url(u, tail) for u in uuids])
+                              
+        pairs = [(u, t) for u in uuids for t in tails]
+        self.assertEquals(urlex.create_hashedurls(pairs), 
+                          [self.reversed_url(u, t) for u, t in pairs])
+                          
+    def test_script_prefix(self):
+        from linkanalytics.models import _create_uuid
+        uuid = _create_uuid()
+        tail = urlex.urltail_pixelgif()
+        old = get_script_prefix()
+        set_script_prefix('/site/')
+        try:
+            url = urlex.create_hashedurl(uuid, tail)
+            self.assertTrue(url.startswith('/site/'))
+            self.assertEquals(url, self.reversed_url(uuid, tail))
+        finally:
+            set_script_prefix(old)
+        self.assertEquals(urlex.create_hashedurl(uuid, tail), 
+                          self.reversed_url(uuid, tail))
+        
+    def test_bad_urltail(self):
+        self.assertRaises(NoReverseMatch, urlex.HashedUrlBuilder, '/a b/')
+        
+    def test_compact(self):
+        from linkanalytics.models import _create_uuid
+        uuid = _create_uuid()
+        tail = urlex.urltail_pixelgif()
+        hexurl = urlex.create_hashedurl(uuid, tail)
+        old = app_settings.URL_TOKEN_FORMAT
+        app_settings.URL_TOKEN_FORMAT = 'compact'
+        try:
+            url = urlex.create_hashedurl(uuid, tail)
+        finally:
+            app_settings.URL_TOKEN_FORMAT = old
+            
+        hash, cuuid = url.split('/')[1:3]
+        self.assertEquals(len(cuuid), 22)
+        self.assertEquals(urlex.parse_uuid(cuuid), uuid)
+        self.assertEquals(urlex.parse_uuid(uuid), uuid)
+        self.assertEquals(len(hash), 2+16)
+        self.assertTrue(urlex.validate_urlhash(hash, uuid, tail))
+        self.assertTrue(len(url) < len(hexurl) - 30)
+        
+        # The truncated MAC must have exactly the configured length.
+        self.assertFalse(urlex.validate_urlhash(hash[:-1], uuid, tail))
+        self.assertFalse(urlex.validate_urlhash(hash+'A', uuid, tail))
+        self.assertFalse(urlex.validate_urlhash(hash, uuid, tail+'/'))
+        
+    def test_parse_uuid(self):
+        uuid = '0123456789abcdef0123456789abcdef'
+        cuuid = urlex.compact_uuid(uuid)
+        self.assertEquals(cuuid, 'ASNFZ4mrze8BI0VniavN7w')
+        self.assertEquals(urlex.parse_uuid(cuuid), uuid)
+        # Invalid and non-canonical encodings are rejected.
+        self.assertEquals(urlex.parse_uuid(cuuid[:-1]+'x'), None)
+        self.assertEquals(urlex.parse_uuid('!'*22), None)
+        self.assertEquals(urlex.parse_uuid(u'\xe9'*22), None)
+        
+        
+class Urltails_TestCase(base.LinkAnalytics_TestCaseBase):
+    def reversed_tail(self, name, **kwargs):
+        return urlreverse(name, urlconf=app_settings.TARGETS_URLCONF, 
+                          kwargs=kwargs)
+        
+    def test_constant(self):
+        self.assertEquals(urlex.urltail_pixelgif(), 
+                          self.reversed_tail('targetview-pixelgif'))
+        self.assertEquals(urlex.urltail_pixelpng(), 
+                          self.reversed_tail('targetview-pixelpng'))
+        self.assertEquals(urlex.constant_urltail('targetview-email-render'), 
+                          self.reversed_tail('targetview-email-render'))
+        
+    def test_format(self):
+        cases = [ ('redirect-http', {'domain': 'www.example.com', 
+                                     'filepath': 'a/b.html'}), 
+                  ('redirect-http', {'domain': 'example.com:8080', 
+                                     'filepath': ''}), 
+                  ('redirect-https', {'domain': 'www.example.com', 
+                                      'filepath': 'a/'}), 
+                  ('redirect-local', {'filepath': 'linkanalytics/testurl/'}), 
+                  ('targetview-html', {'filepath': 'email/a.html'}), ]
+        for name, kwargs in cases:
+            f = urlex.urltail_format(name, sorted(kwargs), 
+                                     app_settings.TARGETS_URLCONF)
+            self.assertNotEquals(f.format, None)
+            self.assertEquals(f.build(**kwargs), 
+                              self.reversed_tail(name, **kwargs))
+            
+    def test_invalid(self):
+        # Arguments not matching the target pattern are still rejected.
+        self.assertRaises(NoReverseMatch, urlex.urltail_redirect_http, 
+                          'no_tld', 'a.html')
+        self.assertRaises(NoReverseMatch, urlex.urltail_html, 'a b.html')
     
 #==============================================================================#
 
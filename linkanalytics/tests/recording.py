@@ -0,0 +1,218 @@
+"""
+    Tests for recording accesses.
+"""
+
+from django.db import DatabaseError
+
+from linkanalytics.models import Access, AccessFailureCount, TrackedInstance
+from linkanalytics.models import _ACCESS_SUCCESS, _ACCESS_ERROR_TARGETVIEW
+from linkanalytics.models import _ACCESS_FAILURE_UUID, _ACCESS_FAILURE_HASH
+from linkanalytics.accessrecorder import AccessRecorder
+from linkanalytics import accessrecorder, instancecache
+
+import base
+
+#==============================================================================#
+class FakeClock(object):
+    """A clock whose time only changes when told to."""
+    def __init__(self):
+        self.now = 1000.0
+    def __call__(self):
+        return self.now
+    def advance(self, seconds):
+        self.now += seconds
+
+#==============================================================================#
+class AccessRecorder_TestCase(base.LinkAnalytics_DBTestCaseBase):
+    def setUp(self):
+        super(AccessRecorder_TestCase, self).setUp()
+        t = self.new_tracker('tracker')
+        v = self.new_visitor('visitor')
+        self.instance = t.add_visitor(v)
+        self.clock = FakeClock()
+
+    def new_recorder(self, **kwargs):
+        kwargs.setdefault('background', False)
+        kwargs.setdefault('clock', self.clock)
+        return AccessRecorder(**kwargs)
+
+    def test_synchronous(self):
+        r = self.new_recorder(synchronous=True)
+        r.record(self.instance.pk, _ACCESS_SUCCESS, '')
+
+        self.assertEquals(Access.objects.count(), 1)
+        self.assertEquals(r.pending(), 0)
+        self.assertEquals(r.flushed, 1)
+        self.assertEquals(self.instance.access_count, 1)
+
+    def test_batch_size(self):
+        r = self.new_recorder(batch_size=3)
+        tracker_id = self.instance.tracker_id
+        r.record(self.instance.pk, _ACCESS_SUCCESS, '', tracker_id)
+        r.record(self.instance.pk, _ACCESS_ERROR_TARGETVIEW, '', tracker_id)
+
+        # Nothing is written until the batch is full.
+        self.assertEquals(Access.objects.count(), 0)
+        self.assertEquals(r.pending(), 2)
+
+        # One bulk INSERT, plus reading and writing the AccessSummary, 
+        # updating the TrackerStats, and creating the hourly and daily 
+        # AccessHistograms for both results.  The Tracker is known already.
+        with self.assertNumQueries(12):
+            r.record(self.instance.pk, _ACCESS_SUCCESS, '', tracker_id)
+
+        self.assertEquals(Access.objects.count(), 3)
+        self.assertEquals(r.pending(), 0)
+        self.assertEquals(r.flushed, 3)
+        self.assertEquals(self.instance.access_count, 2)
+
+    def test_flush_interval(self):
+        r = self.new_recorder(batch_size=100, flush_interval=5.0)
+        r.record(self.instance.pk, _ACCESS_SUCCESS, '')
+        self.assertEquals(Access.objects.count(), 0)
+
+        self.clock.advance(6)
+        r.record(self.instance.pk, _ACCESS_SUCCESS, '')
+        self.assertEquals(Access.objects.count(), 2)
+
+    def test_buffer_limit(self):
+        r = self.new_recorder(batch_size=100, buffer_limit=2)
+        for i in range(5):
+            r.record(self.instance.pk, _ACCESS_SUCCESS, '')
+
+        self.assertEquals(r.pending(), 2)
+        self.assertEquals(r.dropped, 3)
+
+        self.assertEquals(r.flush(), 2)
+        self.assertEquals(r.stats(),
+                          {'pending': 0, 'flushed': 2, 'dropped': 3})
+        self.assertEquals(Access.objects.count(), 2)
+
+    def test_close(self):
+        r = self.new_recorder(batch_size=100)
+        r.record(self.instance.pk, _ACCESS_SUCCESS, '')
+        r.close()
+        self.assertEquals(Access.objects.count(), 1)
+
+        # Once closed, Accesses are saved immediately.
+        r.record(self.instance.pk, _ACCESS_SUCCESS, '')
+        self.assertEquals(Access.objects.count(), 2)
+        self.assertEquals(r.pending(), 0)
+
+    def test_deferred(self):
+        instancecache.clear()
+        r = self.new_recorder(batch_size=100)
+        with self.assertNumQueries(0):
+            r.record_deferred(self.instance.uuid, _ACCESS_SUCCESS, '')
+            r.record_deferred(self.instance.uuid, _ACCESS_SUCCESS, '')
+        self.assertEquals(r.pending(), 2)
+
+        # The uuid is looked up once, when the Accesses are written.
+        with self.assertNumQueries(9):
+            self.assertEquals(r.flush(), 2)
+        self.assertEquals(self.instance.access_count, 2)
+
+    def test_deferred_unknown(self):
+        r = self.new_recorder(batch_size=100)
+        r.record_deferred('0'*32, _ACCESS_SUCCESS, '')
+        r.record_deferred(self.instance.uuid, _ACCESS_SUCCESS, '')
+
+        # A failed write is retried without counting the failure twice.
+        def fail(accesses):
+            raise DatabaseError('failed')
+        old, accessrecorder.save_accesses = accessrecorder.save_accesses, fail
+        try:
+            self.assertRaises(DatabaseError, r.flush)
+        finally:
+            accessrecorder.save_accesses = old
+        self.assertEquals(r.pending(), 2)
+
+        # An unknown uuid is counted as a failure, not saved.
+        self.assertEquals(r.flush(), 1)
+        self.assertEquals(Access.objects.count(), 1)
+        qs = AccessFailureCount.objects.filter(result=_ACCESS_FAILURE_UUID)
+        self.assertEquals(qs.get().count, 1)
+        AccessFailureCount.objects.all().delete()
+
+#==============================================================================#
+class FailedAccess_TestCase(base.LinkAnalytics_DBTestCaseBase):
+    def setUp(self):
+        super(FailedAccess_TestCase, self).setUp()
+        self.clock = FakeClock()
+        
+    def tearDown(self):
+        super(FailedAccess_TestCase, self).tearDown()
+        AccessFailureCount.objects.all().delete()
+
+    def new_recorder(self, **kwargs):
+        kwargs.setdefault('background', False)
+        kwargs.setdefault('clock', self.clock)
+        return AccessRecorder(**kwargs)
+        
+    def failure_count(self, result):
+        qs = AccessFailureCount.objects.filter(result=result)
+        return sum(qs.values_list('count', flat=True))
+        
+    def test_unknown_pk(self):
+        pk = TrackedInstance.unknown_pk()
+        self.assertEquals(pk, TrackedInstance.unknown().pk)
+        with self.assertNumQueries(0):
+            self.assertEquals(TrackedInstance.unknown_pk(), pk)
+            
+        # Deleting the unknown TrackedInstance clears the cached value.
+        TrackedInstance.objects.all().delete()
+        self.assertEquals(TrackedInstance.unknown_pk(), 
+                          TrackedInstance.unknown().pk)
+        
+    def test_synchronous(self):
+        r = self.new_recorder(synchronous=True, failure_samples=2)
+        r.record_failure(_ACCESS_FAILURE_UUID, '')
+        r.record_failure(_ACCESS_FAILURE_UUID, '')
+        # Failures past the samples are only counted until the next write.
+        with self.assertNumQueries(0):
+            for i in range(3):
+                r.record_failure(_ACCESS_FAILURE_UUID, '')
+        self.assertEquals(self.failure_count(_ACCESS_FAILURE_UUID), 2)
+        self.clock.advance(r.flush_interval)
+        r.record_failure(_ACCESS_FAILURE_UUID, '')
+            
+        # Only the samples are kept as Accesses, but every failure is counted.
+        qs = Access.objects.filter(result=_ACCESS_FAILURE_UUID)
+        self.assertEquals(qs.count(), 2)
+        self.assertEquals(qs[0].instance.pk, TrackedInstance.unknown_pk())
+        self.assertEquals(AccessFailureCount.objects.count(), 1)
+        self.assertEquals(self.failure_count(_ACCESS_FAILURE_UUID), 6)
+        
+    def test_buffered(self):
+        t = self.new_tracker('tracker')
+        v = self.new_visitor('visitor')
+        i = t.add_visitor(v)
+        TrackedInstance.unknown_pk()
+        
+        r = self.new_recorder(batch_size=100, failure_samples=1)
+        with self.assertNumQueries(0):
+            for n in range(5):
+                r.record_failure(_ACCESS_FAILURE_UUID, '')
+                r.record_failure(_ACCESS_FAILURE_HASH, '', i.pk)
+        self.assertEquals(r.pending(), 2)
+        
+        r.flush()
+        self.assertEquals(Access.objects.count(), 2)
+        self.assertEquals(i.access_set.count(), 1)
+        self.assertEquals(self.failure_count(_ACCESS_FAILURE_UUID), 5)
+        self.assertEquals(self.failure_count(_ACCESS_FAILURE_HASH), 5)
+        
+    def test_minutes(self):
+        r = self.new_recorder(synchronous=True, failure_samples=1)
+        r.record_failure(_ACCESS_FAILURE_UUID, '')
+        r.record_failure(_ACCESS_FAILURE_UUID, '')
+        self.clock.advance(60)
+        r.record_failure(_ACCESS_FAILURE_UUID, '')
+        
+        # One sample and one count for each minute.
+        self.assertEquals(Access.objects.count(), 2)
+        counts = AccessFailureCount.objects.order_by('minute')
+        self.assertEquals([c.count for c in counts], [2, 1])
+
+#==============================================================================#
+
@@ -2,6 +2,7 @@
 from linkanalytics.email import _email
 from linkanalytics.util.htmltotext import HTMLtoText
 from linkanalytics.util.htmldocument import  HtmlDocument
+from linkanalytics.util.lrucache import LRUCache
 
 import base
 
@@ -124,4 +125,41 @@ class HTMLtoText_TestCase(base.LinkAnalytics_TestCaseBase):
         self.assertEquals(text, "One line.\nTwo lines.")
 
     
+#==============================================================================#
+class LRUCache_TestCase(base.LinkAnalytics_TestCaseBase):
+    def test_basic(self):
+        c = LRUCache(2)
+        c.set('a', 1)
+        c.set('b', 2)
+        self.assertEquals(c.get('a'), 1)
+        self.assertEquals(c.get('b'), 2)
+        self.assertEquals(c.get('c'), None)
+        self.assertEquals(c.get('c', 3), 3)
+        
+    def test_eviction(self):
+        c = LRUCache(2)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get('a')     # 'b' is now the least recently used
+        c.set('c', 3)
+        self.assertEquals(len(c), 2)
+        self.assertEquals(c.get('a'), 1)
+        self.assertEquals(c.get('b'), None)
+        self.assertEquals(c.get('c'), 3)
+        
+    def test_ttl(self):
+        now = [0]
+        c = LRUCache(10, ttl=60, clock=lambda: now[0])
+        c.set('a', 1)
+        now[0] = 59
+        self.assertEquals(c.get('a'), 1)
+        now[0] = 60
+        self.assertEquals(c.get('a'), None)
+        
+    def test_disabled(self):
+        c = LRUCache(0)
+        c.set('a', 1)
+        self.assertEquals(c.get('a'), None)
+        
+    
 #==============================================================================#
@@ -3,11 +3,17 @@
 """
 import datetime
 import imghdr
+from wsgiref.util import setup_testing_defaults
 
-from django.core.urlresolvers import reverse as urlreverse
+from django.core.urlresolvers import reverse as urlreverse, Resolver404
 
-from linkanalytics.models import TrackedInstance, Visitor, Tracker
-from linkanalytics import targetviews, urlex
+from linkanalytics.models import TrackedInstance, Visitor, Tracker, Access
+from linkanalytics.models import _ACCESS_FAILURE_HASH, _ACCESS_FAILURE_UUID
+from linkanalytics import targetviews, urlex, instancecache, app_settings
+from linkanalytics import accessrecorder
+from linkanalytics.accessrecorder import AccessRecorder
+from linkanalytics.targetdispatch import TargetDispatcher
+from linkanalytics.wsgiaccess import TrackingApplication
 
 import base
 
@@ -51,6 +57,124 @@ class AccessHashedUrl_TestCase(base.LinkAnalytics_DBTestCaseBase):
         self.assertEquals(Tracker.objects.count(), 1)
         self.assertEquals(Tracker.objects.all()[0].name, '_UNKNOWN')
         
+    def test_badhash_first(self):
+        # With VALIDATE_HASH_FIRST, a bad hash is rejected before the 
+        # TrackedInstance is looked up, so it is recorded against the unknown 
+        # TrackedInstance.
+        t = self.new_tracker(name='Name1')
+        v = self.new_visitor(username='trackee1')
+        i = t.add_visitor(v)
+        
+        hash = urlex.generate_urlhash(i.uuid, '/linkanalytics/nonexistent_url/')
+        urltail = urlex.urltail_redirect_local('linkanalytics/testurl/')
+        url = urlex.assemble_hashedurl(hash, i.uuid, urltail)
+        
+        old = app_settings.VALIDATE_HASH_FIRST
+        app_settings.VALIDATE_HASH_FIRST = True
+        try:
+            response = self.client.get(url)
+        finally:
+            app_settings.VALIDATE_HASH_FIRST = old
+        self.assertEquals(response.status_code, 404)
+        
+        a = Access.objects.get(result=_ACCESS_FAILURE_HASH)
+        self.assertEquals(a.instance.pk, TrackedInstance.unknown_pk())
+        self.assertEquals(i.access_set.count(), 0)
+        
+    def test_badhash_last(self):
+        # Without VALIDATE_HASH_FIRST, a bad hash is recorded against the 
+        # TrackedInstance.
+        t = self.new_tracker(name='Name1')
+        v = self.new_visitor(username='trackee1')
+        i = t.add_visitor(v)
+        
+        hash = urlex.generate_urlhash(i.uuid, '/linkanalytics/nonexistent_url/')
+        urltail = urlex.urltail_redirect_local('linkanalytics/testurl/')
+        url = urlex.assemble_hashedurl(hash, i.uuid, urltail)
+        
+        old = app_settings.VALIDATE_HASH_FIRST
+        app_settings.VALIDATE_HASH_FIRST = False
+        try:
+            response = self.client.get(url)
+        finally:
+            app_settings.VALIDATE_HASH_FIRST = old
+        self.assertEquals(response.status_code, 404)
+        
+        a = Access.objects.get(result=_ACCESS_FAILURE_HASH)
+        self.assertEquals(a.instance.pk, i.pk)
+        
+
+    def test_compact_tokens(self):
+        t = self.new_tracker(name='Name1')
+        v = self.new_visitor(username='trackee1')
+        i = t.add_visitor(v)
+        
+        legacy = urlex.hashedurl_redirect_local(i.uuid, 'linkanalytics/testurl/')
+        old = app_settings.URL_TOKEN_FORMAT
+        app_settings.URL_TOKEN_FORMAT = 'compact'
+        try:
+            url = urlex.hashedurl_redirect_local(i.uuid, 
+                                                 'linkanalytics/testurl/')
+            # Both compact and legacy urls are accepted.
+            self.assertEquals(self.client.get(url).status_code, 302)
+            self.assertEquals(self.client.get(legacy).status_code, 302)
+        finally:
+            app_settings.URL_TOKEN_FORMAT = old
+        self.assertEquals(self.client.get(url).status_code, 302)
+        self.assertEquals(i.access_count, 3)
+        
+        # A compact uuid which is not canonical is an unknown uuid.
+        hash, uuid = url.split('/')[1:3]
+        bad = url.replace(uuid, 'A'*21+'B')
+        self.assertEquals(self.client.get(bad).status_code, 404)
+        self.assertEquals(Access.objects.filter(
+                            result=_ACCESS_FAILURE_UUID).count(), 1)
+        
+
+class InstanceCache_TestCase(base.LinkAnalytics_DBTestCaseBase):
+    def test_lookup(self):
+        t = self.new_tracker(name='Name1')
+        v = self.new_visitor(username='trackee1')
+        i = t.add_visitor(v)
+        
+        with self.assertNumQueries(1):
+            ref = instancecache.lookup(i.uuid)
+        self.assertEquals(ref.pk, i.pk)
+        self.assertEquals(ref.uuid, i.uuid)
+        self.assertEquals(ref.tracker_id, t.pk)
+        
+        # The second lookup is served from the cache.
+        with self.assertNumQueries(0):
+            self.assertEquals(instancecache.lookup(i.uuid), ref)
+            
+    def test_unknown(self):
+        self.assertEquals(instancecache.lookup('0'*32), None)
+        
+    def test_invalidate_on_delete(self):
+        t = self.new_tracker(name='Name1')
+        v = self.new_visitor(username='trackee1')
+        i = t.add_visitor(v)
+        uuid = i.uuid
+        
+        self.assertNotEquals(instancecache.lookup(uuid), None)
+        i.delete()
+        self.assertEquals(instancecache.lookup(uuid), None)
+        
+    def test_repeat_access(self):
+        t = self.new_tracker('url1')
+        v = self.new_visitor('trackee1')
+        i = t.add_visitor(v)
+        
+        url = urlex.hashedurl_redirect_local(i.uuid, 'linkanalytics/testurl/')
+        self.client.get(url)
+        # Once cached, an access only costs the INSERT of its Access and the 
+        # updates of its AccessSummary, TrackerStats and AccessHistograms.  
+        # The cached instance gives its Tracker too.
+        with self.assertNumQueries(6):
+            response = self.client.get(url)
+        self.assertEquals(response.status_code, 302)
+        self.assertEquals(i.access_count, 2)
+        
 
 class CreateTrackedUrl_TestCase(base.LinkAnalytics_DBTestCaseBase):
     pass
@@ -59,6 +183,41 @@ class CreateTrackee_TestCase(base.LinkAnalytics_DBTestCaseBase):
     pass
 
 
+class TargetDispatch_TestCase(base.LinkAnalytics_TestCaseBase):
+    def new_dispatcher(self):
+        return TargetDispatcher(app_settings.TARGETS_URLCONF, 10)
+        
+    def test_fixed(self):
+        d = self.new_dispatcher()
+        fixed = d.fixed_targets()
+        for tail in ('/linkanalytics/ppx', '/linkanalytics/ppx/'):
+            self.assertTrue(tail in fixed)
+            viewfunc, args, kwargs = d.resolve(tail)
+            self.assertEquals(viewfunc, targetviews.targetview_pixelpng)
+            self.assertEquals(kwargs, {})
+        viewfunc, args, kwargs = d.resolve('/linkanalytics/gpx')
+        self.assertEquals(viewfunc, targetviews.targetview_pixelgif)
+        self.assertTrue('/linkanalytics/email/render/' in fixed)
+        
+    def test_cached(self):
+        d = self.new_dispatcher()
+        tail = urlex.urltail_redirect_http('www.example.com', 'a/b.html')
+        viewfunc, args, kwargs = d.resolve(tail)
+        self.assertEquals(viewfunc, targetviews.targetview_redirect)
+        self.assertEquals(kwargs, {'scheme': 'http', 
+                                   'domain': 'www.example.com', 
+                                   'filepath': 'a/b.html'})
+        
+        # Callers may modify the returned kwargs without affecting the cache.
+        kwargs['linkanalytics_flag'] = True
+        viewfunc, args, kwargs = d.resolve(tail)
+        self.assertFalse('linkanalytics_flag' in kwargs)
+        
+    def test_unknown(self):
+        d = self.new_dispatcher()
+        self.assertRaises(Resolver404, d.resolve, '/linkanalytics/nothing/')
+        
+        
 #==============================================================================#
 # Target View tests:
 
@@ -126,7 +285,19 @@ class ViewHtml_TestCase(base.LinkAnalytics_DBTestCaseBase):
         
 
 class ViewPixelGif_TestCase(base.LinkAnalytics_DBTestCaseBase):
-    pass
+    def test_basic(self):
+        t = self.new_tracker('url1')
+        v = self.new_visitor('trackee1')
+        i = t.add_visitor(v)
+        
+        url = urlex.hashedurl_pixelgif(i.uuid)
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], 'image/gif')
+        self.assertEquals(imghdr.what('', h=response.content), 'gif')
+        self.assertEquals(response['Content-Length'], 
+                          str(len(response.content)))
+        self.assertEquals(i.access_count, 1)
 
 class ViewPixelPng_TestCase(base.LinkAnalytics_DBTestCaseBase):
     def test_basic(self):
@@ -140,9 +311,155 @@ class ViewPixelPng_TestCase(base.LinkAnalytics_DBTestCaseBase):
         # In imghdr.what(), the first arg (the filename) is ignored when the 
         # 'h' arg (a byte stream) is given.
         self.assertEquals(imghdr.what('', h=response.content), 'png')
+        
+    def test_headers(self):
+        t = self.new_tracker('url1')
+        v = self.new_visitor('trackee1')
+        i = t.add_visitor(v)
+        
+        url = urlex.hashedurl_pixelpng(i.uuid)
+        response = self.client.get(url)
+        self.assertEquals(response['Content-Length'], 
+                          str(len(response.content)))
+        self.assertTrue('no-store' in response['Cache-Control'])
+        self.assertTrue(response.has_header('ETag'))
+        
+    def test_head(self):
+        t = self.new_tracker('url1')
+        v = self.new_visitor('trackee1')
+        i = t.add_visitor(v)
+        
+        url = urlex.hashedurl_pixelpng(i.uuid)
+        length = self.client.get(url)['Content-Length']
+        response = self.client.head(url)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.content, '')
+        self.assertEquals(response['Content-Length'], length)
 
 
 #==============================================================================#
+# WSGI application tests:
+
+class WsgiAccess_TestCase(base.LinkAnalytics_DBTestCaseBase):
+    def setUp(self):
+        super(WsgiAccess_TestCase, self).setUp()
+        self.fallback_calls = []
+        self.app = TrackingApplication(fallback=self.fallback, 
+                                       close_connections=False)
+        
+    def fallback(self, environ, start_response):
+        self.fallback_calls.append(environ['PATH_INFO'])
+        start_response('200 OK', [])
+        return ['fallback']
+        
+    def call(self, path, method='GET'):
+        environ = {'PATH_INFO': path, 'REQUEST_METHOD': method}
+        setup_testing_defaults(environ)
+        result = {}
+        def start_response(status, headers):
+            result['status'] = status
+            result['headers'] = dict(headers)
+        result['body'] = ''.join(self.app(environ, start_response))
+        return result
+        
+    def test_pixel(self):
+        t = self.new_tracker('url1')
+        v = self.new_visitor('trackee1')
+        i = t.add_visitor(v)
+        
+        r = self.call(urlex.hashedurl_pixelgif(i.uuid))
+        self.assertEquals(r['status'], '200 OK')
+        self.assertEquals(r['headers']['Content-Type'], 'image/gif')
+        self.assertEquals(imghdr.what('', h=r['body']), 'gif')
+        self.assertEquals(i.access_count, 1)
+        self.assertEquals(self.fallback_calls, [])
+        
+        r = self.call(urlex.hashedurl_pixelpng(i.uuid), method='HEAD')
+        self.assertEquals(r['status'], '200 OK')
+        self.assertEquals(r['body'], '')
+        self.assertEquals(i.access_count, 2)
+        
+    def test_redirect(self):
+        t = self.new_tracker('url1')
+        v = self.new_visitor('trackee1')
+        i = t.add_visitor(v)
+        
+        url = urlex.hashedurl_redirect_http(i.uuid, domain='www.example.com', 
+                                            filepath='a/b.html')
+        r = self.call(url)
+        self.assertEquals(r['status'], '302 FOUND')
+        self.assertEquals(r['headers']['Location'], 
+                          'http://www.example.com/a/b.html')
+        
+        url = urlex.hashedurl_redirect_local(i.uuid, 'linkanalytics/testurl/')
+        r = self.call(url)
+        self.assertEquals(r['headers']['Location'], 
+                          'http://127.0.0.1/linkanalytics/testurl/')
+        self.assertEquals(i.access_count, 2)
+        
+    def test_failures(self):
+        t = self.new_tracker('url1')
+        v = self.new_visitor('trackee1')
+        i = t.add_visitor(v)
+        
+        hash = urlex.generate_urlhash(i.uuid, '/linkanalytics/other/')
+        urltail = urlex.urltail_pixelpng()
+        r = self.call(urlex.assemble_hashedurl(hash, i.uuid, urltail))
+        self.assertEquals(r['status'], '404 NOT FOUND')
+        
+        r = self.call(urlex.hashedurl_pixelpng('0'*32))
+        self.assertEquals(r['status'], '404 NOT FOUND')
+        self.assertEquals(i.access_count, 0)
+        self.assertEquals(self.fallback_calls, [])
+        a = Access.objects.get(result=_ACCESS_FAILURE_HASH)
+        self.assertEquals(a.instance.pk, TrackedInstance.unknown_pk())
+        
+        # Without VALIDATE_HASH_FIRST, a bad hash is recorded against the 
+        # TrackedInstance.
+        old = app_settings.VALIDATE_HASH_FIRST
+        app_settings.VALIDATE_HASH_FIRST = False
+        try:
+            r = self.call(urlex.assemble_hashedurl(hash, i.uuid, urltail))
+        finally:
+            app_settings.VALIDATE_HASH_FIRST = old
+        self.assertEquals(r['status'], '404 NOT FOUND')
+        self.assertEquals(i.access_set.get().result, _ACCESS_FAILURE_HASH)
+        
+    def test_fallback(self):
+        t = self.new_tracker('url1')
+        v = self.new_visitor('trackee1')
+        i = t.add_visitor(v)
+        
+        # Other targets, and untracked urls, are passed on.
+        url = urlex.hashedurl_html(i.uuid, 'email/access-thankyou.html')
+        self.assertEquals(self.call(url)['body'], 'fallback')
+        self.assertEquals(self.call('/linkanalytics/testurl/')['body'], 
+                          'fallback')
+        self.assertEquals(len(self.fallback_calls), 2)
+        self.assertEquals(i.access_count, 0)
 
+    def test_deferred_lookup(self):
+        t = self.new_tracker('url1')
+        v = self.new_visitor('trackee1')
+        i = t.add_visitor(v)
+        instancecache.clear()
 
+        # With a buffered recorder and DEFER_INSTANCE_LOOKUP, a pixel is
+        # served without touching the database.
+        recorder = AccessRecorder(batch_size=100, background=False)
+        old = (accessrecorder._recorder, app_settings.DEFER_INSTANCE_LOOKUP)
+        accessrecorder._recorder = recorder
+        app_settings.DEFER_INSTANCE_LOOKUP = True
+        try:
+            with self.assertNumQueries(0):
+                r = self.call(urlex.hashedurl_pixelgif(i.uuid))
+        finally:
+            accessrecorder._recorder, app_settings.DEFER_INSTANCE_LOOKUP = old
+        self.assertEquals(r['status'], '200 OK')
+        self.assertEquals(recorder.pending(), 1)
 
+        recorder.flush()
+        self.assertEquals(i.access_count, 1)
+
+
+#==============================================================================#
@@ -2,11 +2,20 @@
     Functions for calculating tracked URLs and generating hashed URLs.
 """
 
+import base64
+import binascii
 import hmac
+import re
 
-from django.core.urlresolvers import reverse as urlreverse
+from django.conf import settings
+from django.core.urlresolvers import reverse as urlreverse, NoReverseMatch
+from django.core.urlresolvers import get_script_prefix, get_urlconf
+from django.core.urlresolvers import get_resolver
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import iri_to_uri, force_unicode
 
-from linkanalytics import app_settings
+from linkanalytics.util.lrucache import LRUCache
+from linkanalytics import app_settings, urlsaccess
 
 #==============================================================================#
 # Basic structure of a Linkanalytics URL:
@@ -18,6 +27,11 @@ from linkanalytics import app_settings
 # The <HASH> is used to validate that a URL was created by Linkanalytics.
 # The <UUID> determines who is visiting a URL and which Tracker is being 
 # visited.
+#
+# The <HASH> and <UUID> are normally hexadecimal.  With the URL_TOKEN_FORMAT 
+# setting 'compact', they are shortened: the <HASH> is 'v1' followed by a 
+# truncated digest in base64url, and the <UUID> is also in base64url.  The 
+# hash is calculated from the hexadecimal uuid in both cases.
 # The <URLTAIL> is redirected to the appropriate targetview via a targeturl 
 # conf.  It may contain forward slashes--everything after the UUID is the 
 # <URLTAIL>.
@@ -28,36 +42,112 @@ from linkanalytics import app_settings
 
 #==============================================================================#
 # Create the 'tail' portion of a tracked URL.
+#
+# Urltails are created often (for every link of every email), and reversing a 
+# target pattern is slow.  A target which takes no arguments always has the 
+# same urltail, so it is reversed only once.  For a target with arguments, a 
+# format string is derived once by reversing it with sentinel values.  Each 
+# urltail formatted from it is still checked against the target's pattern; 
+# if it does not match, urlreverse() is used instead (which raises 
+# NoReverseMatch if the arguments are invalid).
+#==============================================================================#
 
 def urltail_redirect_http(domain, filepath=''):
     """Create a urltail that will redirect to an arbitrary http:// URL."""
-    return urlreverse('redirect-http', urlconf=app_settings.TARGETS_URLCONF, 
-                      kwargs={'domain':domain, 'filepath':filepath})
+    return build_urltail('redirect-http', domain=domain, filepath=filepath)
                       
 def urltail_redirect_https(domain, filepath=''):
     """Create a urltail that will redirect to an arbitrary https:// URL."""
-    return urlreverse('redirect-https', urlconf=app_settings.TARGETS_URLCONF, 
-                      kwargs={'domain':domain, 'filepath':filepath})
+    return build_urltail('redirect-https', domain=domain, filepath=filepath)
                       
 def urltail_redirect_local(filepath):
     """Create a urltail that will redirect to an arbitrary local url."""
-    return urlreverse('redirect-local', urlconf=app_settings.TARGETS_URLCONF, 
-                      kwargs={'filepath':filepath})
+    return build_urltail('redirect-local', filepath=filepath)
                       
 def urltail_html(filepath):
     """Create a urltail that will forward to an arbitrary local html page."""
-    return urlreverse('targetview-html', urlconf=app_settings.TARGETS_URLCONF, 
-                      kwargs={'filepath':filepath})
+    return build_urltail('targetview-html', filepath=filepath)
                       
 def urltail_pixelgif():
     """Create a urltail that will forward to the gif pixel image."""
-    return urlreverse('targetview-pixelgif', 
-                      urlconf=app_settings.TARGETS_URLCONF)
+    return constant_urltail('targetview-pixelgif')
                       
 def urltail_pixelpng():
     """Create a urltail that will forward to the png pixel image."""
-    return urlreverse('targetview-pixelpng', 
-                      urlconf=app_settings.TARGETS_URLCONF)
+    return constant_urltail('targetview-pixelpng')
+    
+_constant_urltails = {}
+
+def constant_urltail(name, urlconf=None):
+    """Returns the urltail of the named target, which must take no arguments.  
+       The default urlconf is the TARGETS_URLCONF setting."""
+    if urlconf is None:
+        urlconf = app_settings.TARGETS_URLCONF
+    key = (name, urlconf, get_script_prefix())
+    tail = _constant_urltails.get(key)
+    if tail is None:
+        tail = _constant_urltails[key] = urlreverse(name, urlconf=urlconf)
+    return tail
+    
+def build_urltail(name, urlconf=None, **kwargs):
+    """Returns the urltail of the named target for the given keyword 
+       arguments.  The default urlconf is the TARGETS_URLCONF setting."""
+    if urlconf is None:
+        urlconf = app_settings.TARGETS_URLCONF
+    return urltail_format(name, sorted(kwargs), urlconf).build(**kwargs)
+    
+_urltail_formats = {}
+
+def urltail_format(name, params, urlconf):
+    """Returns the UrltailFormat of the named target for the given parameter 
+       names."""
+    key = (name, tuple(params), urlconf, get_script_prefix())
+    f = _urltail_formats.get(key)
+    if f is None:
+        f = _urltail_formats[key] = UrltailFormat(name, params, urlconf)
+    return f
+    
+
+class UrltailFormat(object):
+    """Builds the urltails of one target from keyword arguments, using a 
+       format string derived by reversing the target once."""
+       
+    def __init__(self, name, params, urlconf):
+        self.name = name
+        self.params = tuple(params)
+        self.urlconf = urlconf
+        self.format = None
+        self.regex = None
+        
+        # Each sentinel matches the patterns for domains and file paths.
+        sentinels = dict((p, 'linkanalytics-sentinel-%d.x' % n) 
+                         for n, p in enumerate(self.params))
+        try:
+            url = urlreverse(name, urlconf=urlconf, kwargs=sentinels)
+        except NoReverseMatch:
+            return
+        entries = get_resolver(urlconf).reverse_dict.getlist(name)
+        if len(entries) != 1:
+            return
+        fmt = url.replace('{', '{{').replace('}', '}}')
+        for p, sentinel in sentinels.iteritems():
+            if fmt.count(sentinel) != 1:
+                return
+            fmt = fmt.replace(sentinel, '{%s}' % p)
+        pattern = entries[0][1]
+        prefix = get_script_prefix()
+        self.regex = re.compile(u'^%s%s' % (re.escape(prefix), pattern), 
+                                re.UNICODE)
+        self.format = fmt
+        
+    def build(self, **kwargs):
+        """Returns the urltail for the given keyword arguments."""
+        if self.format is not None:
+            values = dict((k, force_unicode(v)) for k, v in kwargs.iteritems())
+            tail = self.format.format(**values)
+            if self.regex.search(tail):
+                return iri_to_uri(tail)
+        return urlreverse(self.name, urlconf=self.urlconf, kwargs=kwargs)
 
 #==============================================================================#
 def hashedurl_redirect_http(uuid, domain, filepath=''):
@@ -97,19 +187,103 @@ def hashedurl_pixelpng(uuid):
     return create_hashedurl(uuid, urltail)
 
 #==============================================================================#
+# An email sent to many recipients contains the same few urltails for every 
+# recipient, so most of the work of creating its hashed URLs can be shared:
+#
+#   * The HMAC is keyed once.  Each hash then starts from a copy() of the keyed 
+#     object, rather than redoing the key schedule.
+#   * The access URL is assembled from a format string, derived once by 
+#     reversing the 'linkanalytics-accesshashedview' pattern with sentinel 
+#     values, instead of calling urlreverse() for every URL.  The format 
+#     depends on the script prefix and urlconf, so one is kept for each.
+#   * Each urltail is checked against the access pattern only once.
+#==============================================================================#
+
+_keyed_hmacs = {}
+
+def _keyed_hmac():
+    """Returns an HMAC object keyed with the SECRET_KEY setting, to which no 
+       data has been added.  It must be copied before use."""
+    key = (app_settings.SECRET_KEY, app_settings.DIGEST_CTOR)
+    h = _keyed_hmacs.get(key)
+    if h is None:
+        h = _keyed_hmacs[key] = hmac.new(key[0], digestmod=key[1])
+    return h
+
 def generate_urlhash(uuid, urltail):
     """Generates a hash for the given urltail and uuid.  The return value is a 
        string of hexadecimal digits representing the hash value.
     """
-    return hmac.new(app_settings.SECRET_KEY, uuid+urltail, 
-                    app_settings.DIGEST_CTOR).hexdigest()
+    h = _keyed_hmac().copy()
+    h.update(uuid+urltail)
+    return h.hexdigest()
+                    
+def validate_urlhash(hash, uuid, urltail):
+    """Returns True if hash is the correct hash for the given uuid and urltail.  
+       The hash may be in either hexadecimal or compact form, but the uuid 
+       must be hexadecimal.  This requires only the secret key, not the 
+       database.
+    """
+    h = _keyed_hmac().copy()
+    h.update(uuid+urltail)
+    if hash.startswith(_TOKEN_VERSION):
+        expected = _compact_hash(h)
+    else:
+        expected = h.hexdigest()
+    return constant_time_compare(hash, expected)
+    
+#==============================================================================#
+# Compact tokens
+
+_TOKEN_VERSION = 'v1'
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+def _compact_hash(h):
+    """Returns the compact form of the hash for the given HMAC object."""
+    return _TOKEN_VERSION + _b64encode(h.digest()[:app_settings.URL_MAC_LENGTH])
+
+def compact_uuid(uuid):
+    """Returns the compact (base64url) form of a hexadecimal uuid."""
+    return _b64encode(binascii.unhexlify(uuid))
+    
+def parse_uuid(uuid):
+    """Returns the hexadecimal form of a uuid taken from a URL, which may be 
+       in either hexadecimal or compact form.  Returns None if it is not a 
+       valid uuid in either form."""
+    if len(uuid) == 32:
+        return uuid
+    try:
+        hexuuid = binascii.hexlify(base64.urlsafe_b64decode(str(uuid)+'=='))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+    # Only the canonical encoding is accepted.
+    if len(hexuuid) != 32 or compact_uuid(hexuuid) != uuid:
+        return None
+    return hexuuid
                     
 def create_hashedurl(uuid, urltail):
     """Create a hashed Linkanalytics URL from the given uuid and urltail."""
-    if not urltail.startswith('/'):
-        urltail = '/%s' % urltail
-    hash = generate_urlhash(uuid, urltail)
-    return assemble_hashedurl(hash, uuid, urltail[1:])
+    return hashedurl_builder(urltail)(uuid)
+    
+def create_hashedurls(pairs):
+    """Create hashed Linkanalytics URLs for a sequence of (uuid, urltail) 
+       pairs.  Returns a list of URLs in the same order."""
+    builders = {}
+    urls = []
+    for uuid, urltail in pairs:
+        b = builders.get(urltail)
+        if b is None:
+            b = builders[urltail] = hashedurl_builder(urltail)
+        urls.append(b(uuid))
+    return urls
+    
+def create_hashedurls_for_tail(urltail, uuids):
+    """Create hashed Linkanalytics URLs for one urltail and each of a 
+       sequence of uuids.  Returns a list of URLs in the same order."""
+    b = hashedurl_builder(urltail)
+    return [b(uuid) for uuid in uuids]
                     
 def assemble_hashedurl(hash, uuid, urltail):
     """Assemble a hashed URL from its components.  The hash must be calculated 
@@ -118,4 +292,81 @@ def assemble_hashedurl(hash, uuid, urltail):
     return urlreverse('linkanalytics-accesshashedview', kwargs=kwargs)
 
 #==============================================================================#
+# Sentinel values used to derive the access URL format.  Each matches the 
+# corresponding part of the access pattern, and cannot appear elsewhere.
+_HASH_SENTINEL = 'a'*40
+_UUID_SENTINEL = 'b'*32
+_TAIL_SENTINEL = 'linkanalyticstailsentinel'
 
+_re_tailpath = re.compile(r'^'+urlsaccess._TAILPATH+r'$', re.UNICODE)
+
+_url_formats = {}
+
+def access_url_format():
+    """Returns a format string for the hashed URLs of the current script 
+       prefix and urlconf, taking the arguments hash, uuid and tailpath.  The 
+       tailpath must not begin with a slash, and must already be converted 
+       with iri_to_uri().
+    """
+    key = (get_script_prefix(), get_urlconf() or settings.ROOT_URLCONF)
+    fmt = _url_formats.get(key)
+    if fmt is None:
+        url = assemble_hashedurl(_HASH_SENTINEL, _UUID_SENTINEL, 
+                                 _TAIL_SENTINEL)
+        fmt = url.replace('{', '{{').replace('}', '}}')
+        for sentinel, name in ((_HASH_SENTINEL, 'hash'), 
+                               (_UUID_SENTINEL, 'uuid'), 
+                               (_TAIL_SENTINEL, 'tailpath')):
+            assert fmt.count(sentinel) == 1, url
+            fmt = fmt.replace(sentinel, '{%s}' % name)
+        _url_formats[key] = fmt
+    return fmt
+    
+
+class HashedUrlBuilder(object):
+    """Creates the hashed Linkanalytics URLs for one urltail.  Call the 
+       builder with a uuid to obtain its URL."""
+       
+    def __init__(self, urltail):
+        if not urltail.startswith('/'):
+            urltail = '/%s' % urltail
+        if not _re_tailpath.match(urltail[1:]):
+            msg = "urltail '%s' does not match the access pattern" % urltail
+            raise NoReverseMatch(msg)
+        self.urltail = urltail
+        self.compact = (app_settings.URL_TOKEN_FORMAT == 'compact')
+        self._hmac = _keyed_hmac()
+        self._format = access_url_format()
+        self._tailpath = iri_to_uri(urltail[1:])
+        
+    def hash(self, uuid):
+        """Returns the hash of this builder's urltail for the given uuid, in 
+           the builder's token format."""
+        h = self._hmac.copy()
+        h.update(uuid+self.urltail)
+        return _compact_hash(h)  if self.compact else  h.hexdigest()
+        
+    def __call__(self, uuid):
+        hash = self.hash(uuid)
+        if self.compact:
+            uuid = compact_uuid(uuid)
+        return self._format.format(hash=hash, uuid=uuid, 
+                                   tailpath=self._tailpath)
+        
+# HashedUrlBuilders by urltail, secret key, token format, script prefix and 
+# urlconf.
+_builders = LRUCache(1000)
+
+def hashedurl_builder(urltail):
+    """Returns a HashedUrlBuilder for the given urltail, reusing one 
+       created earlier if possible."""
+    key = (urltail, app_settings.SECRET_KEY, app_settings.DIGEST_CTOR, 
+           app_settings.URL_TOKEN_FORMAT, app_settings.URL_MAC_LENGTH,
+           get_script_prefix(), get_urlconf() or settings.ROOT_URLCONF)
+    b = _builders.get(key)
+    if b is None:
+        b = HashedUrlBuilder(urltail)
+        _builders.set(key, b)
+    return b
+    
+#==============================================================================#
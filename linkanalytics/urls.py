@@ -3,10 +3,11 @@ from django.conf.urls.defaults import *
 #==============================================================================#
 # Note that the trailing slash in _TAILPATH is optional.
 _TAILPATH = r'(?P<tailpath>(?:(?:/[-\w\d_.])|[-\w\d_.])+/?)'
-_UUID = r'(?P<uuid>[a-f0-9]{32})'
+# The uuid is either hexadecimal or (in compact urls) base64url.
+_UUID = r'(?P<uuid>[a-f0-9]{32}|[-\w]{22})'
 # The hash can be many lengths depending on the exact algorithm used, so only a 
-# lower bound is given.
-_HASH = r'(?P<hash>[a-f0-9]{32,})'
+# lower bound is given.  Compact hashes are base64url with a version prefix.
+_HASH = r'(?P<hash>[a-f0-9]{32,}|v1[-\w]{6,})'
 
 #==============================================================================#
 # The following variables are used by target views.
@@ -0,0 +1,59 @@
+import threading
+import time
+from collections import OrderedDict
+
+#==============================================================================#
+class LRUCache(object):
+    """A thread-safe mapping with a bounded number of entries.  When full, the
+       least recently used entry is discarded.  If ttl is given, entries
+       expire that many seconds after they were stored.  A maxsize of 0
+       disables the cache: nothing is stored.
+    """
+    def __init__(self, maxsize, ttl=None, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return the value stored for key, or default if there is no
+           unexpired entry."""
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= self.clock():
+                return default
+            self._data[key] = (value, expires)  # now most recently used
+            return value
+
+    def set(self, key, value):
+        """Store value for key, discarding the least recently used entry if the
+           cache is full."""
+        if self.maxsize <= 0:
+            return
+        expires = None
+        if self.ttl is not None:
+            expires = self.clock() + self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Remove any entry for key."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+
+#==============================================================================#
@@ -4,15 +4,15 @@ from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.contrib.auth.decorators import login_required
-from django.core.urlresolvers import resolve, Resolver404, reverse as urlreverse
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.urlresolvers import Resolver404, reverse as urlreverse
 
 
-from linkanalytics.models import Visitor, Tracker, TrackedInstance
+from linkanalytics.models import Visitor, Tracker
 from linkanalytics.models import _ACCESS_SUCCESS, _ACCESS_FAILURE_UUID
 from linkanalytics.models import _ACCESS_FAILURE_HASH, _ACCESS_ERROR_TARGETVIEW
 from linkanalytics.forms import TrackedUrlDefaultForm, TrackeeForm
-from linkanalytics import app_settings
+from linkanalytics import app_settings, accessrecorder, instancecache, urlex
+from linkanalytics import targetdispatch
 
 #==============================================================================#
 # Linkanalytics basic views
@@ -27,43 +27,65 @@ def accessHashedTrackedUrl(request, hash, uuid, tailpath):
        targetview raises an exception, the unsuccessful access is noted and the 
        exception is reraised.
     """
-    # Implementation note: The access attempt must always be recorded.
+    # Implementation note: The access attempt must always be recorded.  This 
+    # goes through the accessrecorder module, which may buffer the Access 
+    # rather than saving it before the response is returned.
     
     url = request.build_absolute_uri()
     if not tailpath.startswith('/'):
         tailpath = '/%s' % tailpath
-    # Retrieve the TrackedInstance.
-    try:
-        i = TrackedInstance.objects.get(uuid=uuid)
-    except ObjectDoesNotExist:
-        # record failed access in special TrackedInstance
-        TrackedInstance.unknown().on_access(result=_ACCESS_FAILURE_UUID, 
-                                            url=url)
+    uuid = urlex.parse_uuid(uuid)
+    if uuid is None:
+        accessrecorder.record_failure(_ACCESS_FAILURE_UUID, url)
         raise Http404
     
-    # Validate the URL against the hash value.
-    if not i.match_hash(hash, tailpath):
-        i.on_access(result=_ACCESS_FAILURE_HASH, url=url)
-        raise Http404
+    # The hash depends only on the uuid in the URL, so it can be validated 
+    # before anything is looked up.  Forged URLs then never reach the 
+    # database.
+    if app_settings.VALIDATE_HASH_FIRST:
+        if not urlex.validate_urlhash(hash, uuid, tailpath):
+            accessrecorder.record_failure(_ACCESS_FAILURE_HASH, url)
+            raise Http404
+    
+    if app_settings.VALIDATE_HASH_FIRST and app_settings.DEFER_INSTANCE_LOOKUP:
+        # A valid hash shows the uuid was generated by Linkanalytics, so the 
+        # TrackedInstance is not looked up until the Access is written.
+        def record(result):
+            accessrecorder.record_deferred(uuid, result, url)
+    else:
+        # Retrieve the TrackedInstance (only its pk and uuid are needed).
+        i = instancecache.lookup(uuid)
+        if i is None:
+            # record failed access (sampled in the unknown TrackedInstance)
+            accessrecorder.record_failure(_ACCESS_FAILURE_UUID, url)
+            raise Http404
+    
+        # Validate the URL against the hash value.
+        if not app_settings.VALIDATE_HASH_FIRST:
+            if not urlex.validate_urlhash(hash, i.uuid, tailpath):
+                accessrecorder.record_failure(_ACCESS_FAILURE_HASH, url, i.pk)
+                raise Http404
+                
+        def record(result):
+            accessrecorder.record(i.pk, result, url, i.tracker_id)
     
     # Call the targetview function (represented by 'viewfunc')
     try:
         # Flag to verify this request comes via a tracked url
-        viewfunc, args, kwargs = resolve(tailpath, 
-                                         urlconf=app_settings.TARGETS_URLCONF)
+        viewfunc, args, kwargs = targetdispatch.resolve_target(tailpath)
         kwargs['linkanalytics_flag'] = True
         kwargs['linkanalytics_uuid'] = uuid
         response = viewfunc(request, *args, **kwargs)
     except Exception:
-        i.on_access(result=_ACCESS_ERROR_TARGETVIEW, url=url)
+        record(_ACCESS_ERROR_TARGETVIEW)
         raise
         
     # If we get here, the target viewfunc returned a response.  But check the 
     # status_code for failure values before recording the access.
     if response.status_code >= 400:
-        i.on_access(result=_ACCESS_ERROR_TARGETVIEW, url=url)
+        record(_ACCESS_ERROR_TARGETVIEW)
     else:
-        i.on_access(result=_ACCESS_SUCCESS, url=url)
+        record(_ACCESS_SUCCESS)
     
     return response
 
@@ -0,0 +1,143 @@
+"""
+    A lightweight WSGI application for serving tracked URLs.
+
+    Tracked URLs are normally handled by the full Django stack: every
+    middleware, then the root urlconf, and then accessHashedTrackedUrl.  For
+    the most common targets--pixel images and redirects--none of that is
+    needed.  This application matches tracked URLs itself, validates them,
+    records the access, and serves pixels and redirects directly.  Any other
+    request (including tracked URLs for other targets) is passed to Django
+    unchanged.
+
+    To use it, point the WSGI server for the tracking hosts at
+    linkanalytics.wsgiaccess.application (with DJANGO_SETTINGS_MODULE set as
+    for any Django WSGI application).
+"""
+
+import re
+import urlparse
+from wsgiref.util import request_uri
+
+from django.core import signals
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.urlresolvers import Resolver404, set_script_prefix
+from django.core.handlers.base import get_script_name
+
+from linkanalytics.models import _ACCESS_SUCCESS, _ACCESS_FAILURE_UUID
+from linkanalytics.models import _ACCESS_FAILURE_HASH, _ACCESS_ERROR_TARGETVIEW
+from linkanalytics import accessrecorder, instancecache, pixels, targetviews
+from linkanalytics import targetdispatch, urlex, urlsaccess, app_settings
+
+#==============================================================================#
+_NOT_FOUND_BODY = '<html><body><h1>Not Found</h1></body></html>'
+
+class TrackingApplication(object):
+    """WSGI application serving pixel and redirect targets of tracked URLs.
+       Other requests are passed to fallback, by default Django's
+       WSGIHandler.
+
+       If close_connections is True, Django's request_started and
+       request_finished signals are sent around each tracked request, as
+       Django's own handler does (which closes the database connection).
+    """
+    def __init__(self, fallback=None, close_connections=True):
+        if fallback is None:
+            fallback = WSGIHandler()
+        self.fallback = fallback
+        self.close_connections = close_connections
+        self.regex = re.compile(urlsaccess.URLCONF_TUPLE[0], re.UNICODE)
+        self.pixel_views = { targetviews.targetview_pixelgif: 'gif',
+                             targetviews.targetview_pixelpng: 'png', }
+        self.redirect_views = ( targetviews.targetview_redirect, )
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        m = self.regex.match(path[1:])
+        if m is None:
+            return self.fallback(environ, start_response)
+        hash, uuid, tailpath = m.group('hash', 'uuid', 'tailpath')
+        tailpath = '/' + tailpath.lstrip('/')
+
+        # Only pixels and redirects are served here.
+        try:
+            viewfunc, args, kwargs = targetdispatch.resolve_target(tailpath)
+        except Resolver404:
+            return self.fallback(environ, start_response)
+        if viewfunc not in self.pixel_views and \
+           viewfunc not in self.redirect_views:
+            return self.fallback(environ, start_response)
+
+        set_script_prefix(get_script_name(environ))
+        if self.close_connections:
+            signals.request_started.send(sender=self.__class__)
+        try:
+            status, headers, body = self.serve(environ, hash, uuid, tailpath,
+                                               viewfunc, kwargs)
+        finally:
+            if self.close_connections:
+                signals.request_finished.send(sender=self.__class__)
+        start_response(status, headers)
+        return [body]
+
+    def serve(self, environ, hash, uuid, tailpath, viewfunc, kwargs):
+        """Validate and record a tracked access whose target is viewfunc.
+           Returns a (status, headers, body) tuple."""
+        url = request_uri(environ)
+
+        uuid = urlex.parse_uuid(uuid)
+        if uuid is None:
+            accessrecorder.record_failure(_ACCESS_FAILURE_UUID, url)
+            return self.not_found()
+        # As in views.accessHashedTrackedUrl().
+        hashfirst = app_settings.VALIDATE_HASH_FIRST
+        if hashfirst and not urlex.validate_urlhash(hash, uuid, tailpath):
+            accessrecorder.record_failure(_ACCESS_FAILURE_HASH, url)
+            return self.not_found()
+        if hashfirst and app_settings.DEFER_INSTANCE_LOOKUP:
+            def record(result):
+                accessrecorder.record_deferred(uuid, result, url)
+        else:
+            i = instancecache.lookup(uuid)
+            if i is None:
+                accessrecorder.record_failure(_ACCESS_FAILURE_UUID, url)
+                return self.not_found()
+            if not hashfirst and \
+               not urlex.validate_urlhash(hash, i.uuid, tailpath):
+                accessrecorder.record_failure(_ACCESS_FAILURE_HASH, url, i.pk)
+                return self.not_found()
+            def record(result):
+                accessrecorder.record(i.pk, result, url, i.tracker_id)
+
+        try:
+            if viewfunc in self.pixel_views:
+                result = self.pixel(environ, self.pixel_views[viewfunc])
+            else:
+                result = self.redirect(url, **kwargs)
+        except Exception:
+            record(_ACCESS_ERROR_TARGETVIEW)
+            raise
+        record(_ACCESS_SUCCESS)
+        return result
+
+    def pixel(self, environ, imgtype):
+        p = pixels.get_pixel(imgtype)
+        body = p.content  if environ.get('REQUEST_METHOD') != 'HEAD' else  ''
+        return '200 OK', list(p.headers), body
+
+    def redirect(self, url, scheme=None, domain=None, filepath=None):
+        location = targetviews.redirect_url(scheme, domain, filepath)
+        location = urlparse.urljoin(url, location)
+        headers = [('Content-Type', 'text/html; charset=utf-8'),
+                   ('Content-Length', '0'),
+                   ('Location', location)]
+        return '302 FOUND', headers, ''
+
+    def not_found(self):
+        headers = [('Content-Type', 'text/html; charset=utf-8'),
+                   ('Content-Length', str(len(_NOT_FOUND_BODY)))]
+        return '404 NOT FOUND', headers, _NOT_FOUND_BODY
+
+#==============================================================================#
+application = TrackingApplication()
+
+#==============================================================================#